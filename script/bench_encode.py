@@ -0,0 +1,159 @@
+import argparse
+import time
+
+import isa
+import map
+
+# instructions per second of map.encode (integer fields, isa.encode) against the
+# binary string encoder it replaced (BI_MAP fragments, hex_bi, build_instr)
+#
+#   python bench_encode.py pipeline.txt --repeat 200
+
+ROT = "0000"
+
+BI_MAP = {
+    'NOP' : '0xE0000000',
+    'ADD' : '0100',
+    'SUB' : '0010',
+    'MOV' : '1101',
+    'LSL' : '0110',
+    'SLT' : '1011',
+    'BEQ' : '00',
+    'BNE' : '01',
+    'B' : '10',
+    'B_prefix' : '10',
+    'con_process': '1110',
+    'process_prefix' : '00',
+    'S' : '0',
+    'imm' : '1',
+    'reg' : '0',
+    'ls_prefix' : '01',
+    'ls_P' : '1',
+    'ls_add' : '1',
+    'ls_sub' : '0',
+    'l_BNWL' : '001',
+    'l_BWL' : '011',
+    'S_BWL' : '000',
+    'S_BNWL' : '010'
+}
+
+
+def hex_bi(str, width=32, signed=False):
+    value = int(map.de_hex(str), 16)
+    if signed :
+        mask = (1 << width) - 1
+        value = value & mask
+    return f'{value:0{width}b}'
+
+def build_instr(upcode, rn, rd, offset, line):
+    bi_instr = f'{upcode}{rn}{rd}{offset}'
+    if len(bi_instr) != 32:
+        raise ValueError(f"Line {line}:  {bi_instr} Instruction length is not 32 bits")
+    return hex(int(bi_instr, 2))
+
+def string_encode(ins, pc):
+    # the old encoder, kept here as the baseline
+    if ins.op == 'nop':
+        return BI_MAP.get('NOP')
+    if ins.op == 'dp':
+        if ins.imm is None:
+            r_ctrl = BI_MAP.get('reg')
+            offset = '0000' + f'{ins.rm:04b}'
+        else:
+            r_ctrl = BI_MAP.get('imm')
+            offset = hex_bi(f'{ins.imm}', width=8)
+        upcode = f'{BI_MAP.get("con_process")}{BI_MAP.get("process_prefix")}{r_ctrl}{BI_MAP.get(ins.cmd)}{BI_MAP.get("S")}'
+        return build_instr(upcode, f'{ins.rn:04b}', f'{ins.rd:04b}', ROT + offset, ins.line)
+    if ins.op in ('ldr', 'str'):
+        if ins.op == 'ldr':
+            bwl = BI_MAP.get('l_BWL') if ins.wb else BI_MAP.get('l_BNWL')
+        else:
+            bwl = BI_MAP.get('S_BWL') if ins.wb else BI_MAP.get('S_BNWL')
+        direction = BI_MAP.get('ls_sub') if ins.sub else BI_MAP.get('ls_add')
+        header = BI_MAP.get('ls_prefix') + BI_MAP.get('imm') + BI_MAP.get('ls_P') + direction + bwl
+        offset = ROT + hex_bi(f'{ins.imm}', width=8)
+        return build_instr(f'{BI_MAP.get("con_process")}{header}', f'{ins.rn:04b}', f'{ins.rd:04b}', offset, ins.line)
+    if ins.op in ('beq', 'bne'):
+        offset = hex_bi(f'{ins.imm - pc - 2}', width=16, signed=True)
+        header = BI_MAP.get('B_prefix') + BI_MAP.get(ins.op.upper())
+        return build_instr(f'{BI_MAP.get("con_process")}{header}', f'{ins.rn:04b}', f'{ins.rm:04b}', offset, ins.line)
+    if ins.op == 'b':
+        offset = '0000' + '000' + hex_bi(f'{ins.imm - pc - 2}', width=9, signed=True)
+        header = BI_MAP.get('B_prefix') + BI_MAP.get('B')
+        return build_instr(f'{BI_MAP.get("con_process")}{header}', '0000', '0000', offset, ins.line)
+    if ins.op == 'bx':
+        return build_instr('11100001', '0010', '1111', '11111111' + '0001' + f'{ins.rm:04b}', ins.line)
+    raise ValueError(f"Line {ins.line}: cannot encode {ins.op}")
+
+
+def lower_file(path):
+    # Instr words of every code line, labels pointed at the word itself;
+    # cmp + b<cond> lowered as map.Assembler does it
+    program = []
+    flags = None
+    with open(path, 'r') as f:
+        for line, text in enumerate(f):
+            parts = text.split(maxsplit=1)
+            if not parts or parts[0].startswith('.') or parts[0].endswith(':'):
+                continue
+            args = parts[1] if len(parts) > 1 else ''
+            if parts[0] == 'cmp':
+                flags = map.parse_cmp(args, line)
+            elif parts[0] in map.COND_BRANCHES:
+                map.LOWER[parts[0]](program, parts[0], args, line, 0, flags)
+            else:
+                map.LOWER[parts[0]](program, parts[0], args, line, 0)
+                flags = None
+    for pc, ins in enumerate(program):
+        if ins.label is not None:
+            if ins.op in ('ldr', 'str'):
+                ins.rn = 0
+            ins.imm = pc if ins.op in ('b', 'beq', 'bne') else 0
+    return program
+
+
+def rate(fn, program, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(program)
+    return len(program) * repeat / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the instruction encoder')
+    parser.add_argument('arm', nargs='?', default='pipeline.txt')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    program = lower_file(args.arm)
+    old = [int(string_encode(ins, pc), 16) for pc, ins in enumerate(program)]
+    new = isa.new_image(len(program))
+    for pc, ins in enumerate(program):
+        new[pc] = map.encode(ins, pc)
+    # B now carries the sign extended off24, the pipeline only reads [8:0]
+    # (and never uses the register fields it overlaps)
+    def view(word):
+        dec = isa.decode(word)
+        return dec._replace(reg1=0, reg2=0, wreg=0) if dec.kind == isa.K_BRANCH else dec
+    bad = [pc for pc in range(len(program)) if view(old[pc]) != view(new[pc])]
+    if bad:
+        raise SystemExit(f'encoders disagree at {bad}')
+
+    def strings(program):
+        return [int(string_encode(ins, pc), 16) for pc, ins in enumerate(program)]
+
+    def fields(program):
+        image = isa.new_image(len(program))
+        for pc, ins in enumerate(program):
+            image[pc] = map.encode(ins, pc)
+        return image
+
+    before = rate(strings, program, args.repeat)
+    after = rate(fields, program, args.repeat)
+    print(f'{len(program)} words x {args.repeat}')
+    print(f'string encoder  : {before:12,.0f} instr/s')
+    print(f'field encoder   : {after:12,.0f} instr/s  ({after / before:.1f}x)')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import time
+
+import isa
+import link
+import sim
+import sim_mt
+import translate
+
+# cycles per second of translate.Engine against an interpreter that decodes
+# the fetched word on every cycle, on the four-thread sort kernels
+#
+#   python bench_sim.py write_Data_I_Mem_Mt.py --repeat 20
+
+decode = isa.decode.__wrapped__     # no decode cache, as a plain interpreter
+
+
+def interpret(imem, dmem, max_cycles=sim.MAX_CYCLES):
+    # one word per cycle, thread_id rotating, decoded when it is fetched
+    regs = [[0] * 16 for _ in range(sim_mt.THREADS)]
+    pcs = [k * sim_mt.PARTITION for k in range(sim_mt.THREADS)]
+    live = [True] * sim_mt.THREADS
+    last = {}
+    done = [0] * sim_mt.THREADS
+    t = 0
+    while any(live) and t < max_cycles:
+        k = t % sim_mt.THREADS
+        t += 1
+        if not live[k]:
+            continue
+        pc = pcs[k]
+        R = regs[k]
+        dec = decode(imem[pc])
+        a = R[dec.reg1]
+        r2 = R[dec.reg2]
+        b = dec.imm64 if dec.use_imm else r2
+        value = sim.ALU[dec.alu_ctrl](a, b)
+        nxt = (pc & sim_mt.BASE) | ((pc + 1) & sim_mt.LOCAL)
+        target = None
+        if dec.is_load:
+            value = dmem[value & 0xFF]
+        elif dec.mem_wen:
+            dmem[value & 0xFF] = r2
+        if dec.is_bl:
+            value = (pc + 1) & isa.PC_MASK
+        if dec.reg_wen and dec.wreg:
+            R[dec.wreg] = value
+        if dec.kind in (isa.K_ALU, isa.K_LOAD, isa.K_STORE):
+            done[k] += 1
+        if dec.is_jump:
+            target = r2
+        elif dec.is_cond_branch:
+            if (a != r2) == dec.branch_cond:
+                target = isa.branch_target(dec, pc)
+        elif dec.is_branch:
+            target = isa.branch_target(dec, pc)
+        if target is not None:
+            nxt = (pc & sim_mt.BASE) | (target & sim_mt.LOCAL)
+        if target is not None or nxt < pc:
+            # a taken branch or the wrap of pc[6:0]
+            if last.get(pc) == done[k]:
+                live[k] = False
+            last[pc] = done[k]
+        pcs[k] = nxt
+    return dmem, regs, t
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the block translating simulator')
+    parser.add_argument('image', nargs='?', default='write_Data_I_Mem_Mt.py')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    imem, dmem = link.read_image(args.image)
+    image = isa.new_image()
+    for pc, word in imem:
+        image[pc] = word
+    start = [dmem.get(addr, 0) for addr in range(sim.DMEM_WORDS)]
+
+    def naive():
+        return interpret(image, list(start))
+
+    def barrel():
+        cpu = sim_mt.Barrel(imem, dmem)
+        cpu.run()
+        return [int(v) for v in cpu.dmem]
+
+    def engine():
+        cpu = translate.Engine(imem, dmem, target='mt')
+        cpu.run()
+        return cpu
+
+    translate._programs.clear()
+    cold, cpu = timed(engine, 1)
+    warm, cpu = timed(engine, args.repeat)
+    base, (ref, regs, cycles) = timed(naive, max(1, args.repeat // 4))
+    vector, mem = timed(barrel, max(1, args.repeat // 4))
+    if cpu.dmem != ref or mem != ref or cpu.regs != regs:
+        raise SystemExit('final state differs between the simulators')
+
+    print(f'{args.image}: {cycles} cycles, {sum(1 for blk in cpu.program().blocks if blk)} blocks')
+    print(f'decode per cycle : {cycles / base:12,.0f} cycles/s')
+    print(f'sim_mt.Barrel    : {cycles / vector:12,.0f} cycles/s  ({base / vector:.1f}x)')
+    print(f'Engine, cold     : {cycles / cold:12,.0f} cycles/s  ({base / cold:.1f}x)')
+    print(f'Engine, cached   : {cycles / warm:12,.0f} cycles/s  ({base / warm:.1f}x)')
+
+
+if __name__ == "__main__":
+    main()
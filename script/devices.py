@@ -0,0 +1,132 @@
+# the FIFO and GPU instructions of cpu_arm_mt (readme, sim/tb_fifo_instrs.v)
+# and models of what sits on their ports, for sim.Pipeline(fifo=.., gpu=..)
+#
+#   RDF Rd,#sel    {8'b10101111, Rd, 19'b0, sel}   Rd = sel ? fifo_end_offset : fifo_start_offset
+#   FIFOWAIT       {8'b10101100, 24'b0}            stall until fifo_data_ready
+#   FIFODONE       {8'b10101011, 24'b0}            fifo_data_done for one cycle
+#   GPU_RUN        {8'b10101101, 24'b0}            start the GPU, stall until gpu_done
+#   WRP Rs,#imm3   {8'b10101110, Rs, 17'b0, imm3}  GPU parameter register imm3 = Rs
+#
+# the RTL behind GPU_RUN and WRP is not in this tree: their encodings are an
+# assumption, the two free top bytes next to the FIFO ones with the operands
+# where RDF has them.  CTRL_UNIT.v decodes all five as NOPs.
+#
+# a stall holds every pipeline register (advance = 0), so a stall only adds
+# cycles: sim.py keeps its pipeline timing and counts fifo_stall / gpu_stall
+# apart from the cycles the pipeline advanced
+#
+# fifo script, one packet per line, numbers in any base python reads:
+#
+#   # arrival  start  words..
+#   0          4      5 7 9
+#   400        4      1 2 3 4
+
+RDF = 0xAF
+FIFOWAIT = 0xAC
+FIFODONE = 0xAB
+GPU_RUN = 0xAD      # assumed
+WRP = 0xAE          # assumed
+
+NAMES = {RDF: 'RDF', FIFOWAIT: 'FIFOWAIT', FIFODONE: 'FIFODONE', GPU_RUN: 'GPU_RUN', WRP: 'WRP'}
+GPU_PARAMS = 8      # imm3
+
+
+def decode_io(word):
+    # -> (op, reg, arg) for the five words above, None for anything else
+    op = word >> 24
+    if op not in NAMES:
+        return None
+    reg = (word >> 20) & 0xF
+    if op == RDF:
+        return op, reg, word & 1
+    if op == WRP:
+        return op, reg, word & 0b111
+    return op, 0, 0
+
+
+def encode_io(op, reg=0, arg=0):
+    # encode_io(RDF, 3, 1) -> rdf r3, #1
+    if op not in NAMES:
+        raise ValueError(f"{op:#x} is not a FIFO/GPU instruction")
+    return op << 24 | (reg & 0xF) << 20 | (arg & 0b111)
+
+
+class Fifo:
+    # scripted producer: packets of (arrival cycle, start, words).  a packet is
+    # handed to the core at max(arrival, previous FIFODONE + gap): its words
+    # land in DMEM from start on, fifo_start_offset / fifo_end_offset frame
+    # them (end exclusive, where fifo.v stops) and fifo_data_ready rises
+    def __init__(self, packets=(), gap=0):
+        self.packets = [(arrival, start, list(words)) for arrival, start, words in packets]
+        self.gap = gap
+        self.reset()
+
+    def reset(self):
+        self.next = 0           # packet handed over by the next FIFOWAIT
+        self.ready = False
+        self.released = 0       # cycle of the last FIFODONE
+        self.start = self.end = 0
+        self.waits = []         # (packet, cycles FIFOWAIT stalled)
+
+    def wait(self, cycle, dmem):
+        # FIFOWAIT in EX at cycle: the cycle fifo_data_ready is 1, None when
+        # the script has run out and it never will be
+        if self.ready:
+            return cycle
+        if self.next >= len(self.packets):
+            return None
+        arrival, start, words = self.packets[self.next]
+        ready = max(cycle, arrival, self.released + self.gap)
+        for i, value in enumerate(words):
+            dmem[(start + i) & 0xFF] = value & 0xFFFFFFFFFFFFFFFF
+        self.start = start & 0xFF
+        self.end = (start + len(words)) & 0xFF
+        self.ready = True
+        self.waits.append((self.next, ready - cycle))
+        self.next += 1
+        return ready
+
+    def read(self, sel):
+        return self.end if sel else self.start
+
+    def done(self, cycle):
+        self.ready = False
+        self.released = cycle
+
+
+class Gpu:
+    # latency: cycles from GPU_RUN to gpu_done, or a function of the parameter
+    # registers giving them; kernel(params, dmem), if given, is what a run
+    # does to the DMEM it shares with the core
+    def __init__(self, latency=100, kernel=None):
+        self.latency = latency
+        self.kernel = kernel
+        self.reset()
+
+    def reset(self):
+        self.params = [0] * GPU_PARAMS
+        self.runs = []          # (start cycle, cycles to gpu_done)
+
+    def param(self, index, value):
+        self.params[index % GPU_PARAMS] = value
+
+    def run(self, cycle, dmem):
+        # GPU_RUN in EX at cycle: the cycle gpu_done is 1
+        latency = self.latency(self.params) if callable(self.latency) else self.latency
+        if self.kernel is not None:
+            self.kernel(list(self.params), dmem)
+        self.runs.append((cycle, latency))
+        return cycle + latency
+
+
+def read_fifo_script(path):
+    # the packets of a fifo script, see the top of this file
+    packets = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].split()
+            if not line:
+                continue
+            arrival, start, *words = (int(v, 0) for v in line)
+            packets.append((arrival, start, words))
+    return packets
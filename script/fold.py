@@ -0,0 +1,199 @@
+# block-copy elimination for map.py (Assembler(FOLD=True), map.py --fold):
+# the copy GCC -O0 emits to initialise a stack array from a .LC constant pool
+#
+#   ldr   r3, .L8               @ .L8: .word .LC0
+#   sub   ip, fp, #56
+#   mov   lr, r3
+#   ldmia lr!, {r0, r1, r2, r3}
+#   stmia ip!, {r0, r1, r2, r3}
+#   ..
+#
+# is done at assembly time.  after the reset prologue every register is 0, so
+# the straight-line words from the entry up to the first label or branch are
+# run here on known values: a store there whose address is known and whose
+# value a load took from DMEM becomes a dmem_write of that value at its final
+# address, loaded with the image, and is dropped.  words of that entry code
+# whose results are then dead (the loads, the pointer setup) are dropped too,
+# by register liveness over the whole program.
+#
+# works on map.py's lowered Instr words, before layout.  immediates from 128
+# up are not folded, CTRL_UNIT.v and pipeline_arm.v extend imm8 differently
+
+MASK64 = (1 << 64) - 1
+IMM_SAFE = 128
+ALL_REGS = frozenset(range(1, 16))     # r0 is always 0
+
+
+def dmem_key(addr):
+    return addr & 0xFF
+
+
+def entry_end(program, leaders):
+    # index of the first branch or branch target
+    end = 0
+    while end < len(program) and end not in leaders and program[end].op not in ('b', 'beq', 'bne', 'bx'):
+        end += 1
+    return end
+
+
+def run_entry(program, end, data, label_map, literal_map):
+    # -> [(index, addr, value)] of the foldable stores in the entry code
+    regs = {r: 0 for r in ALL_REGS}
+    loaded = set()          # registers holding a value loaded from DMEM
+    mem = {dmem_key(addr): value for addr, value in data}
+    read = set()            # DMEM words loaded so far
+    written = set()         # and stored
+    stores = []
+    for i in range(end):
+        ins = program[i]
+        if ins.op == 'dp':
+            value = evaluate(ins, regs)
+            regs[ins.rd] = value
+            loaded.discard(ins.rd)
+        elif ins.op == 'ldr':
+            if ins.label is not None:
+                if ins.label in literal_map:
+                    regs[ins.rd] = label_map.get(literal_map[ins.label])
+                    loaded.discard(ins.rd)
+                    continue
+                addr = label_map.get(ins.label)
+            else:
+                addr = address(ins, regs)
+            if addr is None:
+                # loads from anywhere from here on
+                return stores
+            read.add(dmem_key(addr))
+            regs[ins.rd] = mem.get(dmem_key(addr), 0)
+            loaded.add(ins.rd)
+        elif ins.op == 'str':
+            addr = address(ins, regs) if ins.label is None else label_map.get(ins.label)
+            if addr is None:
+                return stores
+            value = regs.get(ins.rd, 0) if ins.rd else 0
+            key = dmem_key(addr)
+            if ins.rd in loaded and value is not None and key not in read and key not in written:
+                stores.append((i, addr, value))
+            else:
+                written.add(key)
+            mem[key] = value
+        if 0 in regs:
+            del regs[0]
+    return stores
+
+
+def evaluate(ins, regs):
+    # value of a MOV / ADD / SUB, None for anything else or unknown operands
+    if ins.imm is not None:
+        if not 0 <= ins.imm < IMM_SAFE:
+            return None
+        b = ins.imm
+    else:
+        b = regs.get(ins.rm, 0) if ins.rm else 0
+    if ins.cmd == 'MOV':
+        return b
+    a = regs.get(ins.rn, 0) if ins.rn else 0
+    if a is None or b is None:
+        return None
+    if ins.cmd == 'ADD':
+        return (a + b) & MASK64
+    if ins.cmd == 'SUB':
+        return (a - b) & MASK64
+    return None
+
+
+def address(ins, regs):
+    base = regs.get(ins.rn, 0) if ins.rn else 0
+    if base is None or ins.imm is None:
+        return None
+    return (base - ins.imm if ins.sub else base + ins.imm) & MASK64
+
+
+def use_def(ins):
+    # registers an Instr reads and writes
+    if ins.op == 'dp':
+        use = set()
+        if ins.cmd != 'MOV' and ins.rn:
+            use.add(ins.rn)
+        if ins.imm is None and ins.rm:
+            use.add(ins.rm)
+        return use, {ins.rd}
+    if ins.op == 'ldr':
+        return ({ins.rn} if ins.rn else set()), {ins.rd}
+    if ins.op == 'str':
+        return {ins.rd, ins.rn} - {0}, set()
+    if ins.op in ('beq', 'bne'):
+        return {ins.rn, ins.rm} - {0}, set()
+    if ins.op == 'bx':
+        return set(ALL_REGS), set()
+    return set(), set()
+
+
+def liveness(program, code_labels, gone):
+    # live_out per Instr index, skipping the ones in gone
+    n = len(program)
+    keep = [i for i in range(n) if i not in gone]
+    after = {}                  # index -> next kept index
+    for k, i in enumerate(keep):
+        after[i] = keep[k + 1] if k + 1 < len(keep) else None
+
+    def first_kept(i):
+        while i < n and i in gone:
+            i += 1
+        return i if i < n else None
+
+    succ = {}
+    for i in keep:
+        ins = program[i]
+        target = first_kept(code_labels[ins.label]) if ins.op in ('b', 'beq', 'bne') and ins.label in code_labels else None
+        nxt = after[i]
+        if ins.op == 'b':
+            succ[i] = [target] if target is not None else []
+        elif ins.op == 'bx':
+            succ[i] = []
+        else:
+            succ[i] = [s for s in (nxt, target) if s is not None]
+    live_in = {i: set() for i in keep}
+    live_out = {i: set() for i in keep}
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(keep):
+            out = set().union(*(live_in[s] for s in succ[i])) if succ[i] else set(ALL_REGS)
+            use, define = use_def(program[i])
+            inn = use | (out - define)
+            if out != live_out[i] or inn != live_in[i]:
+                live_out[i], live_in[i] = out, inn
+                changed = True
+    return live_out
+
+
+def fold_copies(program, start, code_labels, data, label_map, literal_map):
+    # -> (indexes of program to drop, [(addr, value)] to write at load time);
+    # start: first word after the reset prologue
+    leaders = {code_labels[ins.label] for ins in program
+               if ins.op in ('b', 'beq', 'bne') and ins.label in code_labels}
+    end = entry_end(program, leaders)
+    stores = run_entry(program, end, data, label_map, literal_map)
+    old = {dmem_key(addr): value for addr, value in data}
+    placed = {}
+    gone = set()
+    for i, addr, value in stores:
+        if old.get(dmem_key(addr), value) != value:
+            continue
+        placed[dmem_key(addr)] = value
+        gone.add(i)
+    if not gone:
+        return gone, []
+
+    # then whatever in the entry code only fed those stores
+    changed = True
+    while changed:
+        changed = False
+        live_out = liveness(program, code_labels, gone)
+        for i in range(start, end):
+            if i in gone or program[i].op not in ('dp', 'ldr'):
+                continue
+            if not use_def(program[i])[1] & live_out[i]:
+                gone.add(i)
+                changed = True
+    return gone, sorted(placed.items())
@@ -0,0 +1,193 @@
+import isa
+import schedule
+
+# pipeline timing, see src/pipline/pipeline_arm.v and pipiline_arm_mt.v
+#
+# a word is in ID two cycles after its pc goes to the IMEM (BRAM + pc_delay),
+# WB writes the register file at the end of the 4th cycle after ID and the IFRF
+# bypass in REG_FILE hands the value to an ID read in that same cycle:
+#
+#   producer  ID  EX  MEM  MEM/WB  WB
+#   consumer                       ID      -> 4 cycles apart, loads included
+#
+# branches resolve in EX, by then three more words have been fetched behind
+# them: the one in ID is flushed from ID/EX, the other two still execute
+WB_DISTANCE = 4
+BRANCH_SHADOW = 3
+
+# cycles between two consecutive words of the same program
+TARGETS = {
+    'st': 1,    # pipeline_arm.v, one thread
+    'mt': 4,    # pipiline_arm_mt.v, thread_id rotates every cycle
+}
+
+# mt: every thread owns 128 IMEM words (pc_target keeps pc[8:7] = thread_id).
+# pc_target.v as instantiated wraps pc[6:0], the planned stop guard holds a pc
+# with pc[6:1] == 111111; a thread program ends before word 126 of its
+# partition so it runs the same with or without the guard
+THREADS = 4
+PARTITION = 128
+PARTITION_USABLE = 126
+
+
+def raw_gap(issue):
+    # words a consumer has to sit behind its producer
+    return -(-WB_DISTANCE // issue)
+
+
+def shadow_slots(issue):
+    # words of the same program fetched before a taken branch redirects it
+    return BRANCH_SHADOW // issue
+
+
+def nops_needed(reads, window, issue):
+    # window: writes of the last emitted words, most recent last
+    gap = raw_gap(issue)
+    need = 0
+    for dist, writes in enumerate(reversed(window), 1):
+        if dist >= gap:
+            break
+        if any(r in writes for r in reads):
+            need = max(need, gap - dist)
+    return need
+
+
+def strip(words):
+    # drop padding NOPs, old pc -> index of the next real word
+    kept = []
+    index = {}
+    for pc, word in words:
+        index[pc] = len(kept)
+        if word != isa.NOP:
+            kept.append((pc, word))
+    return kept, index
+
+
+def pad(words, target='st', pc_start=None, leaders=None, origin=None):
+    # words: [(pc, word)] of one program in pc order, as written by imem_write
+    # returns [(pc, word)] with only the NOPs the target pipeline needs and
+    # every direct branch moved to the new address of its target
+    # leaders: label pcs, when given every basic block is list scheduled first
+    # origin: dict, filled with new pc -> old pc of every word that is not padding
+    issue = TARGETS[target]
+    gap = raw_gap(issue)
+    slots = shadow_slots(issue)
+    if not words:
+        return []
+    if pc_start is None:
+        pc_start = words[0][0]
+
+    kept, index = strip(words)
+    if leaders is None:
+        blocks = [kept]
+    else:
+        heads = set()
+        for pc in leaders:
+            i = index.get(pc, len(kept))
+            if i < len(kept):
+                heads.add(kept[i][0])
+        for pc, word in kept:
+            t = isa.branch_target(isa.decode(word), pc)
+            if index.get(t, len(kept)) < len(kept):
+                heads.add(kept[index[t]][0])
+        blocks = schedule.split(kept, heads)
+
+    out = []        # (word, pc it came from, None for padding)
+    window = []
+    new_pc = {}
+    for block in blocks:
+        head = block[0][0]
+        if leaders is not None and gap > 1:
+            block = schedule.order(block, window, gap)
+        for pc, word in block:
+            dec = isa.decode(word)
+            for i in range(nops_needed(dec.reads, window, issue)):
+                out.append((isa.NOP, None))
+                window.append(())
+            new_pc[pc] = pc_start + len(out)
+            out.append((word, pc))
+            window.append(dec.writes)
+            if dec.is_branch or dec.is_jump:
+                for i in range(slots):
+                    out.append((isa.NOP, None))
+                    window.append(())
+            del window[:-gap]
+        # a branch to the block lands on whatever got scheduled first
+        new_pc[head] = new_pc[block[0][0]]
+
+    # stripped NOPs follow the word that replaced them
+    end = pc_start + len(out)
+    remap = {}
+    for pc, i in index.items():
+        remap[pc] = new_pc[kept[i][0]] if i < len(kept) else end
+
+    result = []
+    for i, (word, old_pc) in enumerate(out):
+        pc = pc_start + i
+        if old_pc is not None:
+            if origin is not None:
+                origin[pc] = old_pc
+            dec = isa.decode(word)
+            old_target = isa.branch_target(dec, old_pc)
+            if old_target is not None:
+                if old_target not in remap:
+                    raise ValueError(f"branch at {old_pc} leaves the program ({old_target})")
+                word = isa.retarget(word, pc, remap[old_target])
+        result.append((pc, word))
+    return result
+
+
+def check(words, target='st'):
+    # [(pc, needed, word)] for every word that reads a register too early
+    issue = TARGETS[target]
+    gap = raw_gap(issue)
+    bad = []
+    window = []
+    shadow = 0
+    for pc, word in words:
+        dec = isa.decode(word)
+        need = nops_needed(dec.reads, window, issue)
+        if need:
+            bad.append((pc, need, word))
+        if shadow and word != isa.NOP:
+            bad.append((pc, shadow, word))
+        shadow = max(shadow - 1, 0)
+        window.append(dec.writes)
+        if dec.is_branch or dec.is_jump:
+            shadow = shadow_slots(issue)
+        del window[:-gap]
+    return bad
+
+
+def parse_output(output):
+    # map.py output lines -> data lines, [(pc, word)]
+    data = []
+    words = []
+    for entry in output:
+        line = entry[0] if isinstance(entry, list) else entry
+        parts = line.split()
+        if parts and parts[0] == 'imem_write':
+            words.append((int(parts[1]), int(parts[2], 16)))
+        else:
+            data.append(line)
+    return data, words
+
+
+def check_partition(words):
+    # mt: the program has to stay clear of the stop guard of its partition
+    if len(words) > PARTITION_USABLE:
+        raise ValueError(f"{len(words)} words do not fit a thread partition "
+                         f"({PARTITION_USABLE} usable of {PARTITION})")
+
+
+def pad_image(words, target='st', leaders=None, origin=None):
+    padded = pad(words, target, leaders=leaders, origin=origin)
+    if target == 'mt':
+        check_partition(padded)
+    return padded
+
+
+def pad_output(output, target='st', leaders=None):
+    data, words = parse_output(output)
+    padded = pad_image(words, target, leaders)
+    return [[line] for line in data] + [[f'imem_write {pc} {word:#010x}'] for pc, word in padded]
@@ -0,0 +1,249 @@
+from array import array
+from collections import namedtuple
+from functools import lru_cache
+
+# instruction fields as decoded by src/pipline/CTRL_UNIT.v
+#
+#   data processing : [31:28] cond | [27:26] 00 | I | opcode | S | Rn | Rd | operand2
+#   load / store    : [31:28] cond | [27:26] 01 | I P U B W L | Rn | Rd | imm12
+#   B / BL          : [31:28] cond | [27:25] 101 | L | off24
+#   BEQ / BNE       : [31:28] 1110 | [27:24] 1000/1001 | Rn | Rm | off16
+#   J               : [31:26] 111011 | target26
+#   BX / JR         : [27:4] 12FFF1 | Rm
+
+
+NOP = 0xE0000000
+HALT = 0xEAFFFFFE   # b .   (branch to itself)
+
+PC_MASK = 0x1FF     # 9 bit word address, 512 x 32 IMEM
+REG_LINK = 14       # BL writes the return address here
+
+ALU_NOP     = 0b0000
+ALU_ADD     = 0b0001
+ALU_SUB     = 0b0010
+ALU_AND     = 0b0011
+ALU_OR      = 0b0100
+ALU_XNOR    = 0b0101
+ALU_SHIFTL  = 0b0110
+ALU_SHIFTR  = 0b0111
+ALU_SHIFTLV = 0b1000
+ALU_SHIFTRV = 0b1001
+ALU_SLT     = 0b1010
+
+# data processing opcode [24:21]
+OPCODES = {
+    'AND': 0b0000, 'EOR': 0b0001, 'SUB': 0b0010, 'RSB': 0b0011,
+    'ADD': 0b0100, 'ADC': 0b0101, 'LSL': 0b0110, 'LSR': 0b0111,
+    'TST': 0b1000, 'TEQ': 0b1001, 'CMP': 0b1010, 'SLT': 0b1011,
+    'ORR': 0b1100, 'MOV': 0b1101, 'MVN': 0b1111,
+}
+
+# data processing opcode [24:21] -> (alu ctrl, reg write)
+DP_OPCODES = {
+    0b0100: (ALU_ADD, True),    # ADD
+    0b0010: (ALU_SUB, True),    # SUB
+    0b0000: (ALU_AND, True),    # AND
+    0b1100: (ALU_OR, True),     # ORR
+    0b0001: (ALU_XNOR, True),   # EOR
+    0b1101: (ALU_ADD, True),    # MOV  (Rn + operand2, Rn is r0)
+    0b1111: (ALU_XNOR, True),   # MVN
+    0b1010: (ALU_SUB, False),   # CMP
+    0b1000: (ALU_AND, False),   # TST
+    0b1001: (ALU_XNOR, False),  # TEQ
+    0b0110: (ALU_SHIFTLV, True),  # SLL  (I=1: shift by 1)
+    0b0111: (ALU_SHIFTRV, True),  # SRL  (I=1: shift by 1)
+    0b1011: (ALU_SLT, True),    # SLT
+    0b0101: (ALU_ADD, True),    # ADC -> ADD
+    0b0011: (ALU_SUB, True),    # RSB -> SUB
+}
+
+# kind of a decoded word
+K_NOP = 'nop'       # no architectural effect
+K_ALU = 'alu'
+K_LOAD = 'load'
+K_STORE = 'store'
+K_BRANCH = 'branch'     # B / BL, pc relative
+K_COND = 'cond'         # BEQ / BNE, pc relative
+K_JUMP = 'jump'         # J, absolute
+K_JR = 'jr'             # BX / JR, register
+
+Dec = namedtuple('Dec', [
+    'kind',
+    'alu_ctrl', 'use_imm', 'imm64',
+    'reg_wen', 'mem_wen', 'is_load',
+    'is_branch', 'is_jump', 'is_cond_branch', 'branch_cond', 'is_bl',
+    'reg1', 'reg2', 'wreg',
+    'off', 'target',    # off: pc relative 9 bit offset, target: J absolute
+    'reads', 'writes',  # registers actually used / written, r0 dropped
+])
+
+
+def _sext(value, bits):
+    value &= (1 << bits) - 1
+    if value >> (bits - 1):
+        value -= 1 << bits
+    return value & 0xFFFFFFFFFFFFFFFF
+
+
+@lru_cache(maxsize=4096)
+def decode(word, signed_imm=False):
+    # zero-extends imm8 / imm12 like the inline decoder in pipeline_arm.v (the
+    # board); signed_imm follows CTRL_UNIT.v ({56{imm8[7]}, imm8}) instead, both
+    # agree for imm8 < 128, imm12 < 2048
+    op = (word >> 26) & 0b11
+    I = (word >> 25) & 1
+    opcode = (word >> 21) & 0xF
+    L = (word >> 20) & 1
+    rn = (word >> 16) & 0xF
+    rd = (word >> 12) & 0xF
+    rm = word & 0xF
+
+    alu_ctrl = ALU_NOP
+    use_imm = False
+    imm64 = 0
+    reg_wen = mem_wen = is_load = False
+    is_branch = is_jump = is_cond = branch_cond = is_bl = False
+    off = target = None
+    kind = K_NOP
+
+    beq_type = (word >> 24) & 0xF
+    if (word >> 28) == 0xE and beq_type in (0b1000, 0b1001):
+        reg1 = (word >> 20) & 0xF
+        reg2 = (word >> 16) & 0xF
+        alu_ctrl = ALU_SUB
+        is_branch = is_cond = True
+        branch_cond = beq_type == 0b1001
+        off = word & PC_MASK
+        kind = K_COND
+        reads = (reg1, reg2)
+    elif (word >> 26) == 0b111011:
+        reg1, reg2 = rn, rm
+        is_branch = True
+        target = word & PC_MASK
+        kind = K_JUMP
+        reads = ()
+    else:
+        reg1 = rn
+        reg2 = rd if (op == 0b01 and not L) else rm
+        reads = ()
+        if op == 0b00:
+            if (word >> 4) & 0xFFFFFF == 0x12FFF1:
+                is_jump = True
+                kind = K_JR
+                reads = (reg2,)
+            else:
+                if I:
+                    use_imm = True
+                    imm64 = _sext(word & 0xFF, 8) if signed_imm else word & 0xFF
+                alu_ctrl, reg_wen = DP_OPCODES.get(opcode, (ALU_NOP, False))
+                if opcode == 0b0110 and I:
+                    alu_ctrl = ALU_SHIFTL
+                elif opcode == 0b0111 and I:
+                    alu_ctrl = ALU_SHIFTR
+                if alu_ctrl != ALU_NOP:
+                    kind = K_ALU
+                    reads = (reg1,) if use_imm else (reg1, reg2)
+        elif op == 0b01:
+            alu_ctrl = ALU_ADD if (word >> 23) & 1 else ALU_SUB
+            use_imm = True
+            imm64 = _sext(word & 0xFFF, 12) if signed_imm else word & 0xFFF
+            if L:
+                is_load = reg_wen = True
+                kind = K_LOAD
+                reads = (reg1,)
+            else:
+                mem_wen = True
+                kind = K_STORE
+                reads = (reg1, reg2)
+        elif op == 0b10 and (word >> 25) & 0b111 == 0b101:
+            is_branch = True
+            off = word & PC_MASK
+            kind = K_BRANCH
+            if (word >> 24) & 1:
+                is_bl = reg_wen = True
+
+    wreg = REG_LINK if is_bl else rd
+    reads = tuple(r for r in reads if r != 0)
+    writes = (wreg,) if reg_wen and wreg != 0 else ()
+    if kind == K_ALU and not writes:
+        # CMP/TST/TEQ have nowhere to put the result
+        kind = K_NOP
+        reads = ()
+
+    return Dec(kind, alu_ctrl, use_imm, imm64, reg_wen, mem_wen, is_load,
+               is_branch, is_jump, is_cond, branch_cond, is_bl,
+               reg1, reg2, wreg, off, target, reads, writes)
+
+
+def branch_target(dec, pc):
+    # word address a B/BL/BEQ/BNE/J at pc lands on, None for BX
+    if dec.target is not None:
+        return dec.target
+    if dec.off is not None:
+        return (pc + 2 + dec.off) & PC_MASK
+    return None
+
+
+def retarget(word, pc, target):
+    # rewrite the offset field of the branch at pc so it lands on target
+    dec = decode(word)
+    if dec.kind == K_JUMP:
+        return (word & ~PC_MASK) | (target & PC_MASK)
+    off = target - pc - 2
+    if dec.kind == K_COND:
+        return (word & ~0xFFFF) | (off & 0xFFFF)
+    if dec.kind == K_BRANCH:
+        return (word & ~0xFFFFFF) | (off & 0xFFFFFF)
+    raise ValueError(f"word {word:#010x} at {pc} is not a direct branch")
+
+
+# encoder, the same fields CTRL_UNIT.v slices: name -> (lsb, width)
+FIELDS = {
+    'opcode': (21, 4), 'rn': (16, 4), 'rd': (12, 4), 'rm': (0, 4), 'imm8': (0, 8),
+    'U': (23, 1), 'W': (21, 1), 'L': (20, 1), 'imm12': (0, 12),
+    'link': (24, 1), 'off24': (0, 24),
+    'beq_type': (24, 4), 'beq_rn': (20, 4), 'beq_rm': (16, 4), 'off16': (0, 16),
+    'target26': (0, 26),
+}
+SIGNED_FIELDS = ('off24', 'off16')     # pc relative, two's complement
+
+COND_AL = 0xE << 28
+
+# format -> (constant bits, fields in argument order)
+FORMATS = {
+    'dp_reg': (COND_AL | 0b00 << 26, ('opcode', 'rn', 'rd', 'rm')),            # I=0 S=0
+    'dp_imm': (COND_AL | 0b00 << 26 | 1 << 25, ('opcode', 'rn', 'rd', 'imm8')), # I=1 S=0 rot=0
+    'mem': (COND_AL | 0b01 << 26 | 1 << 25 | 1 << 24, ('U', 'W', 'L', 'rn', 'rd', 'imm12')),  # I=1 P=1 B=0
+    'b': (COND_AL | 0b101 << 25, ('link', 'off24')),
+    'beq': (COND_AL, ('beq_type', 'beq_rn', 'beq_rm', 'off16')),
+    'j': (0b111011 << 26, ('target26',)),
+    'bx': (COND_AL | 0x12FFF1 << 4, ('rm',)),
+}
+
+BEQ = 0b1000
+BNE = 0b1001
+
+_FORMATS = {
+    name: (base, tuple((FIELDS[f][0], (1 << FIELDS[f][1]) - 1, f in SIGNED_FIELDS, f) for f in fields))
+    for name, (base, fields) in FORMATS.items()
+}
+
+
+def encode(fmt, *values):
+    # encode('dp_imm', OPCODES['MOV'], 0, 3, 12) -> mov r3, #12
+    word, fields = _FORMATS[fmt]
+    if len(values) != len(fields):
+        raise ValueError(f"{fmt} takes {len(fields)} fields, got {len(values)}")
+    for (shift, mask, signed, name), value in zip(fields, values):
+        if not signed and not 0 <= value <= mask:
+            raise ValueError(f"{fmt}: {name} = {value} does not fit in {mask.bit_length()} bits")
+        word |= (value & mask) << shift
+    return word
+
+
+def new_image(words=PC_MASK + 1):
+    # IMEM image, one unsigned 32 bit entry per word, NOP filled
+    image = array('I', [NOP]) * words
+    if image.itemsize != 4:
+        raise RuntimeError("array('I') is not 32 bit on this platform")
+    return image
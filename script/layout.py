@@ -0,0 +1,253 @@
+# DMEM layout for map.py: compact word addressing and the memory map
+#
+# GCC addresses bytes, D_M_64bit_256 is 256 words of 64 bits and every load /
+# store uses Rn +- imm12 as the word index.  map.py lays .word data out 4
+# apart and keeps GCC's byte offsets, so three of four words go unused and a
+# frame of 16 words takes 64.  with Assembler(COMPACT=True) (map.py --compact)
+# .word data is packed one per word and compact() divides what is a byte
+# quantity by 4 in the lowered Instr words:
+#
+#   ldr/str [rn, #imm]              imm / 4, every one
+#   add/sub rd, rn, #imm            imm / 4 when rn is sp, fp or a pointer
+#                                   made from them in the same block
+#   lsl rd, rn, #2 (mov r8, #2)     lsl #0 when the result is added to a pointer
+#   add/sub/mov on that index       imm / 4
+#
+# pointers are followed forwards through each block from sp / fp / literal
+# addresses (ldr r3, .L8) and backwards from every load / store base, the
+# way -O0 code builds them.  an offset that is not a multiple of 4 is kept as
+# it is (a word index written by hand, str r3, [r6, #1]) and listed.  such a
+# load / store has to name its word outright (r0 or a mov #k base in the same
+# block).  in either mode fixed_words() finds every load / store that names
+# its word this way (mov r6, #0 / str r3, [r6, #4] too) and the data and the
+# constant pool are kept clear of those words, so neither puts a .word where
+# a hand-written access lands
+#
+# memory_map() says where data, words placed by fold.py, the materialize.py
+# constant pool and the stack (down from 0, so at the top of DMEM) sit and
+# fails when data and stack overlap
+
+DMEM_WORDS = 256
+SP, FP = 12, 13                 # map.REGS_MAP sp / fp
+POINTER_REGS = (SP, FP)
+
+
+def def_before(program, first, i, reg):
+    # index of the last word in [first, i) writing reg, None if there is none
+    for j in range(i - 1, first - 1, -1):
+        ins = program[j]
+        if ins.op in ('dp', 'ldr') and ins.rd == reg:
+            return j
+    return None
+
+
+def compact(program, start, code_labels, literal_map):
+    # scale byte offsets in program[start:] to word offsets in place, returns
+    # the indexes of words left as they were
+    leaders = set(code_labels.values())
+    scaled = set()
+    raw = []
+
+    def scale(j, by=4):
+        if j in scaled:
+            return
+        scaled.add(j)
+        ins = program[j]
+        if ins.imm % by:
+            raw.append(j)
+            return
+        ins.imm //= by
+
+    def offset_slice(reg, i, first):
+        # reg is added to a pointer at i: undo the byte scaling that made it
+        j = def_before(program, first, i, reg)
+        if j is None or j in scaled:
+            return
+        ins = program[j]
+        if ins.op != 'dp':
+            return
+        if ins.cmd == 'LSL' and ins.imm is None:
+            k = def_before(program, first, j, ins.rm)
+            if k is not None and program[k].cmd == 'MOV' and program[k].imm is not None and k not in scaled:
+                scaled.add(k)
+                if program[k].imm >= 2:
+                    program[k].imm -= 2
+                else:
+                    raw.append(k)
+            scaled.add(j)
+        elif ins.cmd in ('ADD', 'SUB') and ins.imm is not None:
+            scale(j)
+            offset_slice(ins.rn, j, first)
+        elif ins.cmd == 'MOV' and ins.imm is not None:
+            scale(j)
+
+    def pointer_slice(reg, i, first):
+        # reg is a load / store base at i: scale the arithmetic that made it
+        j = def_before(program, first, i, reg)
+        if j is None or j in scaled:
+            return
+        ins = program[j]
+        if ins.op != 'dp':
+            return      # a literal address or a pointer loaded from DMEM
+        if ins.cmd in ('ADD', 'SUB') and ins.imm is not None:
+            scale(j)
+            pointer_slice(ins.rn, j, first)
+        elif ins.cmd == 'ADD':
+            if ins.rn in POINTER_REGS:
+                offset_slice(ins.rm, j, first)
+            elif ins.rm in POINTER_REGS:
+                offset_slice(ins.rn, j, first)
+        elif ins.cmd == 'MOV':
+            if ins.imm is None:
+                pointer_slice(ins.rm, j, first)
+            else:
+                scale(j)
+
+    first = start
+    pointers = set(POINTER_REGS)
+    for i in range(start, len(program)):
+        if i in leaders or (i > start and program[i - 1].op in ('b', 'beq', 'bne', 'bx')):
+            first = i
+            pointers = set(POINTER_REGS)
+        ins = program[i]
+        if ins.op == 'dp':
+            is_pointer = False
+            if ins.cmd in ('ADD', 'SUB') and ins.imm is not None and ins.rn in pointers:
+                scale(i)
+                is_pointer = True
+            elif ins.cmd == 'ADD' and ins.imm is None and (ins.rn in pointers or ins.rm in pointers):
+                offset_slice(ins.rm if ins.rn in pointers else ins.rn, i, first)
+                is_pointer = True
+            elif ins.cmd == 'MOV' and ins.imm is None:
+                is_pointer = ins.rm in pointers
+            if is_pointer:
+                pointers.add(ins.rd)
+            elif ins.rd not in POINTER_REGS:
+                pointers.discard(ins.rd)
+        elif ins.op in ('ldr', 'str'):
+            if ins.label is not None:
+                if ins.op == 'ldr' and ins.label in literal_map:
+                    pointers.add(ins.rd)
+                continue
+            scale(i)
+            if ins.rn and ins.rn not in pointers:
+                pointer_slice(ins.rn, i, first)
+            if ins.op == 'ldr' and ins.rd not in POINTER_REGS:
+                pointers.discard(ins.rd)
+    return sorted(raw)
+
+
+def fixed_words(program, start, code_labels, raw=()):
+    # {DMEM index: line} of the loads / stores in program[start:] whose base is
+    # r0 or a mov #k in the same block, ValueError for one among the raw words
+    # whose base is not a known constant
+    leaders = set(code_labels.values())
+    raw = set(raw)
+    fixed = {}
+    for i in range(start, len(program)):
+        ins = program[i]
+        if ins.op not in ('ldr', 'str') or ins.label is not None:
+            continue
+        base = 0 if not ins.rn else None
+        if ins.rn:
+            first = i
+            while first > start and first not in leaders and program[first - 1].op not in ('b', 'beq', 'bne', 'bx'):
+                first -= 1
+            j = def_before(program, first, i, ins.rn)
+            if j is not None and program[j].op == 'dp' and program[j].cmd == 'MOV' and program[j].imm is not None:
+                base = program[j].imm
+        if base is None and i not in raw:
+            continue
+        if base is None:
+            raise ValueError(f"Line {ins.line + 1}: offset #{ins.imm} is not a multiple of 4 and its base is not "
+                             f"a known address, cannot tell which word it means with COMPACT")
+        fixed[(base - ins.imm if ins.sub else base + ins.imm) & 0xFF] = ins.line
+    return fixed
+
+
+def data_shift(fixed, start, end, depth, step=1):
+    # words to move the data [start, end), one every step, by so that no fixed
+    # word below the stack is one of them
+    below = [a for a in fixed if a < DMEM_WORDS - depth]
+    first = start
+    while True:
+        inside = [a for a in below if first <= a < first + end - start and (a - first) % step == 0]
+        if not inside:
+            return first - start
+        first = max(inside) + step
+
+
+def stack_depth(program, code_labels):
+    # words (byte units before compact) sp goes below 0 in the entry code
+    leaders = set(code_labels.values())
+    regs = {SP: 0, FP: 0}
+    low = 0
+    for i, ins in enumerate(program):
+        if (i in leaders and i) or ins.op in ('b', 'beq', 'bne', 'bx'):
+            break
+        if ins.op == 'dp' and ins.rd in regs and ins.cmd in ('ADD', 'SUB', 'MOV'):
+            if ins.cmd == 'MOV':
+                regs[ins.rd] = ins.imm if ins.imm is not None else regs.get(ins.rm, 0)
+            elif ins.imm is not None and ins.rn in regs:
+                step = ins.imm if ins.cmd == 'ADD' else -ins.imm
+                regs[ins.rd] = regs[ins.rn] + step
+            low = min(low, regs[SP])
+    return -low
+
+
+def runs(indexes, step):
+    # sorted DMEM indexes -> [(first, last)] of runs step apart
+    out = []
+    for index in sorted(indexes):
+        if out and index == out[-1][1] + step:
+            out[-1] = (out[-1][0], index)
+        else:
+            out.append((index, index))
+    return out
+
+
+def memory_map(data, label_map, placed, depth, step, pool=(), fixed=None):
+    # [(first, last, step, region)] over DMEM indexes, the stack last; data
+    # may hold the placed and pool words too.  fixed: {index: line} of
+    # fixed_words, each must have its word to itself
+    regions = []
+    used = {}
+    starts = sorted((addr & 0xFF, name) for name, addr in label_map.items())
+    ends = [s for s, name in starts[1:]] + [None]
+    at = {addr & 0xFF for addr, value in placed}
+    pooled = {addr & 0xFF for addr, value in pool}
+    data_at = sorted({addr & 0xFF for addr, value in data} - at - pooled)
+    for (first, name), end in zip(starts, ends):
+        words = [a for a in data_at if a >= first and (end is None or a < end)]
+        if words:
+            regions.append((words[0], words[-1], step, f'data {name}'))
+            used.update((a, f'data {name}') for a in words)
+    for first, last in runs(at, step):
+        # the stack words an .LC copy starts with, inside the frame
+        regions.append((first, last, step, 'placed (fold.py)'))
+    for first, last in runs(pooled, step):
+        regions.append((first, last, step, 'pool'))
+        used.update((a, 'pool') for a in range(first, last + 1, step))
+    for a, line in sorted((fixed or {}).items()):
+        if a in used:
+            raise ValueError(f"DMEM[{a}]: line {line + 1} writes to it by index, it holds {used[a]}")
+        regions.append((a, a, 1, f'fixed (line {line + 1})'))
+        used[a] = f'fixed (line {line + 1})'
+    if depth:
+        first = (-depth) & 0xFF
+        regions.append((first, DMEM_WORDS - step, step, f'stack ({depth // step} words)'))
+        for a in range(first, DMEM_WORDS, step):
+            if a in used:
+                raise ValueError(f"DMEM[{a}]: {used[a]} overlaps the stack")
+    return regions
+
+
+def write_memory_map(path, regions, step):
+    used = len({a for first, last, s, name in regions for a in range(first, last + 1, s)})
+    with open(path, 'w') as f:
+        f.write(f'# DMEM, {DMEM_WORDS} words of 64 bits, '
+                f'{"one word per GCC word" if step == 1 else "GCC byte addresses, every 4th word"}\n')
+        f.write('# first\tlast\tstep\twords\tregion\n')
+        for first, last, s, name in sorted(regions):
+            f.write(f'{first}\t{last}\t{s}\t{(last - first) // s + 1}\t{name}\n')
+        f.write(f'# {used} words used, {DMEM_WORDS // step - used} of the {DMEM_WORDS // step} reachable free\n')
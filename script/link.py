@@ -0,0 +1,224 @@
+import argparse
+import ast
+import os
+import re
+
+import hazard
+import isa
+import map
+from materialize import IMM_SAFE
+
+# links up to four thread programs into one IMEM/DMEM image for
+# pipiline_arm_mt.v: thread t runs from word 0x80*t, see pc_target.v
+#
+#   python link.py sort0.txt sort1.txt none sort3.txt -o image.txt
+#   python link.py --template sort.txt --param r1=0,10,20,30 --dmem data.txt -o image.txt
+#
+# inputs are map.py output (imem_write/dmem_write lines) or the hex listings
+# of write_Data_I_Mem*.py (000;e3a01000 / 00;0000000000000143), the scripts
+# themselves included.  map.py places .word data from DMEM 0 unless told
+# otherwise, programs with different data need their own --dmem-start.  --param patches the program's own mov: the reset
+# prologue map.py schedules in among it is told apart by the template's .map
+# (sort.map next to sort.txt, or --map), a template without one is taken to
+# have no prologue
+
+
+def script_listing(path):
+    # the dmem/imem strings of a write_Data_I_Mem*.py script, without running it
+    tree = ast.parse(open(path, 'r').read(), path)
+    text = []
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) \
+                and any(isinstance(t, ast.Name) and t.id in ('dmem', 'imem') for t in node.targets):
+            text.extend(node.value.value.split('\n'))
+    return text
+
+
+def read_image(path):
+    # -> [(pc, word)] sorted, {addr: value}
+    imem = {}
+    dmem = {}
+    if path.endswith('.py'):
+        lines = script_listing(path)
+    else:
+        with open(path, 'r') as f:
+            lines = f.read().split('\n')
+    for line in lines:
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        if parts[0] == 'imem_write':
+            imem[int(parts[1], 0)] = int(parts[2], 16)
+        elif parts[0] == 'dmem_write':
+            dmem[int(parts[1], 0)] = ((int(parts[2], 0) << 32) | int(parts[3], 0)) & 0xFFFFFFFFFFFFFFFF
+        elif ';' in line:
+            addr, data = line.split(';')
+            if len(data.strip()) > 8:
+                dmem[int(addr, 16)] = int(data, 16)
+            else:
+                imem[int(addr, 16)] = int(data, 16)
+        else:
+            raise ValueError(f"{path}: cannot read '{line}'")
+    return sorted(imem.items()), dmem
+
+
+def parse_reg(name):
+    match = re.fullmatch(r'r(\d+)', name.strip().lower())
+    if not match or not 0 < int(match.group(1)) < 16:
+        raise ValueError(f"Invalid register {name}")
+    return int(match.group(1))
+
+
+def reset_pcs(path):
+    # pcs of the reset prologue in a map.py line map
+    return {pc for pc, row in map.read_line_map(path).items() if row.line == 0}
+
+
+def patch_mov(words, reg, value, reset=()):
+    # rewrite the imm8 of the first MOV Rd,#imm that writes reg, the reset pcs
+    # left out; 128..255 would sign-extend in CTRL_UNIT.v and zero-extend in
+    # pipeline_arm.v
+    if not 0 <= value < IMM_SAFE:
+        raise ValueError(f"mov r{reg}, #{value} is outside 0..{IMM_SAFE - 1}, "
+                         f"the imm8 range both decoders agree on")
+    for i, (pc, word) in enumerate(words):
+        if pc in reset:
+            continue
+        if (word >> 26) & 0b11 == 0 and (word >> 25) & 1 and (word >> 21) & 0xF == 0b1101 \
+                and (word >> 12) & 0xF == reg:
+            out = list(words)
+            out[i] = (pc, (word & ~0xFF) | value)
+            return out
+    raise ValueError(f"no mov r{reg}, #imm in the template")
+
+
+def relocate(words, thread):
+    # move a program into the partition of thread, J targets follow it
+    if not words:
+        return []
+    start = words[0][0]
+    end = words[-1][0] + 1
+    if end - start > hazard.PARTITION_USABLE:
+        raise ValueError(f"thread {thread}: {end - start} words run into the words kept free for the planned "
+                         f"stop guard ({hazard.PARTITION_USABLE} usable of {hazard.PARTITION}, pc_target.v itself "
+                         f"wraps at {hazard.PARTITION})")
+    base = thread * hazard.PARTITION
+    out = []
+    for pc, word in words:
+        new = base + pc - start
+        dec = isa.decode(word)
+        target = isa.branch_target(dec, pc)
+        if target is not None:
+            if not start <= target < end:
+                raise ValueError(f"thread {thread}: branch at {pc:#x} leaves the program ({target:#x})")
+            if dec.kind == isa.K_JUMP:
+                word = isa.retarget(word, new, base + target - start)
+        out.append((new, word))
+    return out
+
+
+def instances(words, params, reset=()):
+    # the template once per thread, params: [(reg, [value per thread])]
+    threads = max([len(values) for reg, values in params], default=hazard.THREADS)
+    programs = []
+    for thread in range(threads):
+        patched = words
+        for reg, values in params:
+            if thread < len(values):
+                patched = patch_mov(patched, reg, values[thread], reset)
+        programs.append(patched)
+    return programs
+
+
+def merge_dmem(images):
+    dmem = {}
+    for name, data in images:
+        for addr, value in data.items():
+            if dmem.get(addr, value) != value:
+                raise ValueError(f"{name}: DMEM[{addr:#x}] clashes with another program, "
+                                 f"assemble them with map.py --dmem-start so their data do not overlap")
+            dmem[addr] = value
+    return dmem
+
+
+def link(programs, halt_idle=True):
+    # programs: per thread [(pc, word)] or None, -> {pc: word}
+    if len(programs) > hazard.THREADS:
+        raise ValueError(f"at most {hazard.THREADS} programs")
+    imem = {}
+    for thread in range(hazard.THREADS):
+        words = programs[thread] if thread < len(programs) else None
+        if words:
+            imem.update(relocate(words, thread))
+        elif halt_idle:
+            # IMEM is not cleared by pcreset, park the idle thread on b .
+            imem[thread * hazard.PARTITION] = isa.HALT
+    return imem
+
+
+def write_image(path, imem, dmem, fmt='pipereg'):
+    with open(path, 'w') as f:
+        for addr in sorted(dmem):
+            value = dmem[addr]
+            if fmt == 'hex':
+                f.write(f'{addr:02x};{value:016x}\n')
+            else:
+                f.write(f'dmem_write {addr} {value >> 32:#x} {value & 0xFFFFFFFF:#x}\n')
+        for pc in sorted(imem):
+            if fmt == 'hex':
+                f.write(f'{pc:03x};{imem[pc]:08x}\n')
+            else:
+                f.write(f'imem_write {pc} {imem[pc]:#010x}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='link thread programs into one pipiline_arm_mt image')
+    parser.add_argument('programs', nargs='*', help="one file per thread, 'none' leaves a thread idle")
+    parser.add_argument('--template', help='one program for every thread')
+    parser.add_argument('--param', action='append', default=[],
+                        help='reg=v0,v1,.. per-thread mov reg, #v of the template')
+    parser.add_argument('--map', help="--template: its map.py line map, default next to it as .map")
+    parser.add_argument('--dmem', action='append', default=[], help='extra DMEM image')
+    parser.add_argument('--no-halt-idle', action='store_true')
+    parser.add_argument('--format', choices=['pipereg', 'hex'], default='pipereg')
+    parser.add_argument('-o', '--out', default='image.txt')
+    args = parser.parse_args()
+
+    programs = []
+    images = []
+    if args.template:
+        words, dmem = read_image(args.template)
+        images.append((args.template, dmem))
+        params = []
+        for p in args.param:
+            reg, values = p.split('=')
+            params.append((parse_reg(reg), [int(v, 0) for v in values.split(',')]))
+        map_path = args.map or os.path.splitext(args.template)[0] + '.map'
+        reset = set()
+        if os.path.exists(map_path):
+            reset = reset_pcs(map_path)
+        elif params:
+            print(f'no line map {map_path}, {args.template} is taken to have no reset prologue')
+        programs = instances(words, params, reset)
+    else:
+        if args.param:
+            raise ValueError("--param needs --template")
+        for path in args.programs:
+            if path == 'none':
+                programs.append(None)
+                continue
+            words, dmem = read_image(path)
+            images.append((path, dmem))
+            programs.append(words)
+    for path in args.dmem:
+        images.append((path, read_image(path)[1]))
+
+    imem = link(programs, halt_idle=not args.no_halt_idle)
+    dmem = merge_dmem(images)
+    write_image(args.out, imem, dmem, args.format)
+    print(f'{len(imem)} imem words, {len(dmem)} dmem words -> {args.out}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import argparse
+
+import numpy as np
+
+import isa
+import link
+import sim
+
+# sim.py's model of src/pipline/pipeline_arm.v run over many DMEM datasets at
+# once: every lane is one board running the same IMEM image, all lanes step
+# the same cycle together with numpy
+#
+#   python lockstep.py write_Data_I_Mem.py --random 1000 --end auto
+#   python lockstep.py pp_output.txt data.npy --out final.npy
+#
+# data.npy is an (N, 256) uint64 array, one DMEM per lane, or give dmem_write
+# files (one lane each).  --random N keeps the image's DMEM layout and puts
+# random values in the words it initializes.
+#
+# each lane has its own pc, IF/ID and ID/EX registers and write back queue, so
+# lanes whose branches go different ways just fetch different words from then
+# on; per cycle the stages work on masks of the lanes doing a load, a store, a
+# taken branch, ..  a lane leaves the batch when it halts (see sim.Pipeline.run)
+# and the rest are compacted, the final DMEM, registers and halt cycle of every
+# lane equal sim.Pipeline run on that lane's DMEM
+
+NO_PC = -1
+NO_REG = 16     # write back slot with nothing to write, reads of r0 stay 0
+
+
+class Lockstep:
+    def __init__(self, imem=None, dmems=None, signed_imm=False):
+        self.signed_imm = signed_imm
+        self.imem = isa.new_image()
+        for pc, word in (imem or []):
+            self.imem[pc & isa.PC_MASK] = word
+        self.dmem = np.array(dmems, dtype=np.uint64).reshape(-1, sim.DMEM_WORDS)
+        self.regs = np.zeros((len(self.dmem), 16), dtype=np.uint64)
+        self.cycles = np.full(len(self.dmem), -1, dtype=np.int64)
+
+    def run(self, max_cycles=sim.MAX_CYCLES, end=None):
+        # run every lane until it halts, returns the halt cycle per lane (-1:
+        # still running when max_cycles ran out); end as for sim.Pipeline.run
+        T = sim.decode_table(self.imem, self.signed_imm)
+        branch = np.flatnonzero(T.what >= sim.X_BRANCH)
+        column = np.zeros(len(self.imem), dtype=np.intp)    # pc -> seen column
+        column[branch] = np.arange(len(branch))
+        writes = np.isin(T.what, (sim.X_ALU, sim.X_LOAD, sim.X_BRANCH)) & (T.wreg != 0)
+        wreg_of = np.where(writes, T.wreg, NO_REG)
+        effect = np.isin(T.what, (sim.X_ALU, sim.X_LOAD, sim.X_STORE))
+
+        # dmem, regs and the halt bookkeeping stay one row per lane, indexed
+        # by lane; only the pipeline registers of running lanes are compacted
+        dmem = self.dmem
+        regs = np.zeros((len(dmem), NO_REG + 1), dtype=np.uint64)
+        regs[:, :16] = self.regs
+        done = np.zeros(len(dmem), dtype=np.int64)         # ALU/load/store words
+        seen_done = np.full((len(dmem), len(branch)), -1, dtype=np.int64)
+        seen_t = np.zeros((len(dmem), len(branch)), dtype=np.int64)
+
+        n = len(dmem)
+        lane = np.arange(n)
+        pc = np.zeros(n, dtype=np.int64)
+        fetched = np.zeros(n, dtype=np.int64)
+        id_pc = np.full(n, NO_PC, dtype=np.int64)
+        ex_pc = np.full(n, NO_PC, dtype=np.int64)
+        ex_a = np.zeros(n, dtype=np.uint64)
+        ex_b = np.zeros(n, dtype=np.uint64)
+        ex_r2 = np.zeros(n, dtype=np.uint64)
+        pend_reg = np.full((4, n), NO_REG, dtype=np.intp)  # cycle & 3 -> register
+        pend_val = np.zeros((4, n), dtype=np.uint64)
+
+        def retire(out, halt):
+            # words behind the halt finish their write back, as sim.Pipeline does
+            for slot in range(4):
+                regs[lane[out], pend_reg[slot, out]] = pend_val[slot, out]
+            self.cycles[lane[out]] = halt[out]
+
+        t = 0
+        while n and t < max_cycles:
+            slot = t & 3
+            regs[lane, pend_reg[slot]] = pend_val[slot]
+            pend_reg[slot] = NO_REG
+
+            # EX
+            live = ex_pc != NO_PC
+            halt = np.full(n, -1, dtype=np.int64)
+            if end is not None:
+                halt[ex_pc == end] = t
+                live &= ex_pc != end
+            p = np.where(live, ex_pc, 0)
+            what = np.where(live, T.what[p], sim.X_NOP)
+            value = sim.alu_batch(T.alu[p], ex_a, ex_b)
+            addr = (value & sim.U64(0xFF)).astype(np.intp)
+            store = what == sim.X_STORE
+            if store.any():
+                dmem[lane[store], addr[store]] = ex_r2[store]
+            load = what == sim.X_LOAD
+            if load.any():
+                value[load] = dmem[lane[load], addr[load]]
+            jump = np.full(n, NO_PC, dtype=np.int64)
+            br = what == sim.X_BRANCH
+            jump[br] = T.target[p[br]]
+            # BL: R14 = pc of the BL + 1
+            value[br] = ((p[br] + 1) & isa.PC_MASK).astype(np.uint64)
+            cond = (what == sim.X_COND) & ((ex_a != ex_b) == T.bne[p])
+            jump[cond] = T.target[p[cond]]
+            jr = what == sim.X_JR
+            jump[jr] = (ex_r2[jr] & sim.U64(isa.PC_MASK)).astype(np.int64)
+            pend_reg[(t + 3) & 3] = np.where(live, wreg_of[p], NO_REG)
+            pend_val[(t + 3) & 3] = value
+            done[lane] += live & effect[p]
+
+            # back on a branch with nothing done since: idle for good
+            taken = jump != NO_PC
+            if taken.any():
+                at = lane[taken]
+                col = column[p[taken]]
+                idle = seen_done[at, col] == done[at]
+                halt[np.flatnonzero(taken)[idle]] = seen_t[at[idle], col[idle]]
+                seen_done[at, col] = done[at]
+                seen_t[at, col] = t
+
+            out = halt >= 0
+            if out.any():
+                retire(out, halt)
+                keep = ~out
+                n = int(keep.sum())
+                lane, pc, fetched, id_pc, jump, taken = (x[keep] for x in (lane, pc, fetched, id_pc, jump, taken))
+                pend_reg, pend_val = pend_reg[:, keep], pend_val[:, keep]
+
+            # ID, a taken branch flushes the word here
+            q = np.where(id_pc == NO_PC, 0, id_pc)
+            ex_pc = np.where(taken, NO_PC, id_pc)
+            ex_a = regs[lane, T.reg1[q]]
+            ex_r2 = regs[lane, T.reg2[q]]
+            ex_b = np.where(T.use_imm[q], T.imm[q], ex_r2)
+
+            # IF
+            id_pc = fetched
+            fetched = pc
+            pc = np.where(taken, jump, (pc + 1) & isa.PC_MASK)
+            t += 1
+
+        if n:
+            retire(np.ones(n, dtype=bool), np.full(n, -1, dtype=np.int64))
+        self.regs = regs[:, :16].copy()
+        return self.cycles
+
+
+def datasets(paths, image_dmem):
+    # (N, 256) uint64 from .npy arrays and dmem_write/listing files
+    lanes = []
+    for path in paths:
+        if path.endswith('.npy'):
+            lanes.extend(np.load(path).astype(np.uint64).reshape(-1, sim.DMEM_WORDS))
+        else:
+            dmem = dict(image_dmem)
+            dmem.update(link.read_image(path)[1])
+            lanes.append([dmem.get(addr, 0) for addr in range(sim.DMEM_WORDS)])
+    return np.array(lanes, dtype=np.uint64).reshape(-1, sim.DMEM_WORDS)
+
+
+def random_datasets(image_dmem, n, seed=None):
+    # the image's DMEM with random values in the words it initializes
+    base = np.zeros(sim.DMEM_WORDS, dtype=np.uint64)
+    for addr, value in image_dmem.items():
+        base[addr & 0xFF] = value
+    lanes = np.tile(base, (n, 1))
+    used = sorted(addr & 0xFF for addr in image_dmem)
+    rng = np.random.default_rng(seed)
+    lanes[:, used] = rng.integers(-1000, 1000, size=(n, len(used))).astype(np.uint64)
+    return lanes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run one map.py/link.py image over many DMEMs on a model of pipeline_arm.v')
+    parser.add_argument('image', nargs='?', default='pp_output.txt')
+    parser.add_argument('data', nargs='*', help='.npy (N, 256) arrays or dmem_write files, one lane each')
+    parser.add_argument('--random', type=int, help='N lanes of random values where the image initializes DMEM')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--max-cycles', type=int, default=sim.MAX_CYCLES)
+    parser.add_argument('--end', help="stop a lane when the word at this pc is in EX, 'auto': behind the last word")
+    parser.add_argument('--sign-ext', action='store_true',
+                        help='sign-extend imm8/imm12 like CTRL_UNIT.v, the board zero-extends')
+    parser.add_argument('--out', help='write the final DMEMs here as an (N, 256) .npy array')
+    args = parser.parse_args()
+
+    imem, dmem = link.read_image(args.image)
+    lanes = datasets(args.data, dmem)
+    if args.random:
+        lanes = np.concatenate([lanes, random_datasets(dmem, args.random, args.seed)])
+    if not len(lanes):
+        lanes = datasets([args.image], dmem)
+    end = None
+    if args.end == 'auto':
+        end = (max(pc for pc, word in imem) + 1) & isa.PC_MASK
+    elif args.end is not None:
+        end = int(args.end, 0)
+
+    cpu = Lockstep(imem, lanes, signed_imm=args.sign_ext)
+    cycles = cpu.run(args.max_cycles, end)
+    halted = cycles[cycles >= 0]
+    print(f'{len(lanes)} lanes, {len(halted)} halted', end='')
+    if len(halted):
+        print(f', cycles min {halted.min()} mean {halted.mean():.1f} max {halted.max()}')
+    else:
+        print()
+    if args.out:
+        np.save(args.out, cpu.dmem)
+    elif len(lanes) == 1:
+        for addr, value in enumerate(cpu.dmem[0]):
+            if value:
+                print(f'DMEM[{addr}] = {int(value):#018x}')
+
+
+if __name__ == "__main__":
+    main()
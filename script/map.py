@@ -1,5 +1,13 @@
+import argparse
 import os
-import re
+from collections import namedtuple
+
+import hazard
+import fold
+import isa
+import layout
+import materialize
+import promote
 
 #if ! ,we should add first then offset == 0
 #
@@ -9,85 +17,6 @@ import re
 # use PC to define the line in pipeline file, which is the same as the line in the complied instruction file
 
 
-cmd_dist={ 
-    ".word" : "dmem_write",
-
-    "push" : 'imem_write',
-    'pop' : 'imem_write',
-    'add' : 'imem_write',
-    'sub' : 'imem_write',
-    'ldr' : 'imem_write',
-    'mov' : 'imem_write',
-    'cmp' : 'imem_write',
-    'ldmia' : 'imem_write',
-    'ldm' : 'imem_write',
-    'str' : 'imem_write',
-    'stmia' : 'imem_write',
-    'stm' : 'imem_write',
-    'lsl' : 'imem_write',
-    'bge' : 'imem_write',
-    'ble' : 'imem_write',
-    'b' : 'imem_write',
-    'bx' : 'imem_write',
-
-
-    "d_w" : "dmem_write",
-    "d_r" : "dmem_read",
-
-
-    "reset" : "pcreset",
-    'run' : 'run 1',
-    'step' : 'step',
-
-
-
-
-    'lw' : 'imem_write',
-    'sw' : 'imem_write',
-    'nop' : 'imem_write'
-
-}
-
-ROT = "0000"
-
-BI_MAP = {
-    'NOP' : '0xE0000000',
-
-
-    'ADD' : '0100',
-    'SUB' : '0010',
-    'MOV' : '1101',
-    'LSL' : '0110',
-    'SLT' : '1011',
-
-
-    'BEQ' : '00',
-    'B' : '10',
-    'BX' : '0001', #special
-    
-    'B_prefix' : '10',
-
-
-    'con_process': '1110',
-
-
-    'process_prefix' : '00',
-    'S' : '0',
-    'imm' : '1',
-    'reg' : '0',
-
-
-    'ls_prefix' : '01',
-    'ls_P' : '1',
-    'ls_add' : '1',
-    'ls_sub' : '0',
-    'l_BNWL' : '001',
-    'l_BWL' : '011',
-    'S_BWL' : '000',
-    'S_BNWL' : '010'
-
-}
-
 REGS_MAP = {
     'r0' : '0000',  #always 0
     'r1' : '0001',
@@ -106,57 +35,62 @@ REGS_MAP = {
     'lr' : '1110',
     'ip' : '1111'}
 
-### we map r0 -> r11 , SLT sign bit -> r10,r9,  store imm SLT and SHIFT: r8
+### we map r0 -> r11 , SLT sign bit -> r10,  store imm SLT and SHIFT: r8
 ## identical 1 reg: r7
 
 
-SLT_AB = '1010'  #this is for bge
-SLT_BA = '1001'  #this is for ble
+REG_NUM = {name: int(bits, 2) for name, bits in REGS_MAP.items()}
+REG_NUM['r0'] = REG_NUM['r11']     # r0 is always 0 in our design, the program's r0 lives in r11
+REG_SCRATCH = REG_NUM['r8']
+REG_SLT = REG_NUM['r10']
+REG_SP = REG_NUM['sp']
+
+COND_BRANCHES = ('beq', 'bne', 'blt', 'bge', 'bgt', 'ble')
+SLT_IMM = 128   # SLT rd, rn, #imm for imm below this, both decoders read imm8 the same
+
+# an assembled program
+#   imem    : [(pc, word)] in pc order, padding included
+#   dmem    : [(addr, value)] of the .word data, value is 64 bit
+#   symbols : {label: pc} of code labels, {label: dmem address} of data labels
+#             (.LC0) and literal pool labels (.L8 : .word .LC0 -> address of .LC0)
+#   output  : imem_write/dmem_write lines for pipereg.pl
+#   lines   : {pc: index into ALLWRITE} of every word that is not padding,
+#             -1 for the register reset prologue
+#   memory  : [(first, last, step, region)] DMEM map from layout.memory_map
+#   unscaled: ALLWRITE indexes of offsets COMPACT left as written
+#   constants: [(ALLWRITE index, value, form, words, cycles)] of every immediate
+#             materialize.py rewrote
+Image = namedtuple('Image', ['imem', 'dmem', 'symbols', 'output', 'lines', 'memory', 'unscaled', 'constants'],
+                   defaults=((), (), ()))
+
+# one row of the pc -> source map written next to the output
+#   line : 1 based line of the .s file, 0 for the reset prologue
+#   label: function and block label the line is under, 'main:.L3'
+#   pad  : a padding NOP, charged to the word it waits for (or the branch
+#          whose shadow it fills)
+Line = namedtuple('Line', ['pc', 'line', 'label', 'pad', 'text'])
+
+
+class Instr:
+    # one imem word with its operands already parsed
+    # op: dp / ldr / str / beq / bne / b / bx / nop, cmd: isa.OPCODES key of a dp opcode
+    # label: branch target or ldr/str symbol, filled in by the fixup pass
+    # nops: padding words after it (fixed NOP_NUM mode)
+    __slots__ = ('op', 'cmd', 'rd', 'rn', 'rm', 'imm', 'sub', 'wb', 'label', 'nops', 'line')
+
+    def __init__(self, op, line, nops=0, cmd=None, rd=0, rn=0, rm=0, imm=None, sub=False, wb=False, label=None):
+        self.op = op
+        self.cmd = cmd
+        self.rd = rd
+        self.rn = rn
+        self.rm = rm
+        self.imm = imm
+        self.sub = sub
+        self.wb = wb
+        self.label = label
+        self.nops = nops
+        self.line = line
 
-label_map = {
-
-} #for all potential processed address in .LC
-# .LC0 : 0x12345678
-
-line_label_map = {
-
-}
-# for all the potential jumps ,to store the label and line number to write PClabel_MAP
-#  2 : .L0
-#  arm line2 has a label .L0
-
-pc_label_map = {
-
-} 
-# .L0 : PC
-# now we excute to .L0, and store the next line's PC
-
-pp_label_map = {
-
-}
-
-# .L0 : PP 
-# store the line number in our script to overwrite
-
-branch_label_map = {
-
-}
-# for all the potential jumps in our pipeline file, 
-# line : [branch_pc, rm]
-# to store arm line number , instruction PC and right rm
-
-
-# when there is a imm jump, we will look up this dist for the correct PC count
-# if not found, we will write 'WAIT FOR EXECUTE' into that [] and store the line number and PC into NOT_FOUND_LABEL
-# try at the end, if still not found, then we will raise error
-# always make sure jump only take 1 PC line
-NOT_FOUND_LABEL = []
-# [[line, Pp_line], [line, Pp_line]] this is the beq line and b line that we have not found the label for, we will try to fill in the correct instruction at the end, if still not found, then we will raise error
-# to store the arm line number and the script line number
-
-# we will transfer line in arm file again and write it into the [[]_PC_line]
-
-dmem_address = 0
 
 def de_hex(str):
     if str.startswith('0x'):
@@ -167,632 +101,548 @@ def de_hex(str):
     else:
         return hex(int(str))
 
-def hex_bi(str, width=32, signed=False):
-    value = de_hex(str)
-    value = int(value, 16)
-    if signed :
-        mask = (1 << width) - 1
-        value = value & mask
-    return f'{value:0{width}b}'
-
-
-
-def split32(str):
-    value=de_hex(str)
-    value = int(value, 16)
-    high = (value >> 32) & 0xFFFFFFFF
-    low = value & 0xFFFFFFFF
-    return hex(high), hex(low)
-
-def build_instr(upcode, rn, rd, offset, line):
-    # 4_con, 8_upcode, 4_rn, 4_rd, 12_offset
-    bi_instr = f'{upcode}{rn}{rd}{offset}'
-    if len(bi_instr) != 32:
-        raise ValueError(f"Line {line}:  {bi_instr} Instruction length is not 32 bits")
-    hex_instr = hex(int(bi_instr, 2))
-    return hex_instr
-
-def change_logic(ALLWRITE, PC_start = 0, RMEM_START = 0, WORKPLACE_START = 0, NOP_NUM = 0):
-    global dmem_address
-    global PC 
-    global pipe_line
-    pipe_line = 0
-    PC = 0
-    PC = PC + PC_start
-    dmem_address = dmem_address + RMEM_START
-    reset_address = WORKPLACE_START
-
-    output = []
-
-    #reset all regs to 0
-
-    for reg in REGS_MAP.keys():
-        mov_instr = f'mov {reg}, #0'
-        output.extend(arm_2_pipeline(mov_instr, -1, NOP_NUM = 0))
-    
-    output.extend(generic_nops(5)) # we can adjust the number of nops here to make sure the reset instruction takes 1 PC line, and we have enough time to write back to sp register before the next instruction
-
-    for i in range(len(ALLWRITE)):
-        if ALLWRITE[i][0].startswith('.'):
-            if ALLWRITE[i][0].startswith('.word'):
-                followinstr = arm_2_pipeline(ALLWRITE[i][0], i)
-                if isinstance(followinstr, list):
-                    output.extend(followinstr)
-                else:
-                    if line_label_map.get(i) :
-                        label_map[line_label_map.get(i)] = followinstr
-                    else:
-                        line_label_map[i] = followinstr
-            elif ALLWRITE[i][0].startswith('.LC'):
-                label_map[ALLWRITE[i][0].split(':')[0]] = dmem_address
-            elif ALLWRITE[i][0].startswith('.L'):
-                if line_label_map.get(i+1) :
-                    label_map[ALLWRITE[i][0].split(':')[0]] = line_label_map.get(i+1)
-                else: 
-                    line_label_map[i+1] = ALLWRITE[i][0].split(':')[0]
-
-    
-    
-
-    for line in range(len(ALLWRITE)):
-        if ALLWRITE[line][0].startswith('.'):
-            pass
+# operand parsing, every source line is parsed exactly once
+
+def parse_reg(name, line):
+    reg = REG_NUM.get(name.strip())
+    if reg is None:
+        raise ValueError(f"Invalid register in line {line}: {name}")
+    return reg
+
+def parse_imm(text, line):
+    # '#12', '#0x0c', '#$12'
+    text = text.strip()
+    if not text.startswith('#'):
+        raise ValueError(f"Invalid immediate in line {line}: {text}")
+    return int(de_hex(text[1:]), 16)
+
+def parse_ops(args, count, line, op):
+    ops = [d.strip() for d in args.split(',')]
+    if len(ops) != count:
+        raise ValueError(f"Invalid {op} instruction in line {line}: {op} {args}")
+    return ops
+
+def parse_reglist(args, line, op):
+    # '{r0, r1, r2}' -> [11, 1, 2]
+    if '{' not in args or '}' not in args:
+        raise ValueError(f"Invalid {op} instruction in line {line}: {op} {args}")
+    names = args[args.index('{') + 1:args.index('}')].split(',')
+    return [parse_reg(name, line) for name in names]
+
+def parse_mem(args, line, op):
+    # '[fp, #-8]!' -> rn, offset, subtract, write back
+    if ']' not in args:
+        raise ValueError(f"Invalid {op} instruction in line {line}: {op} {args}")
+    wb = args.rstrip().endswith('!')
+    dest = args[args.index('[') + 1:args.index(']')].split(',')
+    rn = parse_reg(dest[0], line)
+    offset = dest[1].strip() if len(dest) > 1 else '#0'
+    if offset.startswith('#-'):
+        return rn, parse_imm('#' + offset[2:], line), True, wb
+    elif offset.startswith('#'):
+        return rn, parse_imm(offset, line), False, wb
+    raise ValueError(f"Invalid {op} instruction in line {line}: {op} {args}")
+
+# lowering: one source line -> Instr words, pseudo instructions are expanded
+# here directly instead of being rewritten into text and translated again
+
+def lower_dp(out, op, args, line, nops):
+    cmd = op.upper()
+    if op == 'mov':
+        rd, src = parse_ops(args, 2, line, op)
+        rd = parse_reg(rd, line)
+        if src.startswith('#'):
+            out.append(Instr('dp', line, nops, 'MOV', rd=rd, imm=parse_imm(src, line)))
         else:
-            label = line_label_map.get(line)
-            if label is not None:
-                PP_current = pipe_line
-                PC_current = PC
-                pc_label_map[label] = PC_current
-                pp_label_map[label] = PP_current
-            followinstr = arm_2_pipeline(ALLWRITE[line][0], line, NOP_NUM)
-            output.extend(followinstr)
-    
-    print (f' total PC is {PC}, total pipe line is {pipe_line}')
-
-    
-    for i in range(len(NOT_FOUND_LABEL)):
-        line, PP_line = NOT_FOUND_LABEL[i]   
-        print(f'line {line} not found, instruction is {ALLWRITE[line][0]}')     
-        followinstr = arm_2_pipeline(ALLWRITE[line][0], line, NOP_NUM)
-        output[PP_line] = followinstr[0]
-            # to be continued
-    return output
-
-def generic_nops(num):
-    nops = []
-    global PC
-    global pipe_line
-    for i in range(num):
-        hex_instr = BI_MAP.get('NOP')
-        nops.append([f'imem_write {PC} {hex_instr}'])
-        PC += 1
-        pipe_line += 1
-        
-    return nops
-
-def arm_2_pipeline(write_line, line, NOP_NUM = 0):
-    global dmem_address
-    global PC
-    global pipe_line
-    write_line = write_line.replace('r0', 'r11') #replace r0 with r11 since r0 is always 0 in our design, we will use r10 to store the sign bit for slt instruction, and use r11 to store the value of r0
-    instr_decode = write_line.split()
-    pipe_instr = []
-    command = cmd_dist.get(instr_decode[0])
-    if command is None:
-        raise ValueError(f"Unknown command: {instr_decode[0]}")
-    if command == 'dmem_write':
-        if instr_decode[0] == '.word':
-            if len(instr_decode) < 2:
-                raise ValueError(f"Invalid instruction in line {line}: {' '.join(instr_decode)}")
-            addr = dmem_address
-            dmem_address += 4
-            data = instr_decode[1]
-            try:
-                high, low = split32(data)
-            except Exception:
-                print(f"line {line}is the end of the file, all readonly instructions have been processed.")
-                taradd = label_map.get(instr_decode[1])
-                return taradd
-            pipe_instr.append([f'{command} {addr} {high} {low}'])
-    
-    elif command == 'imem_write':
-        if instr_decode[0] == 'push':    #n+1 clk
-            regs = []
-            match = re.search(r'\{([^}]+)\}', write_line)
-            if match:
-                regs.append(match.group(1).split(','))    # [['r0', 'r1', 'r2'']]
-            else:
-                raise ValueError(f"Invalid push instruction in line {line}: {write_line}")
-            for i in range(len(regs[0])):
-                reg = REGS_MAP.get(regs[0][i].strip())
-                if reg is None:
-                    raise ValueError(f"Invalid register in line {line}: {reg}")
-                #store to sp-4 then write back to sp register
-                prefix = '111001010010'
-                addr = hex_bi(f'{4*(i+1)}', width=8) #4, 8, 12...
-                offset = '11000000' + addr
-                # offset = '1100000000000100' 
-                bi_instr = prefix + reg + offset
-                hex_instr = hex(int(bi_instr, 2))
-
-                pipe_instr.append([f'{command} {PC} {hex_instr}'])
-                PC += 1
-                pipe_line += 1
-                pipe_instr.extend(generic_nops(NOP_NUM)) 
-                
-            endaddr = 4*len(regs[0]) 
-            sub_instr = f'sub sp, sp, #{endaddr}'
-            pipe_instr.extend(arm_2_pipeline(sub_instr, line, NOP_NUM))  #ADD PC in inner instrution
-            return pipe_instr
-        
-        elif instr_decode[0] == 'pop':
-            regs = []
-            match = re.search(r'\{([^}]+)\}', write_line)
-            if match:
-                regs.append(match.group(1).split(','))    # [['r0', 'r1', 'r2'']]
-            else:
-                raise ValueError(f"Invalid pop instruction in line {line}: {write_line}")
-            for i in range(len(regs[0])):
-                reg = REGS_MAP.get(regs[0][i].strip())
-                if reg is None:
-                    raise ValueError(f"Invalid register in line {line}: {reg}")
-                #load from sp then write sp+4 back to sp register
-                addr = hex_bi(f'{4*i}', width=8) #0, 4, 8...
-                offset = '11000000' + addr
-                prefix = '111001011010'
-                # offset = '1100000000000100' #4
-                bi_instr = prefix + reg + offset
-                hex_instr = hex(int(bi_instr, 2))
-
-                pipe_instr.append([f'{command} {PC} {hex_instr}'])
-                PC += 1
-                pipe_line += 1
-                pipe_instr.extend(generic_nops(NOP_NUM)) 
-                
-            endaddr = 4*len(regs[0]) 
-            add_instr = f'add sp, sp, #{endaddr}'
-            pipe_instr.extend(arm_2_pipeline(add_instr, line, NOP_NUM))  #ADD PC in inner instrution
-            return pipe_instr
-                
-
-
-        elif instr_decode[0] == 'add':
-            op, data = write_line.split(maxsplit=1)
-            data = [d.strip() for d in data.split(',')]
-            try :
-                rd = REGS_MAP.get(data[0])
-                rn = REGS_MAP.get(data[1])
-                if data[2].startswith('#'):
-                    rt = hex_bi(data[2][1:], width=8)
-                    r_ctrl = BI_MAP.get('imm')
-                    offset = rt
-                else:
-                    r_ctrl = BI_MAP.get('reg')
-                    rt = REGS_MAP.get(data[2])
-                    offset = '0000'+rt
-            except Exception:
-                raise ValueError(f"Invalid add instruction in line {line}: {write_line}")
-            
-            cmd = BI_MAP.get('ADD') 
-            upcode = f'{BI_MAP.get("con_process")}{BI_MAP.get("process_prefix")}{r_ctrl}{cmd}{BI_MAP.get("S")}'
-            rot = ROT
-            offset = rot + offset
-            hex_instr = build_instr(upcode, rn, rd, offset, line)
-            
+            out.append(Instr('dp', line, nops, 'MOV', rd=rd, rm=parse_reg(src, line)))
+        return
+    rd, rn, src = parse_ops(args, 3, line, op)
+    rd = parse_reg(rd, line)
+    rn = parse_reg(rn, line)
+    if not src.startswith('#'):
+        out.append(Instr('dp', line, nops, cmd, rd=rd, rn=rn, rm=parse_reg(src, line)))
+    elif op == 'lsl':
+        # no shift by immediate, MOV the imm to r8 then use r8
+        out.append(Instr('dp', line, nops, 'MOV', rd=REG_SCRATCH, imm=parse_imm(src, line)))
+        out.append(Instr('dp', line, nops, cmd, rd=rd, rn=rn, rm=REG_SCRATCH))
+    else:
+        out.append(Instr('dp', line, nops, cmd, rd=rd, rn=rn, imm=parse_imm(src, line)))
+
+def lower_mem(out, op, args, line, nops):
+    if ',' not in args:
+        raise ValueError(f"Invalid {op} instruction in line {line}: {op} {args}")
+    rd, data = args.split(',', 1)
+    rd = parse_reg(rd, line)
+    data = data.strip()
+    if not data.startswith('['):
+        # ldr r3, .L8 / str r3, .LC0, resolved by the fixup pass
+        out.append(Instr(op, line, nops, rd=rd, label=data))
+        return
+    rn, offset, sub, wb = parse_mem(data, line, op)
+    if wb:
+        # write the base register back first, then access with offset 0
+        out.append(Instr('dp', line, nops, 'SUB' if sub else 'ADD', rd=rn, rn=rn, imm=offset))
+        offset = 0
+    out.append(Instr(op, line, nops, rd=rd, rn=rn, imm=offset, sub=sub, wb=wb))
+
+def lower_multi(out, op, args, line, nops):
+    # ldmia/ldm/stmia/stm rn{!}, {regs}: one ldr/str per register
+    if ',' not in args:
+        raise ValueError(f"Invalid {op} instruction in line {line}: {op} {args}")
+    rn, data = args.split(',', 1)
+    write_back = '!' in rn
+    rn = parse_reg(rn.replace('!', ''), line)
+    regs = parse_reglist(data, line, op)
+    kind = 'ldr' if op.startswith('ldm') else 'str'
+    if kind == 'str':
+        nops = 0
+    for i, reg in enumerate(regs):
+        out.append(Instr(kind, line, nops, rd=reg, rn=rn, imm=i*4))
+    if write_back:
+        out.append(Instr('dp', line, nops, 'ADD', rd=rn, rn=rn, imm=len(regs)*4))
+
+def lower_stack(out, op, args, line, nops):
+    # push/pop {regs}, lowest register at the lowest address
+    regs = parse_reglist(args, line, op)
+    n = len(regs)
+    for i, reg in enumerate(regs):
+        if op == 'push':
+            out.append(Instr('str', line, nops, rd=reg, rn=REG_SP, imm=4*(n-i), sub=True))
+        else:
+            out.append(Instr('ldr', line, nops, rd=reg, rn=REG_SP, imm=4*i))
+    cmd = 'SUB' if op == 'push' else 'ADD'
+    out.append(Instr('dp', line, nops, cmd, rd=REG_SP, rn=REG_SP, imm=4*n))
+
+def parse_cmp(args, line):
+    # cmp a, b -> (a, b, None), cmp a, #imm -> (a, None, imm)
+    a, b = parse_ops(args, 2, line, 'cmp')
+    a = parse_reg(a, line)
+    if b.startswith('#'):
+        return a, None, parse_imm(b, line)
+    return a, parse_reg(b, line), None
+
+def lower_cond(out, op, args, line, nops, flags=None):
+    # cmp emits nothing, each b<cond> after it lowers the pair: BEQ/BNE on the
+    # operands for eq/ne, otherwise one SLT into r10 and BEQ/BNE of r10 and r0
+    if flags is None:
+        raise ValueError(f"{op} without a cmp before it in line {line}")
+    label = args.strip()
+    a, b, imm = flags
+    if op in ('beq', 'bne'):
+        if imm == 0:
+            b = 0
+        elif imm is not None:
+            out.append(Instr('dp', line, nops, 'MOV', rd=REG_SCRATCH, imm=imm))
+            b = REG_SCRATCH
+        out.append(Instr(op, line, nops, rn=a, rm=b, label=label))
+        return
+    # blt: a < b, bge: !(a < b), bgt: b < a, ble: !(b < a)
+    swap = op in ('bgt', 'ble')
+    branch = 'bne' if op in ('blt', 'bgt') else 'beq'
+    if imm is None:
+        rn, rm = (b, a) if swap else (a, b)
+        out.append(Instr('dp', line, nops, 'SLT', rd=REG_SLT, rn=rn, rm=rm))
+    elif not swap and 0 <= imm < SLT_IMM:
+        out.append(Instr('dp', line, nops, 'SLT', rd=REG_SLT, rn=a, imm=imm))
+    elif swap and 0 <= imm + 1 < SLT_IMM:
+        # a > k is !(a < k + 1), a <= k is a < k + 1
+        out.append(Instr('dp', line, nops, 'SLT', rd=REG_SLT, rn=a, imm=imm + 1))
+        branch = 'beq' if branch == 'bne' else 'bne'
+    else:
+        out.append(Instr('dp', line, nops, 'MOV', rd=REG_SCRATCH, imm=imm))
+        rn, rm = (REG_SCRATCH, a) if swap else (a, REG_SCRATCH)
+        out.append(Instr('dp', line, nops, 'SLT', rd=REG_SLT, rn=rn, rm=rm))
+    out.append(Instr(branch, line, nops, rn=REG_SLT, rm=0, label=label))
+
+def lower_branch(out, op, args, line, nops):
+    out.append(Instr('b', line, nops, label=args.strip()))
+
+def lower_bx(out, op, args, line, nops):
+    out.append(Instr('bx', line, nops, rm=parse_reg(args, line)))
+
+LOWER = {
+    'push' : lower_stack,
+    'pop' : lower_stack,
+    'add' : lower_dp,
+    'sub' : lower_dp,
+    'mov' : lower_dp,
+    'lsl' : lower_dp,
+    'ldr' : lower_mem,
+    'str' : lower_mem,
+    'ldmia' : lower_multi,
+    'ldm' : lower_multi,
+    'stmia' : lower_multi,
+    'stm' : lower_multi,
+    'beq' : lower_cond,
+    'bne' : lower_cond,
+    'blt' : lower_cond,
+    'bge' : lower_cond,
+    'bgt' : lower_cond,
+    'ble' : lower_cond,
+    'b' : lower_branch,
+    'bx' : lower_bx,
+}
 
-        elif instr_decode[0] == 'sub':
-            op, data = write_line.split(maxsplit=1)
-            data = [d.strip() for d in data.split(',')]
-            try :
-                rd = REGS_MAP.get(data[0])
-                rn = REGS_MAP.get(data[1])
-                if data[2].startswith('#'):
-                    rt = hex_bi(data[2][1:], width=8)
-                    r_ctrl = BI_MAP.get('imm')
-                    offset = rt
-                else:
-                    r_ctrl = BI_MAP.get('reg')
-                    rt = REGS_MAP.get(data[2])
-                    offset = '0000'+rt
-            except Exception:
-                raise ValueError(f"Invalid sub instruction in line {line}: {write_line}")
-            cmd = BI_MAP.get('SUB')
-            upcode = f'{BI_MAP.get("con_process")}{BI_MAP.get("process_prefix")}{r_ctrl}{cmd}{BI_MAP.get("S")}'
-            rot = ROT
-            offset = rot + offset
-            hex_instr = build_instr(upcode, rn, rd, offset, line)
-            
-        
-        elif instr_decode[0] == 'ldr':
-            op, rd, data = write_line.split(maxsplit=2)
-            rd = rd.replace(',', '').strip()
-            rd = REGS_MAP.get(rd)
-            data = data.strip()
-            match = re.search(r'\[([^\]]+)\]', data)
-            if re.search(r'!\s*$', data):
-                bwl = BI_MAP.get('l_BWL')
-            else:
-                bwl = BI_MAP.get('l_BNWL')
-            dest = []
-            if match:
-                dest = match.group(1).split(',')  # get the destination register
-                rn = REGS_MAP.get(dest[0].strip())
-                dest[1] = dest[1].strip()
-                if dest[1].startswith('#-'):
-                    offset = hex_bi(dest[1][2:], width=8)
-                    header = BI_MAP.get('ls_prefix') +BI_MAP.get('imm') + BI_MAP.get('ls_P') + BI_MAP.get('ls_sub') + bwl 
-                elif dest[1].startswith('#'):
-                    offset = hex_bi(dest[1][1:], width=8)
-                    header = BI_MAP.get('ls_prefix') +BI_MAP.get('imm') + BI_MAP.get('ls_P') + BI_MAP.get('ls_add') + bwl 
-                else:
-                    raise ValueError(f"Invalid ldr instruction in line {line}: {write_line}")
-            elif label_map.get(data) is not None:
-                rn = REGS_MAP.get('r0') #use r0 as the base register
-                offset = hex_bi(f'{label_map.get(data)}', width=8)
-                header = BI_MAP.get('ls_prefix') +BI_MAP.get('imm') + BI_MAP.get('ls_P') + BI_MAP.get('ls_add') + bwl
-            else:
-                raise ValueError(f"Invalid ldr instruction in line {line}: {write_line}")
-            upcode = f'{BI_MAP.get("con_process")}{header}'
-            rot = ROT
-            offset = rot + offset
-            # add a WB
-            if re.search(r'!\s*$', data):
-                reg_name = dest[0].strip() # Get the raw string 
-                imm_val = dest[1].strip()  # Get the raw offset 
-    
-                if imm_val.startswith('#-'):
-                    w_l = f'sub {reg_name}, {reg_name}, #{imm_val[2:]}'
-                else:
-                    w_l = f'add {reg_name}, {reg_name}, {imm_val}'
-                
-                pipe_instr.extend(arm_2_pipeline(w_l, line, NOP_NUM)) 
-                offset = '0000' + '00000000' # we have write back to the base register, so the offset is 0 now
-            
-            
-            hex_instr = build_instr(upcode, rn, rd, offset, line)
-        
-        elif instr_decode[0] == 'mov':
-            op, data = write_line.split(maxsplit=1)
-            data = [d.strip() for d in data.split(',')]
-            try :
-                rd = REGS_MAP.get(data[0])
-                if data[1].startswith('#'):
-                    rt = hex_bi(data[1][1:], width=8)
-                    rn = '0000' # q: really connect rn to mov instruction?
-                    r_ctrl = BI_MAP.get('imm')
-                    offset = rt
-                else:
-                    r_ctrl = BI_MAP.get('reg')
-                    rt = REGS_MAP.get(data[0])
-                    offset = '0000' + rt
-                    rn = '0000' # q: really connect rn to mov instruction?
-            except Exception:
-                raise ValueError(f"Invalid sub instruction in line {line}: {write_line}")
-            cmd = BI_MAP.get('MOV')
-            # if data[0] == 'sp' or data[0] == 'fp' or data[0] == 'ip': #then we substract
-            #     cmd = BI_MAP.get('ADD')
-            #     rt = hex_bi(int(rt, 2) // 4, width=8)
-            # else:
-            #     cmd = BI_MAP.get('SUB')
-            upcode = f'{BI_MAP.get("con_process")}{BI_MAP.get("process_prefix")}{r_ctrl}{cmd}{BI_MAP.get("S")}'
-            rot = ROT
-            offset = rot + offset
-            hex_instr = build_instr(upcode, rn, rd, offset, line)
-        
-        elif instr_decode[0] == 'ldmia' or instr_decode[0] == 'ldm':
-            op, rn, data = write_line.split(maxsplit=2)
-            rn = rn.replace(',', '')
-            if re.search('!', rn):
-                rn = rn.replace('!', '')
-                write_back = True
-            else:
-                write_back = False
-            rn = rn.strip()
-            regs = []
-            match = re.search(r'\{([^}]+)\}', data)
-            if match:
-                regs.append(match.group(1).split(','))    # [['r0', 'r1', 'r2'']]
-            else:
-                raise ValueError(f"Invalid push instruction in line {line}: {write_line}")
-            for i in range(len(regs[0])):
-                reg = regs[0][i]
-                reg = reg.strip()
-                offset = i*4
-                w_l = f'ldr {reg}, [{rn}, #{offset}]'
-                pipe_instr.extend(arm_2_pipeline(w_l, line, NOP_NUM))
-            if write_back:
-                w_l = f'add {rn}, {rn}, #{len(regs[0])*4}'
-                pipe_instr.extend(arm_2_pipeline(w_l, line, NOP_NUM))  #ADD PC in inner instrution
-            return pipe_instr
-        
-        elif instr_decode[0] == 'str':
-            op, rd, data = write_line.split(maxsplit=2)
-            # NOP_NUM = 0
-            rd = rd.replace(',', '').strip()
-            rd = REGS_MAP.get(rd)
-            data = data.strip()
-            match = re.search(r'\[([^\]]+)\]', data)
-            if re.search(r'!\s*$', data):
-                bwl = BI_MAP.get('S_BWL')
-            else:
-                bwl = BI_MAP.get('S_BNWL')
-            dest = []
-            if match:
-                dest = match.group(1).split(',')  # get the destination register
-                rn = REGS_MAP.get(dest[0].strip())
-                dest[1] = dest[1].strip()
-                if dest[1].startswith('#-'):
-                    offset = hex_bi(dest[1][2:], width=8)
-                    header = BI_MAP.get('ls_prefix') +BI_MAP.get('imm') + BI_MAP.get('ls_P') + BI_MAP.get('ls_sub') + bwl 
-                elif dest[1].startswith('#'):
-                    offset = hex_bi(dest[1][1:], width=8)
-                    header = BI_MAP.get('ls_prefix') +BI_MAP.get('imm') + BI_MAP.get('ls_P') + BI_MAP.get('ls_add') + bwl 
-                else:
-                    raise ValueError(f"Invalid str instruction in line {line}: {write_line}")
-            elif label_map.get(data) is not None:
-                rn = REGS_MAP.get('r0') #use r0 as the base register
-                offset = hex_bi(label_map.get(data), width=8)
-                header = BI_MAP.get('ls_prefix') +BI_MAP.get('imm') + BI_MAP.get('ls_P') + BI_MAP.get('ls_add') + bwl
-            else:
-                raise ValueError(f"Invalid str instruction in line {line}: {write_line}")
-            upcode = f'{BI_MAP.get("con_process")}{header}'
-
-            rot = ROT
-            offset = rot + offset
-
-            if re.search(r'!\s*$', data):
-                reg_name = dest[0].strip() # Get the raw string 
-                imm_val = dest[1].strip()  # Get the raw offset 
-    
-                if imm_val.startswith('#-'):
-                    w_l = f'sub {reg_name}, {reg_name}, #{imm_val[2:]}'
-                else:
-                    w_l = f'add {reg_name}, {reg_name}, {imm_val}'
-                
-                pipe_instr.extend(arm_2_pipeline(w_l, line, NOP_NUM)) 
-                offset = '0000' + '00000000' # we have write back to the base register, so the offset is 0 now
 
-            
-            hex_instr = build_instr(upcode, rn, rd, offset, line)
-        
-        elif instr_decode[0] == 'stmia' or instr_decode[0] == 'stm':
-            op, rn, data = write_line.split(maxsplit=2)
-            rn = rn.replace(',', '')
-            NOP_NUM = 0
-            if re.search('!', rn):
-                rn = rn.replace('!', '')
-                write_back = True
-            else:
-                write_back = False
-            rn = rn.strip()
-            regs = []
-            match = re.search(r'\{([^}]+)\}', data)
-            if match:
-                regs.append(match.group(1).split(','))    # [['r0', 'r1', 'r2'']]
-            else:
-                raise ValueError(f"Invalid push instruction in line {line}: {write_line}")
-            for i in range(len(regs[0])):
-                reg = regs[0][i]
-                reg = reg.strip()
-                offset = i*4
-                w_l = f'str {reg}, [{rn}, #{offset}]'
-                pipe_instr.extend(arm_2_pipeline(w_l, line, NOP_NUM))
-            if write_back:
-                w_l = f'add {rn}, {rn}, #{len(regs[0])*4}'
-                pipe_instr.extend(arm_2_pipeline(w_l, line, NOP_NUM))  #ADD PC in inner instrution
-            return pipe_instr
-        
-        elif instr_decode[0] == 'lsl':
-            op, data = write_line.split(maxsplit=1)
-            data = [d.strip() for d in data.split(',')]
-            try :
-                rd = REGS_MAP.get(data[0])
-                rn = REGS_MAP.get(data[1])
-                # if data[2].startswith('#'):
-                #     rt = hex_bi(data[2][1:], width=8)
-                #     r_ctrl = BI_MAP.get('imm')
-                #     offset = rt
-                # else:
-                #     r_ctrl = BI_MAP.get('reg')
-                #     rt = REGS_MAP.get(data[2])
-                #     offset = '0000'+rt
-                if data[2].startswith('#'): #MOV the imm to r8 then use r8
-                    mov_instr = f'mov r8, {data[2]}'
-                    pipe_instr.extend(arm_2_pipeline(mov_instr, line, NOP_NUM))
-                    r_ctrl = BI_MAP.get('reg')
-                    offset = '0000' + REGS_MAP.get('r8')
-                else:
-                    r_ctrl = BI_MAP.get('reg')
-                    rt = REGS_MAP.get(data[2])
-                    offset = '0000'+rt
-            except Exception:
-                raise ValueError(f"Invalid lsl instruction in line {line}: {write_line}")
-            cmd = BI_MAP.get('LSL')
-            upcode = f'{BI_MAP.get("con_process")}{BI_MAP.get("process_prefix")}{r_ctrl}{cmd}{BI_MAP.get("S")}'
-            rot = ROT
-            offset = rot + offset
-            hex_instr = build_instr(upcode, rn, rd, offset, line)
-        
-        elif instr_decode[0] == 'cmp': #we use SLT
-            op, data = write_line.split(maxsplit=1)
-            data = [d.strip() for d in data.split(',')]
-            try :
-                r1 = REGS_MAP.get(data[0])
-                if data[1].startswith('#'):
-                    mov_instr = f'mov r8, {data[1]}'
-                    pipe_instr.extend(arm_2_pipeline(mov_instr, line, NOP_NUM))
-                    r2 = REGS_MAP.get('r8')
-                    # r2 = hex_bi(data[1][1:], width=8)
-                    # r_ctrl = BI_MAP.get('imm')
-                    # offset = r2
-                else:
-                    r2 = REGS_MAP.get(data[1])
-                # if data[2].startswith('#'):
-                #     rt = hex_bi(data[2][1:], width=8)
-                #     r_ctrl = BI_MAP.get('imm')
-                #     offset = rt
-                # else:
-                #     r_ctrl = BI_MAP.get('reg')
-                #     rt = REGS_MAP.get(data[2])
-                #     offset = '0000'+rt
-                r_ctrl = BI_MAP.get('reg')
-                rot = ROT
-            except Exception:
-                raise ValueError(f"Invalid cmp instruction in line {line}: {write_line}")
-            cmd = BI_MAP.get('con_process') + BI_MAP.get('process_prefix') + r_ctrl + BI_MAP.get('SLT') + BI_MAP.get('S')
-            for i in range(2):
-                if i == 0:
-                    rn = r1
-                    rm = r2
-                    rd = SLT_AB  #for bge 
-                    offset = ROT + '0000' +rm                   
-                    hex_instr = build_instr(cmd, rn, rd, offset, line)
-                else:
-                    rn = r2
-                    rm = r1
-                    rd = SLT_BA #for ble
-                    offset = ROT + '0000' +rm
-                    hex_instr = build_instr(cmd, rn, rd, offset, line)
-                pipe_instr.append([f'{command} {PC} {hex_instr}'])
-                PC += 1
-                pipe_line += 1
-                pipe_instr.extend(generic_nops(NOP_NUM)) # we can adjust the number of nops here to make sure the cmp instruction takes 2 PC lines, and we have enough time to write the sign bit to r10 before the next instruction
-            return pipe_instr
-        
-        elif instr_decode[0] == 'bge' or instr_decode[0] == 'ble':
-            jump_label = pc_label_map.get(instr_decode[1]) #this  is  target PC
-            if instr_decode[0] == 'bge':
-                rm = SLT_AB
-            else:
-                rm = SLT_BA
-            rn = REGS_MAP.get('r0')  #for now, we use r7 == 1
-            # mov_instr = f'mov r7, #1'
-            # pipe_instr.extend(arm_2_pipeline(mov_instr, line, NOP_NUM))
-            # rn = REGS_MAP.get('r7')
-
-            if branch_label_map.get(line) is not None:
-                    pc_current = branch_label_map.get(line)[0]
-                    rm = branch_label_map.get(line)[1]
-            else:
-                pc_current = PC
-            if jump_label is not None:                
-                off16 = jump_label - pc_current - 2 #+ 1
-                offset = hex_bi(f'{off16}', width=16, signed=True)
-
-                # off_top = hex_bi (f'{jump_label}', width=32, signed=True)[-9:] # we only need the last 9 bits because the offset is 9 bits, and we will add 0000 in the middle to make it 16 bits
-                # off_top = off_top[-9:-4] # we only use top 5 bits
-                # off_buttom = offset[-4:] # we only use bottom 4 bits
-                # offset = off_top + off_buttom
-                # offset = '0000' + '000' +offset
-
-                header = BI_MAP.get('B_prefix') + BI_MAP.get('BEQ')
-                cmd = f'{BI_MAP.get("con_process")}{header}'
-                hex_instr = build_instr(cmd, rn, rm, offset, line)
-                pipe_instr.append([f'{command} {pc_current} {hex_instr}'])
-                if pc_current != PC:
-                    pass
-                else:
-                    PC += 1
-                    pipe_line += 1
-                    pipe_instr.extend(generic_nops(NOP_NUM))
-            else :
-                pp_current = pipe_line
-                #store the line and PC into NOT_FOUND_LABEL and write 'WAIT FOR EXECUTE' into that line in pipe_instr, we will try to fill in the correct instruction at the end
-                NOT_FOUND_LABEL.append([line, pp_current])
-                branch_label_map[line] = [PC, rm]
-                hex_instr = 'WAIT FOR EXECUTE'
-                pipe_instr.append([f'{command} {pc_current} {hex_instr}'])
-                PC += 1
-                pipe_line += 1
-                pipe_instr.extend(generic_nops(NOP_NUM))
-            
-            
-             # we can adjust the number of nops here to make sure the branch instruction takes 1 PC line, and we have enough time to write back to sp register before the next instruction
-            return pipe_instr
-        
-        elif instr_decode[0] == 'b':
-            jump_label = pc_label_map.get(instr_decode[1]) #this  is  target PC
-            if branch_label_map.get(line) is not None:
-                    pc_current = branch_label_map.get(line)[0]
+def resolve(ins, pc_label_map, label_map, literal_map):
+    # fixup pass: labels -> branch target PC / data address
+    # pc_label_map: .L2 : PC, label_map: .LC0 : dmem address, literal_map: .L8 : .LC0
+    label = ins.label
+    if ins.op in ('b', 'beq', 'bne'):
+        target = pc_label_map.get(label)
+        if target is None:
+            raise ValueError(f"Line {ins.line}: label {label} not found")
+        ins.imm = target
+    elif label in literal_map:
+        # the literal is an address, load it as an immediate
+        value = label_map.get(literal_map[label])
+        if ins.op != 'ldr' or value is None:
+            raise ValueError(f"Line {ins.line}: cannot resolve {ins.op} {label} ({literal_map[label]})")
+        ins.op, ins.cmd, ins.rn, ins.imm = 'dp', 'MOV', 0, value
+    elif label in label_map:
+        ins.rn = 0  #use r0 as the base register
+        ins.imm = label_map[label]
+    else:
+        raise ValueError(f"Line {ins.line}: label {label} not found")
+
+
+def encode(ins, pc):
+    # final pass: Instr -> word, fields packed by isa.encode
+    if ins.op == 'dp':
+        if ins.imm is None:
+            return isa.encode('dp_reg', isa.OPCODES[ins.cmd], ins.rn, ins.rd, ins.rm)
+        return isa.encode('dp_imm', isa.OPCODES[ins.cmd], ins.rn, ins.rd, ins.imm)
+    if ins.op == 'ldr':
+        return isa.encode('mem', not ins.sub, ins.wb, 1, ins.rn, ins.rd, ins.imm)
+    if ins.op == 'str':
+        # W is set the other way round for stores, as it always was
+        return isa.encode('mem', not ins.sub, not ins.wb, 0, ins.rn, ins.rd, ins.imm)
+    if ins.op in ('beq', 'bne'):
+        return isa.encode('beq', isa.BEQ if ins.op == 'beq' else isa.BNE, ins.rn, ins.rm, ins.imm - pc - 2)
+    if ins.op == 'b':
+        return isa.encode('b', 0, ins.imm - pc - 2)
+    if ins.op == 'bx':  #special
+        return isa.encode('bx', ins.rm)
+    if ins.op == 'nop':
+        return isa.NOP
+    raise ValueError(f"Line {ins.line}: cannot encode {ins.op}")
+
+
+class Assembler:
+    # one instance per configuration, every assemble() call starts from empty
+    # label tables so instances (or one shared instance) can be used from
+    # several threads or pickled into a process pool
+    #
+    # NOP_NUM=None: emit the program dense and let hazard.pad put in only the
+    # bubbles the target pipeline needs, otherwise NOP_NUM NOPs after every word
+    # SCHEDULE: reorder each .L block to fill those bubbles before padding
+    # PROMOTE: keep the -O0 [fp, #-N] scalars in free registers (promote.py)
+    # FOLD: do the .LC pool -> stack array copy at load time (fold.py)
+    # COMPACT: one .word per DMEM word, byte offsets scaled to words (layout.py)
+
+    def __init__(self, PC_start = 0, RMEM_START = 0, NOP_NUM = None, target = 'st', SCHEDULE = True, PROMOTE = False,
+                 FOLD = False, COMPACT = False):
+        if target not in hazard.TARGETS:
+            raise ValueError(f"Unknown target {target}")
+        self.PC_start = PC_start
+        self.RMEM_START = RMEM_START
+        self.NOP_NUM = NOP_NUM
+        self.target = target
+        self.SCHEDULE = SCHEDULE
+        self.PROMOTE = PROMOTE
+        self.FOLD = FOLD
+        self.COMPACT = COMPACT
+
+    def assemble(self, ALLWRITE):
+        # ALLWRITE: source lines, plain strings or [line] as read by main()
+        hazard_aware = self.NOP_NUM is None
+        if self.PROMOTE:
+            ALLWRITE = promote.promote(ALLWRITE)[0]
+        NOP_NUM = 0 if hazard_aware else self.NOP_NUM
+        step = 1 if self.COMPACT else 4
+        dmem_address = self.RMEM_START
+        label_map = {}      # .LC0 : dmem address
+        literal_map = {}    # .L8 : .LC0, ldr r3, .L8 puts the address of .LC0 into r3
+        pc_label_map = {}   # .L2 : PC of the first word translated from the line after .L2
+
+        program = []
+        #reset all regs to 0
+        for reg in REGS_MAP.keys():
+            program.append(Instr('dp', -1, 0, 'MOV', rd=REG_NUM[reg], imm=0))
+        if not hazard_aware:
+            # we can adjust the number of nops here to make sure we have enough time to write back to sp register before the next instruction
+            program.extend(Instr('nop', -1) for i in range(5))
+        prologue = len(program)
+
+        # pass 1: parse and lower every line once, collect labels and data
+        dmem = []
+        code_labels = {}    # .L2 : index of its first word in program
+        fixups = []         # indexes of words waiting for a label
+        pending = []        # labels seen, not yet attached to code or data
+        flags = None        # operands of the last cmp, for the b<cond> after it
+        for line in range(len(ALLWRITE)):
+            entry = ALLWRITE[line]
+            text = (entry[0] if isinstance(entry, list) else entry).strip()
+            if not text:
+                continue
+            if text.endswith(':'):
+                pending.append(text[:-1])
+                continue
+            if text.startswith('.'):
+                parts = text.split()
+                if parts[0] == '.word':
+                    if len(parts) < 2:
+                        raise ValueError(f"Invalid instruction in line {line}: {text}")
+                    try:
+                        value = int(de_hex(parts[1]), 16) & 0xFFFFFFFFFFFFFFFF
+                    except ValueError:
+                        for name in pending:
+                            literal_map[name] = parts[1]
+                    else:
+                        for name in pending:
+                            label_map[name] = dmem_address
+                        dmem.append((dmem_address, value))
+                        dmem_address += step
+                    pending = []
+                continue
+
+            parts = text.split(maxsplit=1)
+            args = parts[1] if len(parts) > 1 else ''
+            if parts[0] == 'cmp':
+                # no words, its labels go to the b<cond> words
+                flags = parse_cmp(args, line)
+                continue
+            lower = LOWER.get(parts[0])
+            if lower is None:
+                raise ValueError(f"Unknown command: {parts[0]}")
+            for name in pending:
+                code_labels[name] = len(program)
+            pending = []
+            start = len(program)
+            if parts[0] in COND_BRANCHES:
+                lower(program, parts[0], args, line, NOP_NUM, flags)
             else:
-                pc_current = PC
-            if jump_label is not None:               
-                off16 = jump_label - pc_current - 2 #+1             
-                offset = hex_bi(f'{off16}', width=9, signed=True)
-
-                # off_top = hex_bi ( f'{jump_label}', width=32, signed=True)[-9:] # we only need the last 9 bits because the offset is 9 bits, and we will add 0000 in the middle to make it 16 bits
-                # off_top = off_top[-9:-4] # we only use top 5 bits
-                # off_buttom = offset[-4:] # we only use bottom 4 bits
-                # offset = off_top + off_buttom
-
-                offset = '0000' + '000' +offset
-                rn = '0000'
-                rd = '0000'
-                header = BI_MAP.get('B_prefix') + BI_MAP.get('B')
-                cmd = f'{BI_MAP.get("con_process")}{header}'
-                hex_instr = build_instr(cmd, rn, rd, offset, line)
-                pipe_instr.append([f'{command} {pc_current} {hex_instr}'])
-                if pc_current != PC:
-                    pass
+                lower(program, parts[0], args, line, NOP_NUM)
+                flags = None
+            fixups.extend(i for i in range(start, len(program)) if program[i].label is not None)
+        for name in pending:
+            code_labels[name] = len(program)
+
+        unscaled = []
+        raw = []
+        if self.COMPACT:
+            raw = layout.compact(program, prologue, code_labels, literal_map)
+            unscaled = sorted({program[i].line for i in raw})
+        fixed = layout.fixed_words(program, prologue, code_labels, raw)
+        depth = layout.stack_depth(program, code_labels)
+        shift = layout.data_shift(fixed, self.RMEM_START, dmem_address, depth, step)
+        if shift:
+            # a load / store names a word by index where the data would go
+            label_map = {name: addr + shift for name, addr in label_map.items()}
+            dmem = [(addr + shift, value) for addr, value in dmem]
+            dmem_address += shift
+
+        placed = []
+        if self.FOLD:
+            gone, placed = fold.fold_copies(program, prologue, code_labels, dmem, label_map, literal_map)
+            if gone:
+                # renumber what points into program, a label on a dropped
+                # word moves to the word after it
+                shift = [0] * (len(program) + 1)
+                for i in range(len(program)):
+                    shift[i + 1] = shift[i] + (i in gone)
+                program = [ins for i, ins in enumerate(program) if i not in gone]
+                code_labels = {name: i - shift[i] for name, i in code_labels.items()}
+                fixups = [i - shift[i] for i in fixups if i not in gone]
+                dmem.extend(placed)
+
+        # immediates imm8 cannot carry: a short sequence or a pool word after
+        # the data, whichever the target runs faster (materialize.py)
+        pool = materialize.Pool(dmem_address, layout.DMEM_WORDS - depth, step, fixed)
+        program, index, constants = materialize.materialize(
+            program, prologue, pool, (REG_SCRATCH, REG_SLT), hazard.TARGETS[self.target],
+            None if hazard_aware else NOP_NUM, label_map, literal_map)
+        if constants:
+            code_labels = {name: index[i] for name, i in code_labels.items()}
+            fixups = [i for i, ins in enumerate(program) if ins.label is not None]
+            dmem.extend(pool.words())
+
+        # pass 2: layout
+        pcs = []
+        PC = self.PC_start
+        for ins in program:
+            pcs.append(PC)
+            PC += 1 + ins.nops
+        for name, i in code_labels.items():
+            pc_label_map[name] = pcs[i] if i < len(program) else PC
+
+        # pass 3: fixups, then encode straight into the IMEM image
+        for i in fixups:
+            resolve(program[i], pc_label_map, label_map, literal_map)
+        code = isa.new_image(PC - self.PC_start)
+        for ins, pc in zip(program, pcs):
+            try:
+                code[pc - self.PC_start] = encode(ins, pc)
+            except ValueError as e:
+                raise ValueError(f"Line {ins.line}: {e}")
+
+        symbols = dict(label_map)
+        for name, sym in literal_map.items():
+            if sym in label_map:
+                symbols[name] = label_map[sym]
+        symbols.update(pc_label_map)
+        memory = layout.memory_map(dmem, label_map, placed, depth, step, pool.words(), fixed)
+        data = [[f'dmem_write {addr} {value >> 32:#x} {value & 0xFFFFFFFF:#x}'] for addr, value in dmem]
+        imem = list(enumerate(code, self.PC_start))
+
+        lines = {pc: ins.line for ins, pc in zip(program, pcs)}
+
+        if hazard_aware:
+            leaders = list(pc_label_map.values()) if self.SCHEDULE else None
+            origin = {}
+            imem = hazard.pad_image(imem, self.target, leaders, origin)
+            lines = {pc: lines[old] for pc, old in origin.items()}
+            output = data + [[f'imem_write {pc} {word:#010x}'] for pc, word in imem]
+            return Image(imem, dmem, symbols, output, lines, memory, unscaled, constants)
+
+        # legacy order: reset words, data, program
+        split = pcs[prologue] - self.PC_start if prologue < len(program) else len(code)
+        output = [[f'imem_write {pc} {word:#x}'] for pc, word in imem[:split]]
+        output.extend(data)
+        output.extend([f'imem_write {pc} {word:#x}'] for pc, word in imem[split:])
+        return Image(imem, dmem, symbols, output, lines, memory, unscaled, constants)
+
+
+def line_map(image, ALLWRITE, target='st'):
+    # [Line] for every pc of the image
+    def text(line):
+        entry = ALLWRITE[line]
+        return (entry[0] if isinstance(entry, list) else entry).strip()
+
+    # label of every source line: the function (a label not starting with
+    # '.') and the block it is in, labels of .word data do not count
+    under = []
+    func = block = ''
+    pending = []
+    for line in range(len(ALLWRITE)):
+        t = text(line)
+        if t.endswith(':'):
+            pending.append(t[:-1])
+        elif t.startswith('.'):
+            pending = []
+        elif t:
+            for name in pending:
+                if name.startswith('.'):
+                    block = name
                 else:
-                    PC += 1
-                    pipe_line += 1
-                    pipe_instr.extend(generic_nops(NOP_NUM))
-            else :
-                #store the line and PC into NOT_FOUND_LABEL and write 'WAIT FOR EXECUTE' into that line in pipe_instr, we will try to fill in the correct instruction at the end
-                pp_current = pipe_line
-                NOT_FOUND_LABEL.append([line, pp_current])
-                branch_label_map[line] = [PC, '0000'] #we will fill in the correct PC later, but we know the rm field is 0000 for unconditional jump
-                hex_instr = 'WAIT FOR EXECUTE'
-                pipe_instr.append([f'{command} {pc_current} {hex_instr}'])
-                PC += 1
-                pipe_line += 1
-                pipe_instr.extend(generic_nops(NOP_NUM))           
-            
-             # we can adjust the number of nops here to make sure the unconditional jump instruction takes 1 PC line, and we have enough time to write back to sp register before the next instruction
-            return pipe_instr
-        
-        elif instr_decode[0] == 'bx':  #special
-            rm = REGS_MAP.get(instr_decode[1])
-            cmd = '11100001'
-            rn = '0010'
-            rd = '1111'
-            offset = '11111111' + '0001' + rm
-            hex_instr = build_instr(cmd, rn, rd, offset, line)
-        
-
-            
-
-
-
-            
-            
-            
-
-
-        
-
-
-
-
+                    func, block = name, ''
+            pending = []
+        under.append(':'.join(name for name in (func, block) if name) or '-')
+
+    rows = []
+    for pc, word in image.imem:
+        line = image.lines.get(pc)
+        if line is None:
+            rows.append(Line(pc, None, None, True, ''))
+        elif line < 0:
+            rows.append(Line(pc, 0, '-', False, 'reset'))
         else:
-            raise ValueError(f"Unknown command in line {line}: {instr_decode[0]}")
-            
-
-        pipe_instr.append([f'{command} {PC} {hex_instr}'])
-        PC += 1
-    pipe_line += 1
-    pipe_instr.extend(generic_nops(NOP_NUM))
-    return pipe_instr
+            rows.append(Line(pc, line + 1, under[line], False, text(line)))
+
+    # padding: the shadow of a branch belongs to the branch, other NOPs to the
+    # word after them that waits on a result
+    slots = hazard.shadow_slots(hazard.TARGETS[target])
+    owner = None
+    for i, row in enumerate(rows):
+        if not row.pad:
+            dec = isa.decode(image.imem[i][1])
+            owner = row if dec.is_branch or dec.is_jump else None
+            shadow = slots
+            continue
+        if owner is not None and shadow:
+            shadow -= 1
+            rows[i] = row._replace(line=owner.line, label=owner.label, text=owner.text)
+            continue
+        nxt = next((r for r in rows[i + 1:] if not r.pad), None)
+        if nxt is not None:
+            rows[i] = row._replace(line=nxt.line, label=nxt.label, text=nxt.text)
+        else:
+            rows[i] = row._replace(line=0, label='-')
+    return rows
+
+
+def write_line_map(path, rows):
+    with open(path, 'w') as f:
+        f.write('# pc\tline\tlabel\tpad\tsource   (line: of the .s file, 0: reset prologue)\n')
+        for row in rows:
+            f.write(f"{row.pc}\t{row.line}\t{row.label}\t{'pad' if row.pad else '-'}\t{row.text}\n")
+
+
+def read_line_map(path):
+    # {pc: Line} from write_line_map
+    rows = {}
+    with open(path) as f:
+        for entry in f:
+            if entry.startswith('#') or not entry.strip():
+                continue
+            pc, line, label, pad, text = entry.rstrip('\n').split('\t', 4)
+            rows[int(pc)] = Line(int(pc), int(line), label, pad == 'pad', text)
+    return rows
+
+
+def attribute(counts, rows):
+    # counts {pc: cycles or samples} -> [(line, label, text, count)] per source
+    # line, largest first; pcs the map does not know are counted under line -1
+    per = {}
+    for pc, count in counts.items():
+        row = rows.get(pc)
+        key = (row.line, row.label, row.text) if row is not None else (-1, '?', f'pc {pc}')
+        per[key] = per.get(key, 0) + count
+    return sorted(((line, label, text, n) for (line, label, text), n in per.items()),
+                  key=lambda item: -item[3])
+
+
+def change_logic(ALLWRITE, PC_start = 0, RMEM_START = 0, WORKPLACE_START = 0, NOP_NUM = None, target = 'st', SCHEDULE = True, PROMOTE = False,
+                 FOLD = False, COMPACT = False):
+    # the old entry point, imem_write/dmem_write lines only
+    return Assembler(PC_start, RMEM_START, NOP_NUM, target, SCHEDULE, PROMOTE, FOLD, COMPACT).assemble(ALLWRITE).output
 
 def main():
-    with open('C:\\Users\\irryb\\Desktop\\533\\L6\\pipeline.txt', 'r') as f:
+    parser = argparse.ArgumentParser(description='translate GCC arm output into imem_write/dmem_write commands')
+    parser.add_argument('arm', nargs='?', default='pipeline.txt')
+    parser.add_argument('out', nargs='?', default='pp_output.txt')
+    parser.add_argument('--nops', type=int, default=None, help='fixed NOPs after every word instead of hazard-aware padding')
+    parser.add_argument('--target', choices=sorted(hazard.TARGETS), default='st')
+    parser.add_argument('--no-schedule', action='store_true', help='keep the source order inside each block')
+    parser.add_argument('--promote', action='store_true', help='keep [fp, #-N] scalar slots in free registers')
+    parser.add_argument('--fold', action='store_true', help='place .LC pool copies at their stack address at load time')
+    parser.add_argument('--compact', action='store_true', help='one .word per DMEM word, byte offsets scaled to words')
+    parser.add_argument('--dmem-start', type=lambda n: int(n, 0), default=0,
+                        help='DMEM address of the first .word, apart for each program link.py puts together')
+    parser.add_argument('--mem', help='DMEM memory map, default: next to out as .mem')
+    parser.add_argument('--map', help='pc -> source line map, default: next to out as .map')
+    args = parser.parse_args()
+    with open(args.arm, 'r') as f:
         all_lines = [[line.strip()] for line in f ]
-    output = change_logic(all_lines, PC_start=0, RMEM_START=0, WORKPLACE_START=0, NOP_NUM=4)
-    with open('C:\\Users\\irryb\\Desktop\\533\\L6\\pp_output.txt', 'w') as f:
-        for line in output:
+    image = Assembler(PC_start=0, RMEM_START=args.dmem_start, NOP_NUM=args.nops, target=args.target, SCHEDULE=not args.no_schedule,
+                      PROMOTE=args.promote, FOLD=args.fold, COMPACT=args.compact).assemble(all_lines)
+    print(f' total PC is {len(image.imem)}')
+    if image.constants:
+        forms = {}
+        for line, value, form, words, took in image.constants:
+            forms[form] = forms.get(form, 0) + 1
+        pool = sum(1 for first, last, s, name in image.memory if name == 'pool' for a in range(first, last + 1, s))
+        print(f' {len(image.constants)} wide immediates: '
+              + ', '.join(f'{n} {form}' for form, n in sorted(forms.items()))
+              + f'; +{sum(c[3] for c in image.constants) - len(image.constants)} words,'
+              f' {sum(c[4] for c in image.constants)} cycles, {pool} pool words')
+    for line in image.unscaled:
+        print(f' line {line + 1}: offset not a multiple of 4, kept as a word offset: {all_lines[line][0]}')
+    with open(args.out, 'w') as f:
+        for line in image.output:
             f.write(line[0] + '\n')
+    write_line_map(args.map or os.path.splitext(args.out)[0] + '.map', line_map(image, all_lines, args.target))
+    layout.write_memory_map(args.mem or os.path.splitext(args.out)[0] + '.mem', image.memory, 1 if args.compact else 4)
             
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,192 @@
+import copy
+
+import hazard
+from fold import use_def
+
+# constant materialization for map.py: every dp immediate imm8 cannot carry
+#
+# CTRL_UNIT.v sign-extends imm8 and pipeline_arm.v zero-extends it, so only
+# 0..127 mean the same on both; anything else (mov r3, #1000, add r3, r3, #-4,
+# cmp r3, #200, a literal address from 128 up) is rewritten here into the
+# cheapest of
+#
+#   one word    sub r3, r0, #4 for -4, add <-> sub for a negative operand
+#   split       mov r3, #127 / add r3, r3, #73 for 128..254 (and negated)
+#   sequence    base 128 digits: mov r3, #d0 / mov r8, #7 / lsl r3, r3, r8 /
+#               orr r3, r3, #d1 .., mvn r3, r3 at the end for a negative value
+#   pool        ldr r3, [r0, #addr] from a DMEM word after the data, one word
+#               per distinct value, past the words a load / store names by
+#               index (layout.fixed_words)
+#
+# weighed in cycles by hazard.raw_gap for the target (the words of a sequence
+# wait on each other), then IMEM words, then DMEM words.  a load is forwarded
+# no later than an ALU result on this core, so the pool wins over anything of
+# two words or more; the splits and sequences are what is left when the pool
+# would run into the stack.  an operand of add / sub / orr .. is built in r8
+# (r10 when r8 is the operand) and the word takes it as a register
+
+IMM_SAFE = 128
+DIGIT = 7                   # bits per sequence digit
+MASK64 = (1 << 64) - 1
+
+
+def signed64(value):
+    value &= MASK64
+    return value - (1 << 64) if value >> 63 else value
+
+
+class Pool:
+    # DMEM words for the constants, from start up to (not including) end,
+    # passing over the words in avoid (layout.fixed_words)
+    def __init__(self, start, end, step, avoid=()):
+        self.avoid = set(avoid)
+        self.step = step
+        self.next = self.free(start)
+        self.end = end
+        self.at = {}            # value -> addr
+
+    def free(self, addr):
+        while addr in self.avoid:
+            addr += self.step
+        return addr
+
+    def room(self, value):
+        return value in self.at or self.next < self.end
+
+    def place(self, value):
+        if value not in self.at:
+            self.at[value] = self.next
+            self.next = self.free(self.next + self.step)
+        return self.at[value]
+
+    def words(self):
+        return sorted((addr, value) for value, addr in self.at.items())
+
+
+def word(ins, **fields):
+    # a copy of ins (line, nops) with fields set, the rest cleared
+    new = copy.copy(ins)
+    new.rd, new.rn, new.rm, new.imm, new.sub, new.wb, new.label = 0, 0, 0, None, False, False, None
+    for name, value in fields.items():
+        setattr(new, name, value)
+    return new
+
+
+def digits(value):
+    # base 2**DIGIT digits of value >= 0, most significant first
+    out = []
+    while True:
+        out.append(value & (IMM_SAFE - 1))
+        value >>= DIGIT
+        if not value:
+            return out[::-1]
+
+
+def sequence(ins, rd, value, shift):
+    # rd = value with words that only need imm8 < 128, shift: a free register
+    if value < 0:
+        return sequence(ins, rd, ~value, shift) + [word(ins, op='dp', cmd='MVN', rd=rd, rm=rd)]
+    first, *rest = digits(value)
+    out = [word(ins, op='dp', cmd='MOV', rd=rd, imm=first)]
+    if rest:
+        out.append(word(ins, op='dp', cmd='MOV', rd=shift, imm=DIGIT))
+    for d in rest:
+        out.append(word(ins, op='dp', cmd='LSL', rd=rd, rn=rd, rm=shift))
+        if d:
+            out.append(word(ins, op='dp', cmd='ORR', rd=rd, rn=rd, imm=d))
+    return out
+
+
+def candidates(ins, rd, value, shift, pool):
+    # [(form, words, pool value or None)] building rd = value
+    out = []
+    if 0 <= value < IMM_SAFE:
+        out.append(('imm8', [word(ins, op='dp', cmd='MOV', rd=rd, imm=value)], None))
+    elif -IMM_SAFE < value < 0:
+        out.append(('imm8', [word(ins, op='dp', cmd='SUB', rd=rd, imm=-value)], None))
+    top = IMM_SAFE - 1
+    if IMM_SAFE <= value < 2 * top:
+        out.append(('split', [word(ins, op='dp', cmd='MOV', rd=rd, imm=top),
+                              word(ins, op='dp', cmd='ADD', rd=rd, rn=rd, imm=value - top)], None))
+    elif -2 * top < value <= -IMM_SAFE:
+        out.append(('split', [word(ins, op='dp', cmd='SUB', rd=rd, imm=top),
+                              word(ins, op='dp', cmd='SUB', rd=rd, rn=rd, imm=-value - top)], None))
+    out.append(('sequence', sequence(ins, rd, value, shift), None))
+    if pool is not None and pool.room(value & MASK64):
+        out.append(('pool', [word(ins, op='ldr', rd=rd, imm=0)], value & MASK64))
+    return out
+
+
+def cycles(words, issue, nops):
+    # cycles the words take on their own: each waits raw_gap words behind the
+    # word it reads, fixed NOP_NUM padding when nops is not None
+    if nops is not None:
+        return len(words) * (1 + nops) * issue
+    gap = hazard.raw_gap(issue)
+    ready = {}
+    slot = 0
+    for ins in words:
+        use, define = use_def(ins)
+        at = max([slot] + [ready[r] for r in use if r in ready])
+        for r in define:
+            ready[r] = at + gap
+        slot = at + 1
+    return slot * issue
+
+
+def cheapest(ins, rd, value, shift, pool, issue, nops):
+    # -> (form, words, cycles) with pool words placed
+    best = None
+    for form, words, pooled in candidates(ins, rd, value, shift, pool):
+        cost = (cycles(words, issue, nops), len(words), pooled is not None and pooled not in pool.at)
+        if best is None or cost < best[0]:
+            best = (cost, form, words, pooled)
+    cost, form, words, pooled = best
+    if pooled is not None:
+        words[0].imm = pool.place(pooled)
+    return form, words, cost[0]
+
+
+def wide(ins):
+    return ins.op == 'dp' and ins.imm is not None and not 0 <= ins.imm < IMM_SAFE
+
+
+def materialize(program, start, pool, temps, issue, nops=None, label_map=None, literal_map=None):
+    # -> (program, index, report): program with every wide immediate from start
+    # on rewritten, index[i] the new index of old word i (len(program) + 1
+    # entries), report [(line, value, form, words, cycles)]
+    # temps: (scratch, spare) registers the rewrite may write, r8 and r10
+    out = program[:start]
+    index = list(range(start))
+    report = []
+    for ins in program[start:]:
+        index.append(len(out))
+        if ins.op == 'ldr' and ins.label in (literal_map or {}):
+            # ldr r3, .L8 becomes mov r3, #address in the fixup pass
+            addr = label_map.get(literal_map[ins.label])
+            if addr is not None and not 0 <= addr < IMM_SAFE:
+                ins = word(ins, op='dp', cmd='MOV', rd=ins.rd, imm=addr)
+        if not wide(ins):
+            out.append(ins)
+            continue
+        value = signed64(ins.imm)
+        if ins.cmd in ('ADD', 'SUB') and -IMM_SAFE < value < 0:
+            out.append(word(ins, op='dp', cmd='SUB' if ins.cmd == 'ADD' else 'ADD', rd=ins.rd, rn=ins.rn, imm=-value))
+            report.append((ins.line, value, 'imm8', 1, issue if nops is None else (1 + nops) * issue))
+            continue
+        if ins.cmd == 'MOV':
+            rd = ins.rd
+            shift = temps[0] if rd != temps[0] else temps[1]
+            tail = []
+        else:
+            # build the operand in a temp, the word reads it as rm
+            rd = temps[0] if ins.rn != temps[0] else temps[1]
+            shift = temps[1] if rd == temps[0] else temps[0]
+            if ins.rn == shift:
+                raise ValueError(f"Line {ins.line}: no free register for #{value}")
+            tail = [word(ins, op='dp', cmd=ins.cmd, rd=ins.rd, rn=ins.rn, rm=rd)]
+        form, words, took = cheapest(ins, rd, value, shift, pool, issue, nops)
+        out.extend(words + tail)
+        report.append((ins.line, value, form, len(words + tail), took))
+    index.append(len(out))
+    return out, index, report
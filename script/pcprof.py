@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import hazard
+import isa
+import link
+import map
+import pipereg
+
+# statistical pc profile of a program running on the board: PIPE_PC_DBG_REG
+# read back to back in batches over one register channel while the program
+# runs, a histogram per pc (per thread on the mt bitfile, thread = pc[8:7])
+# and a flat profile per .s line through map.py's line map
+#
+#   PIPEREG='coproc:ssh netfpga python3 pipereg.py --backend ioctl serve' \
+#       python pcprof.py pp_output.txt --lines pp_output.map
+#   python pcprof.py image.txt mt --attach --samples 500000 --json prof.json
+#
+# the register holds the fetch address (pc of pipeline_arm.v, imem_addr_mux
+# of pipiline_arm_mt.v), a few words ahead of EX; map.py's line map charges
+# padding to the word that waits for it, so a sample on the NOPs in front of
+# a word counts for that word.  ioctl and coproc backends keep one channel
+# open, cmd forks regread per sample and is only good for a rough look
+
+BATCH = 1024            # reads per transact
+SAMPLES = 100000
+SECONDS = 30
+
+
+def sample(regs, samples=SAMPLES, seconds=SECONDS, halts=None, batch=BATCH):
+    # pc histogram over IMEM, until samples are taken, seconds have passed or
+    # every thread was seen on its halt word -> (hist, samples, seconds)
+    hist = np.zeros(isa.PC_MASK + 1, dtype=np.int64)
+    waiting = [set(pcs) for pcs in (halts or [])]
+    taken = 0
+    start = time.monotonic()
+    while taken < samples and time.monotonic() - start < seconds:
+        pcs = np.array(regs.sample_pc(min(batch, samples - taken)), dtype=np.int64) & isa.PC_MASK
+        hist += np.bincount(pcs, minlength=len(hist))
+        taken += len(pcs)
+        if waiting:
+            seen = set(np.flatnonzero(hist).tolist())
+            waiting = [pcs for pcs in waiting if not pcs & seen]
+            if not waiting:
+                break
+    return hist, taken, time.monotonic() - start
+
+
+def flat(hist, lines=None, imem=None):
+    # [(samples, line, label, text)] largest first, per line of the line map
+    # or, without one, per pc with its word
+    counts = {pc: int(n) for pc, n in enumerate(hist) if n}
+    if lines is not None:
+        return [(n, line, label, text) for line, label, text, n in map.attribute(counts, lines)]
+    words = dict(imem or [])
+    return sorted(((n, pc, '-', f'{words.get(pc, isa.NOP):#010x}') for pc, n in counts.items()),
+                  key=lambda row: -row[0])
+
+
+def profile(hist, target='st', lines=None, imem=None):
+    # {'threads': [{'samples': .., 'rows': flat()}]}, one thread for st
+    threads = hazard.THREADS if target == 'mt' else 1
+    size = len(hist) // threads
+    out = []
+    for k in range(threads):
+        part = np.zeros_like(hist)
+        part[k * size:(k + 1) * size] = hist[k * size:(k + 1) * size]
+        out.append({'thread': k, 'samples': int(part.sum()), 'rows': flat(part, lines, imem)})
+    return {'target': target, 'by': 'pc' if lines is None else 'line', 'samples': int(hist.sum()), 'threads': out}
+
+
+def table(prof, top=20):
+    lines = []
+    for thread in prof['threads']:
+        if not thread['samples']:
+            continue
+        head = f"thread {thread['thread']}: " if prof['target'] == 'mt' else ''
+        lines.append(f"{head}{thread['samples']} samples")
+        lines.append(f"{'samples':>10} {'%':>6}  {prof['by']:>5}  {'label':12} source")
+        for n, line, label, text in thread['rows'][:top]:
+            lines.append(f'{n:>10} {100 * n / thread["samples"]:6.2f}  {line:>5}  {label:12} {text}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sample PIPE_PC_DBG_REG into a pc / source line profile')
+    parser.add_argument('image', help='map.py/link.py output the board runs')
+    parser.add_argument('target', nargs='?', default='st', choices=('st', 'mt'))
+    parser.add_argument('--lines', help='map.py line map (.map), default: next to the image if there')
+    parser.add_argument('--backend', default=pipereg.PIPEREG_SPEC, help='cmd | ioctl | fake | coproc:<server command>')
+    parser.add_argument('--attach', action='store_true', help='sample what is running, do not load and start')
+    parser.add_argument('--samples', type=int, default=SAMPLES)
+    parser.add_argument('--seconds', type=float, default=SECONDS)
+    parser.add_argument('--batch', type=int, default=BATCH)
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--json', help='write the profile here as JSON')
+    parser.add_argument('--hist', help='write the raw pc histogram here (.npy)')
+    args = parser.parse_args()
+
+    imem, dmem = link.read_image(args.image)
+    path = args.lines or os.path.splitext(args.image)[0] + '.map'
+    lines = map.read_line_map(path) if os.path.exists(path) else None
+
+    regs = pipereg.connect(args.backend)
+    if not args.attach:
+        regs.run(0)
+        regs.load([f'dmem_write {addr} {value >> 32:#x} {value & 0xFFFFFFFF:#x}' for addr, value in dmem.items()]
+                  + [f'imem_write {pc} {word:#x}' for pc, word in imem])
+        regs.pcreset()
+        regs.run(1)
+    try:
+        hist, taken, took = sample(regs, args.samples, args.seconds, pipereg.halt_pcs(imem, args.target), args.batch)
+    finally:
+        if not args.attach:
+            regs.run(0)
+        regs.close()
+
+    print(f'{taken} samples in {took:.3f} s ({taken / max(took, 1e-9):,.0f}/s)'
+          + ('' if lines else f', no line map at {path}'))
+    prof = profile(hist, args.target, lines, imem)
+    print(table(prof, args.top))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(prof, f, indent=2)
+    if args.hist:
+        np.save(args.hist, hist)
+
+
+if __name__ == "__main__":
+    main()
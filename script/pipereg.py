@@ -0,0 +1,504 @@
+import argparse
+import os
+import re
+import shlex
+import struct
+import subprocess
+import sys
+
+# register access for pipeline_top_regs.v, the python side of pipereg.pl
+#
+# pipereg.pl forks regwrite/regread for every register access and reads
+# PIPE_CTRL_REG back before every bit change.  here one backend stays open for
+# the whole session, PIPE_CTRL_REG is only ever written (a shadow copy holds
+# its value) and IMEM/DMEM loads go out as one batch:
+#
+#   regs = PipeRegs(CoprocessBackend('ssh netfpga python3 pipereg.py serve'))
+#   regs.write_imem(image)              # [word, ...] from address 0
+#   regs.write_dmem(values, start=0)    # 64 bit values
+#   regs.pcreset(); regs.run(1)
+#
+# backends: CmdBackend (regwrite/regread per access, like pipereg.pl),
+# IoctlBackend (the nf2 driver directly, what regwrite does inside),
+# CoprocessBackend (a long lived `pipereg.py serve` reached over a pipe, e.g.
+# through ssh) and FakeBackend (in-memory model of pipeline_top_regs.v)
+#
+# the tools on the control machine (run.py, pcprof.py, steptrace.py,
+# regress.py) reach the board through connect(), the backend named by $PIPEREG:
+#   PIPEREG='coproc:ssh netfpga python3 pipereg.py --backend ioctl serve'
+
+PIPE_BASE = 0x2000240
+#SW regs
+PIPE_CTRL_REG          = PIPE_BASE + 0x0
+PIPE_IMEM_ADDR_REG     = PIPE_BASE + 0x4
+PIPE_IMEM_WDATA_REG    = PIPE_BASE + 0x8
+PIPE_DMEM_ADDR_REG     = PIPE_BASE + 0xc
+PIPE_DMEM_WDATA_LO_REG = PIPE_BASE + 0x10
+PIPE_DMEM_WDATA_HI_REG = PIPE_BASE + 0x14
+PIPE_RESERVED_REG      = PIPE_BASE + 0x18
+#HW dbg regs
+PIPE_PC_DBG_REG        = PIPE_BASE + 0x1c
+PIPE_IF_INSTR_REG      = PIPE_BASE + 0x20
+PIPE_DMEM_RDATA_LO_REG = PIPE_BASE + 0x24
+PIPE_DMEM_RDATA_HI_REG = PIPE_BASE + 0x28
+
+# CTRL bits
+CTRL_RUN      = 0     # run_level
+CTRL_STEP     = 1     # step_pulse     (rising edge)
+CTRL_PCRESET  = 2     # pc_reset_pulse (rising edge)
+CTRL_IMEM_WE  = 3     # imem_we_pulse  (rising edge)
+CTRL_DMEM_EN  = 4     # dmem_prog_en
+CTRL_DMEM_WE  = 5     # dmem_prog_we
+
+IMEM_WORDS = 512
+DMEM_WORDS = 256
+
+# a batch is a list of ('w', addr, value) / ('r', addr), transact() returns
+# the values of the reads in order
+
+
+def parse_addr(text):
+    # as pipereg.pl: 0x.. is hex, anything else decimal
+    return int(text, 16) if text.lower().startswith('0x') else int(text)
+
+
+class Backend:
+    def read(self, addr):
+        raise NotImplementedError
+
+    def write(self, addr, value):
+        raise NotImplementedError
+
+    def transact(self, ops):
+        values = []
+        for op in ops:
+            if op[0] == 'w':
+                self.write(op[1], op[2])
+            else:
+                values.append(self.read(op[1]))
+        return values
+
+    def close(self):
+        pass
+
+
+class CmdBackend(Backend):
+    # regwrite/regread, one process per access, prefix e.g. 'ssh netfpga'
+    def __init__(self, prefix=''):
+        self.prefix = shlex.split(prefix)
+
+    def write(self, addr, value):
+        subprocess.run(self.prefix + ['regwrite', f'0x{addr:08x}', f'0x{value:08x}'], check=True,
+                       stdout=subprocess.DEVNULL)
+
+    def read(self, addr):
+        out = subprocess.run(self.prefix + ['regread', f'0x{addr:08x}'], check=True,
+                             capture_output=True, text=True).stdout
+        # OUTPUT: Reg 0xADDR (DEC): 0xVALUE (DEC)
+        match = re.search(r'Reg (0x[0-9a-f]+) \((\d+)\):\s+(0x[0-9a-f]+) \((\d+)\)', out, re.I)
+        if match is None:
+            raise ValueError(f"regread 0x{addr:08x}: {out.strip()}")
+        return int(match.group(3), 16)
+
+
+class IoctlBackend(Backend):
+    # the SIOCREGREAD/SIOCREGWRITE ioctls regread/regwrite use (nf2util.c)
+    SIOCREGREAD = 0x89F0
+    SIOCREGWRITE = 0x89F1
+
+    def __init__(self, ifname='nf2c0'):
+        import ctypes
+        import fcntl
+        import socket
+        self.fcntl = fcntl
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.reg = (ctypes.c_uint32 * 2)()      # struct nf2reg {reg, val}
+        self.ifreq = bytearray(40)              # struct ifreq {ifr_name[16], ifr_data}
+        name = ifname.encode()
+        self.ifreq[:len(name)] = name
+        struct.pack_into('P', self.ifreq, 16, ctypes.addressof(self.reg))
+
+    def _ioctl(self, request, addr, value=0):
+        self.reg[0] = addr
+        self.reg[1] = value
+        self.fcntl.ioctl(self.sock.fileno(), request, self.ifreq)
+        return self.reg[1]
+
+    def write(self, addr, value):
+        self._ioctl(self.SIOCREGWRITE, addr, value)
+
+    def read(self, addr):
+        return self._ioctl(self.SIOCREGREAD, addr)
+
+    def close(self):
+        self.sock.close()
+
+
+class FakeBackend(Backend):
+    # pipeline_top_regs.v without the pipeline: programming pulses, DMEM port B,
+    # a step moves the fetch address on by one
+    def __init__(self):
+        self.regs = {}
+        self.imem = [0] * IMEM_WORDS
+        self.dmem = [0] * DMEM_WORDS
+        self.pc = 0
+        self.reads = 0
+        self.writes = 0
+
+    def _dmem_port(self):
+        ctrl = self.regs.get(PIPE_CTRL_REG, 0)
+        if (ctrl >> CTRL_DMEM_EN) & 1 and (ctrl >> CTRL_DMEM_WE) & 1:
+            addr = self.regs.get(PIPE_DMEM_ADDR_REG, 0) & 0xFF
+            self.dmem[addr] = (self.regs.get(PIPE_DMEM_WDATA_HI_REG, 0) << 32) | self.regs.get(PIPE_DMEM_WDATA_LO_REG, 0)
+
+    def write(self, addr, value):
+        self.writes += 1
+        value &= 0xFFFFFFFF
+        old = self.regs.get(addr, 0)
+        self.regs[addr] = value
+        if addr == PIPE_CTRL_REG:
+            rise = value & ~old
+            if (rise >> CTRL_IMEM_WE) & 1:
+                self.imem[self.regs.get(PIPE_IMEM_ADDR_REG, 0) & 0x1FF] = self.regs.get(PIPE_IMEM_WDATA_REG, 0)
+            if (rise >> CTRL_PCRESET) & 1:
+                self.pc = 0
+            if (rise >> CTRL_STEP) & 1:
+                self.pc = (self.pc + 1) % IMEM_WORDS
+        # dmem_prog_we is a level, every cycle it is high writes port B
+        self._dmem_port()
+
+    def read(self, addr):
+        self.reads += 1
+        if addr == PIPE_PC_DBG_REG:
+            return self.pc
+        if addr == PIPE_IF_INSTR_REG:
+            return self.imem[self.pc]
+        value = self.dmem[self.regs.get(PIPE_DMEM_ADDR_REG, 0) & 0xFF]
+        if addr == PIPE_DMEM_RDATA_LO_REG:
+            return value & 0xFFFFFFFF
+        if addr == PIPE_DMEM_RDATA_HI_REG:
+            return value >> 32
+        return self.regs.get(addr, 0)
+
+
+class CoprocessBackend(Backend):
+    # a `pipereg.py serve` process, requests are pipelined:
+    #   w <addr> <value>    no reply
+    #   r <addr>            reply <value>
+    # replies are drained every CHUNK reads so neither pipe fills up
+    CHUNK = 1024
+
+    def __init__(self, cmd):
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def _reply(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError(f"register server exited ({self.proc.poll()})")
+        return int(line, 16)
+
+    def transact(self, ops):
+        values = []
+        lines = []
+        pending = 0
+        for op in ops:
+            if op[0] == 'w':
+                lines.append(f'w {op[1]:x} {op[2]:x}\n')
+            else:
+                lines.append(f'r {op[1]:x}\n')
+                pending += 1
+                if pending == self.CHUNK:
+                    self.proc.stdin.write(''.join(lines))
+                    self.proc.stdin.flush()
+                    lines = []
+                    values.extend(self._reply() for i in range(pending))
+                    pending = 0
+        self.proc.stdin.write(''.join(lines))
+        self.proc.stdin.flush()
+        values.extend(self._reply() for i in range(pending))
+        return values
+
+    def write(self, addr, value):
+        self.transact([('w', addr, value)])
+
+    def read(self, addr):
+        return self.transact([('r', addr)])[0]
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.write('q\n')
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+def serve(backend, fin=sys.stdin, fout=sys.stdout):
+    # the other end of CoprocessBackend
+    for line in fin:
+        parts = line.split()
+        if not parts:
+            continue
+        if parts[0] == 'w':
+            backend.write(int(parts[1], 16), int(parts[2], 16))
+        elif parts[0] == 'r':
+            fout.write(f'{backend.read(int(parts[1], 16)):x}\n')
+            fout.flush()
+        elif parts[0] == 'q':
+            break
+        else:
+            raise ValueError(f"Unknown request: {line.strip()}")
+
+
+class PipeRegs:
+    def __init__(self, backend, ctrl=None):
+        # ctrl: known PIPE_CTRL_REG value, read once from the board otherwise
+        self.backend = backend
+        self.ctrl = backend.read(PIPE_CTRL_REG) if ctrl is None else ctrl
+
+    def close(self):
+        self.backend.close()
+
+    # ---- PIPE_CTRL_REG, from the shadow copy ----
+
+    def _ctrl_ops(self, value):
+        self.ctrl = value
+        return [('w', PIPE_CTRL_REG, value)]
+
+    def _set_ops(self, bit, val):
+        value = self.ctrl | (1 << bit) if val else self.ctrl & ~(1 << bit)
+        return self._ctrl_ops(value) if value != self.ctrl else []
+
+    def _pulse_ops(self, bit):
+        # rising edge: low (only if it was left high), high, low
+        return self._set_ops(bit, 0) + self._set_ops(bit, 1) + self._set_ops(bit, 0)
+
+    def set_bit(self, bit, val):
+        self.backend.transact(self._set_ops(bit, val))
+
+    def pulse(self, bit):
+        self.backend.transact(self._pulse_ops(bit))
+
+    def run(self, on=1):
+        self.set_bit(CTRL_RUN, on)
+
+    def step(self):
+        self.pulse(CTRL_STEP)
+
+    def pcreset(self):
+        self.pulse(CTRL_PCRESET)
+
+    # ---- memories ----
+
+    def _imem_ops(self, addr, word):
+        return [('w', PIPE_IMEM_ADDR_REG, addr), ('w', PIPE_IMEM_WDATA_REG, word & 0xFFFFFFFF)] \
+            + self._pulse_ops(CTRL_IMEM_WE)
+
+    def _dmem_ops(self, addr, value):
+        value &= 0xFFFFFFFFFFFFFFFF
+        return [('w', PIPE_DMEM_ADDR_REG, addr),
+                ('w', PIPE_DMEM_WDATA_HI_REG, value >> 32),
+                ('w', PIPE_DMEM_WDATA_LO_REG, value & 0xFFFFFFFF)] \
+            + self._set_ops(CTRL_DMEM_EN, 1) + self._set_ops(CTRL_DMEM_WE, 1) + self._set_ops(CTRL_DMEM_WE, 0)
+
+    def write_imem(self, words, start=0):
+        # words: any sequence of 32 bit words (list, array('I'), numpy), one batch
+        ops = []
+        for i, word in enumerate(words):
+            ops += self._imem_ops(start + i, int(word))
+        self.backend.transact(ops)
+
+    def write_dmem(self, values, start=0):
+        # values: 64 bit words, one batch
+        ops = []
+        for i, value in enumerate(values):
+            ops += self._dmem_ops(start + i, int(value))
+        self.backend.transact(ops)
+
+    def read_dmem(self, start=0, count=DMEM_WORDS):
+        ops = self._set_ops(CTRL_DMEM_EN, 1) + self._set_ops(CTRL_DMEM_WE, 0)
+        for addr in range(start, start + count):
+            ops += [('w', PIPE_DMEM_ADDR_REG, addr), ('r', PIPE_DMEM_RDATA_LO_REG), ('r', PIPE_DMEM_RDATA_HI_REG)]
+        values = self.backend.transact(ops)
+        return [(values[i + 1] << 32) | values[i] for i in range(0, len(values), 2)]
+
+    def imem_write(self, addr, word):
+        self.write_imem([word], addr)
+
+    def dmem_write(self, addr, value):
+        self.write_dmem([value], addr)
+
+    def dmem_read(self, addr):
+        return self.read_dmem(addr, 1)[0]
+
+    def pc(self):
+        return self.backend.read(PIPE_PC_DBG_REG)
+
+    def if_instr(self):
+        return self.backend.read(PIPE_IF_INSTR_REG)
+
+    def sample_pc(self, count):
+        # PIPE_PC_DBG_REG count times back to back, one batch
+        return self.backend.transact([('r', PIPE_PC_DBG_REG)] * count)
+
+    def step_trace(self, count):
+        # count steps with PIPE_PC_DBG_REG and PIPE_IF_INSTR_REG read after
+        # each, one batch -> ([pc, ..], [word, ..])
+        ops = []
+        for i in range(count):
+            ops += self._pulse_ops(CTRL_STEP) + [('r', PIPE_PC_DBG_REG), ('r', PIPE_IF_INSTR_REG)]
+        values = self.backend.transact(ops)
+        return values[0::2], values[1::2]
+
+    def load(self, lines):
+        # imem_write/dmem_write lines (map.py, link.py output) as one batch
+        ops = []
+        for entry in lines:
+            line = entry[0] if isinstance(entry, list) else entry
+            parts = line.split('#')[0].split()
+            if not parts:
+                continue
+            if parts[0] == 'imem_write':
+                ops += self._imem_ops(parse_addr(parts[1]), int(parts[2], 16))
+            elif parts[0] == 'dmem_write':
+                ops += self._dmem_ops(parse_addr(parts[1]), (int(parts[2], 16) << 32) | int(parts[3], 16))
+            else:
+                raise ValueError(f"Cannot load '{line.strip()}'")
+        self.backend.transact(ops)
+
+
+# cmd | ioctl | fake | coproc:<server command>, None when $PIPEREG is not set
+PIPEREG_SPEC = os.environ.get('PIPEREG')
+
+
+def open_backend(name, arg=None):
+    if name == 'cmd':
+        return CmdBackend(arg or '')
+    if name == 'ioctl':
+        return IoctlBackend(arg or 'nf2c0')
+    if name == 'coproc':
+        return CoprocessBackend(arg or f'{sys.executable} {__file__} serve')
+    if name == 'fake':
+        return FakeBackend()
+    raise ValueError(f"Unknown backend {name}")
+
+
+def connect(spec=None, ctrl=None):
+    # spec, else $PIPEREG, else cmd (regwrite/regread on this machine)
+    name, _, arg = (spec or PIPEREG_SPEC or 'cmd').partition(':')
+    return PipeRegs(open_backend(name, arg or None), ctrl)
+
+
+def imem_words(lines):
+    # [(pc, word)] of the imem_write lines of a map.py / link.py image
+    words = []
+    for entry in lines:
+        parts = (entry[0] if isinstance(entry, list) else entry).split('#')[0].split()
+        if len(parts) > 2 and parts[0] == 'imem_write':
+            words.append((parse_addr(parts[1]), int(parts[2], 16)))
+    return words
+
+
+def idle_loop(words, pc, slots):
+    # pcs a thread fetches from pc on when that only leads through words that
+    # do nothing (NOPs, B without link), with the slots words behind every B;
+    # None if a word on the way does work or is not in the image.  b . and
+    # GCC's .L11: b .L12 / .L12: b .L11 both come out as such a loop, as in
+    # sim.py's halt: back on a branch with nothing done since
+    import isa
+    seen = set()
+    todo = [pc]
+    while todo:
+        pc = todo.pop()
+        if pc in seen:
+            continue
+        if pc not in words:
+            return None
+        dec = isa.decode(words[pc])
+        seen.add(pc)
+        if dec.kind in (isa.K_BRANCH, isa.K_JUMP) and not dec.is_bl:
+            todo.append(isa.branch_target(dec, pc))
+            for k in range(1, slots + 1):
+                shadow = (pc + k) & isa.PC_MASK
+                if shadow not in words or isa.decode(words[shadow]).kind != isa.K_NOP:
+                    return None
+                seen.add(shadow)
+        elif dec.kind == isa.K_NOP:
+            todo.append((pc + 1) & isa.PC_MASK)
+        else:
+            return None
+    return seen
+
+
+def halt_pcs(imem, target='st'):
+    # one set of halt pcs per thread that runs a program, the pcs of its idle
+    # loops; None when such a thread has none, the caller can only time out.
+    # a thread whose entry already is an idle loop (link.py parks unused mt
+    # threads on b .) is left out
+    # isa / hazard are imported here, `pipereg.py serve` on the board runs without them
+    import hazard
+    import isa
+    words = dict(imem)
+    slots = hazard.shadow_slots(hazard.TARGETS[target])
+    threads = {}
+    for pc in words:
+        threads.setdefault(pc // hazard.PARTITION if target == 'mt' else 0, []).append(pc)
+    halts = []
+    for thread, pcs in sorted(threads.items()):
+        entry = thread * hazard.PARTITION if target == 'mt' else 0
+        if idle_loop(words, entry, slots) is not None:
+            continue
+        loops = set()
+        for pc in pcs:
+            dec = isa.decode(words[pc])
+            if dec.kind in (isa.K_BRANCH, isa.K_JUMP) and not dec.is_bl:
+                loops |= idle_loop(words, pc, slots) or set()
+        if not loops:
+            return None
+        halts.append(loops)
+    return halts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pipeline register access, see pipereg.pl')
+    parser.add_argument('--backend', choices=['cmd', 'ioctl', 'coproc', 'fake'], default='cmd')
+    parser.add_argument('--arg', help="cmd: prefix ('ssh host'), ioctl: interface, coproc: server command")
+    parser.add_argument('cmd', help='run step pcreset imem_write dmem_write dmem_read dbg allregs load serve')
+    parser.add_argument('args', nargs='*')
+    args = parser.parse_args()
+
+    backend = open_backend(args.backend, args.arg)
+    if args.cmd == 'serve':
+        serve(backend)
+        return
+    regs = PipeRegs(backend)
+    a = args.args
+    if args.cmd == 'run':
+        regs.run(int(a[0]))
+    elif args.cmd == 'step':
+        regs.step()
+    elif args.cmd == 'pcreset':
+        regs.pcreset()
+    elif args.cmd == 'imem_write':
+        regs.imem_write(parse_addr(a[0]), int(a[1], 16))
+    elif args.cmd == 'dmem_write':
+        regs.dmem_write(parse_addr(a[0]), (int(a[1], 16) << 32) | int(a[2], 16))
+    elif args.cmd == 'dmem_read':
+        value = regs.dmem_read(parse_addr(a[0]))
+        print(f'DMEM[{parse_addr(a[0])}] = 0x{value >> 32:08x}0x{value & 0xFFFFFFFF:08x}')
+    elif args.cmd in ('dbg', 'allregs'):
+        print(f'PC:       0x{regs.pc():08x}')
+        print(f'IF_INSTR: 0x{regs.if_instr():08x}')
+        if args.cmd == 'allregs':
+            print(f'DMEM_RLO: 0x{backend.read(PIPE_DMEM_RDATA_LO_REG):08x}')
+            print(f'DMEM_RHI: 0x{backend.read(PIPE_DMEM_RDATA_HI_REG):08x}')
+    elif args.cmd == 'load':
+        with open(a[0], 'r') as f:
+            regs.load(f.readlines())
+    else:
+        parser.error(f"Unrecognized command {args.cmd}")
+    regs.close()
+
+
+if __name__ == "__main__":
+    main()
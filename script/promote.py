@@ -0,0 +1,401 @@
+import re
+
+# stack slot to register promotion for GCC -O0 input, a text pass run by
+# map.py before lowering (Assembler(PROMOTE=True), map.py --promote)
+#
+#   ldr r3, [fp, #-8]          mov r3, r4
+#   add r3, r3, #1      ->     add r3, r3, #1     ->     add r4, r4, #1
+#   str r3, [fp, #-8]          mov r4, r3
+#
+# a slot [fp, #-N] is promoted when every use of it is such a plain word load
+# or store and its address is never taken.  pointers made from fp (sub ip,
+# fp, #56 for an array, add r3, r3, fp to index one) are followed through each
+# block and every aggregate gets the bytes they reach: the words a constant
+# offset or an ldm / stm names, from the lowest of them up to the next slot
+# named directly above them (the frame layout), or up to fp when the pointer
+# escapes (stored, passed on, mixed with another pointer).  -O0 reads a[2] as
+# ldr r3, [fp, #-16], so a slot inside any of these is not promoted, and a
+# function where fp itself escapes keeps all of its slots.
+#
+# a slot gets a register from r1..r7 the program never names, so calls and
+# the r8 / r10 / r11 map.py lowers into are not touched.  on a core without
+# forwarding a mov costs what the load did, so the movs are then propagated
+# away where register liveness allows: a load's copy is read from the slot
+# register directly, a store's value is computed straight into it.  the
+# rewrite is line for line, a line that goes away is left empty, so line
+# indexes (and the line map) stay as they are
+
+FREE_REGS = ('r4', 'r5', 'r6', 'r7', 'r1', 'r2', 'r3')
+ALL_REGS = frozenset([f'r{i}' for i in range(13)] + ['fp', 'sp', 'ip', 'lr'])
+
+SLOT = re.compile(r'(ldr|str)\s+(\w+)\s*,\s*\[\s*fp\s*,\s*#-(\w+)\s*\]$')
+# pointers into the frame and the words that move them
+FRAME_PTR = re.compile(r'(add|sub)\s+(\w+)\s*,\s*fp\s*,\s*#(\w+)$')
+MULTI = re.compile(r'(ldm|stm)\w*\s+(\w+)\s*(!?)\s*,\s*\{(.*)\}$')
+LITERAL = re.compile(r'ldr\s+(\w+)\s*,\s*[.\w]+$')
+# fp in the frame setup and teardown, not an escape
+FRAME_OPS = (
+    re.compile(r'add\s+fp\s*,\s*sp\s*,\s*#\w+$'),
+    re.compile(r'sub\s+sp\s*,\s*fp\s*,\s*#\w+$'),
+    re.compile(r'(push|pop)\s*\{.*\}$'),
+)
+REG = re.compile(r'\b(r\d+|fp|sp|ip|lr)\b')
+
+# the words the propagation looks into, anything else is a barrier
+DP3 = re.compile(r'(add|sub|lsl)\s+(\w+)\s*,\s*(\w+)\s*,\s*(\w+|#\S+)$')
+DP2 = re.compile(r'(mov|cmp)\s+(\w+)\s*,\s*(\w+|#\S+)$')
+MEM = re.compile(r'(ldr|str)\s+(\w+)\s*,\s*\[\s*(\w+)\s*(?:,\s*(#[^\]]+?))?\s*\]$')
+BRANCH = re.compile(r'(b|beq|bne|blt|bge|bgt|ble)\s+(\S+)$')
+
+
+def text_of(entry):
+    return (entry[0] if isinstance(entry, list) else entry).strip()
+
+
+def functions(texts):
+    # [(first, end)] line ranges, split at labels not starting with '.'
+    starts = [i for i, t in enumerate(texts) if t.endswith(':') and not t.startswith('.')]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return list(zip(starts, starts[1:] + [len(texts)]))
+
+
+def number(text):
+    return int(text, 0)
+
+
+def reg_list(text):
+    # ldm / stm {r0, r1, r4-r6} -> [r0, r1, r4, r5, r6]
+    regs = []
+    for part in text.split(','):
+        low, dash, high = part.strip().partition('-')
+        regs.extend(f'r{k}' for k in range(number(low[1:]), number(high[1:]) + 1)) if dash else regs.append(low)
+    return regs
+
+
+def frame_reach(texts, first, end):
+    # -> [[low, high, escaped]] fp offsets each aggregate is reached at, None
+    # when the whole frame may be
+    reach = []
+    pointers = {}       # reg -> (reach index or None, fp offset, indexed)
+    lost = False
+
+    def source(reg):
+        return (None, 0, False) if reg == 'fp' else pointers[reg]
+
+    def access(reg, offset):
+        # a load / store at offset from a pointer
+        index, base, indexed = source(reg)
+        if index is None:
+            reach.append([base + offset, base + offset + 4, False])
+            if reg != 'fp' and not indexed:
+                pointers[reg] = (len(reach) - 1, base, indexed)
+            return
+        span = reach[index]
+        span[0] = min(span[0], base + offset)
+        if not indexed:
+            span[1] = max(span[1], base + offset + 4)
+
+    def escape(regs):
+        nonlocal lost
+        for reg in regs:
+            if reg == 'fp':
+                lost = True
+            elif reg in pointers:
+                index, base, indexed = pointers.pop(reg)
+                if index is None:
+                    lost = True
+                else:
+                    reach[index][2] = True
+
+    for i in range(first, end):
+        t = texts[i]
+        if not t or t.startswith('.') and not t.endswith(':'):
+            continue
+        if t.endswith(':'):
+            pointers = {}
+            continue
+        if any(op.match(t) for op in FRAME_OPS):
+            continue
+        m = SLOT.match(t)
+        if m:
+            op, rd = m.group(1, 2)
+            if op == 'str':
+                escape([rd])
+            pointers.pop(rd, None)
+            continue
+        m = FRAME_PTR.match(t)
+        if m:
+            offset = number(m.group(3)) * (-1 if m.group(1) == 'sub' else 1)
+            reach.append([offset, offset + 4, False])
+            pointers[m.group(2)] = (len(reach) - 1, offset, False)
+            continue
+        m = LITERAL.match(t)
+        if m:
+            pointers.pop(m.group(1), None)
+            continue
+        m = MULTI.match(t)
+        if m and m.group(2) in pointers:
+            op, rn, wb, regs = m.groups()
+            regs = reg_list(regs)
+            for k in range(len(regs)):
+                access(rn, 4 * k)
+            index, base, indexed = pointers[rn]
+            if op == 'stm':
+                escape(regs)
+            for reg in regs if op == 'ldm' else []:
+                pointers.pop(reg, None)
+            if wb:
+                pointers[rn] = (index, base + 4 * len(regs), indexed)
+            continue
+        word = parse(t)
+        if word is None:
+            escape(list(pointers) if t.startswith('bl') else REG.findall(t))
+            continue
+        written = word.written()
+        if word.op in ('ldr', 'str'):
+            rd, rn = word.regs
+            offset = number(word.rest.lstrip('#')) if word.rest else 0
+            if rn in pointers or rn == 'fp':
+                access(rn, offset)
+            elif rn != 'sp' and offset < 0:
+                # below a register not followed here, the -O0 array index
+                reach.append([offset, offset + 4, False])
+            if word.op == 'str':
+                escape([rd])
+            pointers.pop(written, None)
+            continue
+        sources = [word.regs[k] for k in word.reads if word.regs[k] in pointers or word.regs[k] == 'fp']
+        new = None
+        if sources and word.op != 'cmp':
+            index, base, indexed = source(sources[0])
+            if word.op == 'mov':
+                new = (index, base, indexed)
+            elif word.op in ('add', 'sub') and word.rest is not None:
+                step = number(word.rest.lstrip('#'))
+                new = (index, base + step if word.op == 'add' else base - step, indexed)
+            elif word.op == 'add' and len(sources) == 1:
+                new = (index, base, True)
+            else:
+                escape(sources)
+        pointers.pop(written, None)
+        if new is not None:
+            pointers[written] = new
+    return None if lost else reach
+
+
+def slots(texts, first, end):
+    # {N: [line, ..]} of the promotable [fp, #-N] slots of one function
+    uses = {}
+    for i in range(first, end):
+        m = SLOT.match(texts[i])
+        if m:
+            uses.setdefault(number(m.group(3)), []).append(i)
+    reach = frame_reach(texts, first, end)
+    if reach is None:
+        return {}
+    named = sorted(-n for n in uses)
+    taken = []
+    for low, high, escaped in reach:
+        top = 0 if escaped else min([a for a in named if a >= high], default=0)
+        taken.append((low, top))
+    return {n: lines for n, lines in uses.items() if not any(low <= -n < top for low, top in taken)}
+
+
+class Word:
+    # one line the propagation understands: regs in operand order, which of
+    # them are read and which one is written
+    def __init__(self, op, regs, reads, write, rest=None):
+        self.op = op
+        self.regs = regs
+        self.reads = reads      # operand indexes
+        self.write = write      # operand index or None
+        self.rest = rest        # immediate / offset text
+
+    def read_regs(self):
+        return {self.regs[i] for i in self.reads}
+
+    def written(self):
+        return self.regs[self.write] if self.write is not None else None
+
+    def text(self):
+        if self.op in ('ldr', 'str'):
+            rd, rn = self.regs
+            return f'{self.op} {rd}, [{rn}, {self.rest}]' if self.rest else f'{self.op} {rd}, [{rn}]'
+        return f'{self.op} ' + ', '.join(self.regs + ([self.rest] if self.rest else []))
+
+
+def parse(t):
+    # -> Word, or None when t is not one of the words above
+    m = DP3.match(t)
+    if m:
+        op, rd, rn, src = m.groups()
+        if src in ALL_REGS:
+            return Word(op, [rd, rn, src], (1, 2), 0)
+        return Word(op, [rd, rn], (1,), 0, src)
+    m = DP2.match(t)
+    if m:
+        op, a, src = m.groups()
+        write = 0 if op == 'mov' else None
+        first = () if op == 'mov' else (0,)
+        if src in ALL_REGS:
+            return Word(op, [a, src], first + (1,), write)
+        return Word(op, [a], first, write, src)
+    m = MEM.match(t)
+    if m:
+        op, rd, rn, off = m.groups()
+        if op == 'ldr':
+            return Word(op, [rd, rn], (1,), 0, off)
+        return Word(op, [rd, rn], (0, 1), None, off)
+    return None
+
+
+def liveness(texts, words):
+    # live_out[i]: registers read on some path after line i before a write
+    labels = {t[:-1]: i for i, t in enumerate(texts) if t.endswith(':')}
+    n = len(texts)
+    succ = []
+    use = []
+    define = []
+    for i, t in enumerate(texts):
+        word = words[i]
+        nxt = [i + 1] if i + 1 < n else []
+        m = BRANCH.match(t)
+        if word is not None:
+            use.append(word.read_regs())
+            define.append({word.written()} - {None})
+            succ.append(nxt)
+        elif m:
+            target = labels.get(m.group(2))
+            if target is None:
+                # out of the file, anything may be read there
+                use.append(ALL_REGS)
+                succ.append([] if m.group(1) == 'b' else nxt)
+            else:
+                use.append(set())
+                succ.append([target] if m.group(1) == 'b' else nxt + [target])
+            define.append(set())
+        elif not t or t.endswith(':') or t.startswith('.'):
+            use.append(set())
+            define.append(set())
+            succ.append(nxt)
+        else:
+            # bx, push/pop, ldm/stm, ..: taken to read everything
+            use.append(ALL_REGS)
+            define.append(set())
+            succ.append(nxt)
+    live_in = [set() for i in range(n)]
+    live_out = [set() for i in range(n)]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(n)):
+            out = set().union(*(live_in[s] for s in succ[i])) if succ[i] else set(ALL_REGS)
+            inn = use[i] | (out - define[i])
+            if out != live_out[i] or inn != live_in[i]:
+                live_out[i], live_in[i] = out, inn
+                changed = True
+    return live_out
+
+
+def forward_load(texts, words, live_out, i):
+    # mov rX, rP: read rP where rX is read, until rX dies or is written
+    x, p = words[i].regs
+    edits = {}
+    j = i
+    while x in live_out[j]:
+        j += 1
+        if j >= len(texts) or words[j] is None:
+            return False
+        word = words[j]
+        if x in word.read_regs():
+            word = Word(word.op, [p if k in word.reads and r == x else r for k, r in enumerate(word.regs)],
+                        word.reads, word.write, word.rest)
+            edits[j] = word
+        if word.written() == x:
+            break
+        if word.written() == p and x in live_out[j]:
+            return False
+    edits[i] = None
+    apply(texts, words, edits)
+    return True
+
+
+def sink_store(texts, words, live_out, k, keep):
+    # mov rP, rX with rX dead after it: the word computing rX writes rP
+    p, x = words[k].regs
+    if x in live_out[k] or x in keep:
+        return False
+    edits = {}
+    j = k
+    while True:
+        j -= 1
+        if j < 0 or words[j] is None:
+            return False
+        word = words[j]
+        if word.written() == x:
+            regs = list(word.regs)
+            regs[word.write] = p
+            edits[j] = Word(word.op, regs, word.reads, word.write, word.rest)
+            break
+        if p in word.read_regs() or word.written() == p:
+            return False
+        if x in word.read_regs():
+            edits[j] = Word(word.op, [p if k2 in word.reads and r == x else r for k2, r in enumerate(word.regs)],
+                            word.reads, word.write, word.rest)
+    edits[k] = None
+    apply(texts, words, edits)
+    return True
+
+
+def apply(texts, words, edits):
+    for i, word in edits.items():
+        words[i] = word
+        texts[i] = word.text() if word is not None else ''
+
+
+def propagate(texts, promoted):
+    # remove the movs to and from the promoted registers where liveness allows
+    keep = set(promoted)
+    words = [parse(t) for t in texts]
+    changed = True
+    while changed:
+        changed = False
+        live_out = liveness(texts, words)
+        for i, word in enumerate(words):
+            if word is None or word.op != 'mov' or len(word.regs) != 2:
+                continue
+            a, b = word.regs
+            if a == b:
+                apply(texts, words, {i: None})
+            elif b in keep and a not in keep:
+                changed = forward_load(texts, words, live_out, i)
+            elif a in keep:
+                changed = sink_store(texts, words, live_out, i, keep)
+            if changed:
+                break
+    return texts
+
+
+def promote(ALLWRITE):
+    # -> (lines, {(function start line, N): reg}) with the slots rewritten
+    texts = [text_of(entry) for entry in ALLWRITE]
+    named = set()
+    for t in texts:
+        named.update(REG.findall(t))
+    free = [reg for reg in FREE_REGS if reg not in named]
+    out = list(texts)
+    promoted = {}
+    for first, end in functions(texts):
+        for n, lines in sorted(slots(texts, first, end).items()):
+            if not free:
+                break
+            reg = free.pop(0)
+            promoted[(first, n)] = reg
+            for i in lines:
+                op, rd = SLOT.match(texts[i]).group(1, 2)
+                out[i] = f'mov {rd}, {reg}' if op == 'ldr' else f'mov {reg}, {rd}'
+    if promoted:
+        out = propagate(out, promoted.values())
+    lines = [[t] if isinstance(entry, list) else t for t, entry in zip(out, ALLWRITE)]
+    return lines, promoted
@@ -0,0 +1,235 @@
+import argparse
+import os
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import link
+import pcprof
+import pipereg
+import sim
+
+# regression of the DMEM dumps recorded from board runs against sim.py's
+# model of pipeline_arm.v: every case is an image, the DMEM it starts from and
+# the DMEM the board left, run in a process pool and diffed word by word
+#
+#   python regress.py
+#   python regress.py --case image.txt init.txt expect.txt --end 0xcf
+#   python regress.py --case image.txt init.txt dump.txt --end 0xcf --at any
+#   python regress.py --case image.txt init.txt dump.txt --end 0xcf --at 4
+#   python regress.py --board --backend 'coproc:ssh netfpga python3 pipereg.py --backend ioctl serve'
+#
+# DMEM files are datamemread.py dumps (DMEM[i] = 0x<hi>0x<lo>, only the words
+# listed are compared), sim.py output (DMEM[i] = 0x<64 bit>) or dmem_write
+# lines.  the initial words go over the image's own dmem_write lines.
+#
+# a final case (at None) compares the DMEM at the halt (or end), a snapshot is a
+# dump taken with the board stopped part way.  the dumps record no pc or store
+# count, so at 'any' finds the stores after which the model's DMEM is the dump
+# (dataMem/1 after 2, dataMem2 after 4, dataMem3 after all 60) and fails if
+# there is none; an int at compares right after that many stores, a run making
+# fewer fails.  --board re-runs the failing final cases on the board and diffs
+# what it read back the same way
+#
+# result/lwswtest.txt (pipereg.pl lab commands) and the compiled
+# result/pp_output.txt have no recorded DMEM, give them with --case when there is
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULT = os.path.join(HERE, '..', 'backup', 'single_thread_backup', 'result')
+SORT = os.path.join(RESULT, 'write_Data_I_Mem.py')
+SORT_END = 0xcf     # runs off its last word
+
+Case = namedtuple('Case', ['name', 'image', 'initial', 'expected', 'end', 'at'])
+
+CASES = (
+    Case('sort', SORT, os.path.join(RESULT, 'dataMemInitial.txt'), os.path.join(RESULT, 'dataMem4.txt'), SORT_END, None),
+    Case('sort-dump', SORT, os.path.join(RESULT, 'dataMemInitial.txt'), os.path.join(RESULT, 'dataMem.txt'), SORT_END, 'any'),
+    Case('sort-dump1', SORT, os.path.join(RESULT, 'dataMemInitial.txt'), os.path.join(RESULT, 'dataMem1.txt'), SORT_END, 'any'),
+    Case('sort-dump2', SORT, os.path.join(RESULT, 'dataMemInitial.txt'), os.path.join(RESULT, 'dataMem2.txt'), SORT_END, 'any'),
+    Case('sort-dump3', SORT, os.path.join(RESULT, 'dataMemInitial.txt'), os.path.join(RESULT, 'dataMem3.txt'), SORT_END, 'any'),
+)
+
+BOARD_SECONDS = 2.0
+
+DUMP = re.compile(r'DMEM\[(\d+)\]\s*=\s*(0x[0-9a-fA-F]+)(0x[0-9a-fA-F]+)?\s*$')
+
+
+def read_dmem(path):
+    # -> (values, mask): (256,) uint64 and the words the file lists
+    values = np.zeros(sim.DMEM_WORDS, dtype=np.uint64)
+    mask = np.zeros(sim.DMEM_WORDS, dtype=bool)
+    with open(path) as f:
+        text = f.read()
+    if 'DMEM[' not in text:
+        words = link.read_image(path)[1].items()
+    else:
+        words = []
+        for line in text.split('\n'):
+            match = DUMP.match(line.strip())
+            if match:
+                addr, hi, lo = match.groups()
+                value = int(hi, 16) << 32 | int(lo, 16) if lo else int(hi, 16)
+                words.append((int(addr), value))
+    for addr, value in words:
+        values[addr & 0xFF] = value & sim.MASK64
+        mask[addr & 0xFF] = True
+    return values, mask
+
+
+def start_dmem(case):
+    # the image's dmem_write words with the initial dump over them
+    imem, dmem = link.read_image(case.image)
+    dmem = dict(dmem)
+    if case.initial:
+        values, mask = read_dmem(case.initial)
+        dmem.update((int(addr), int(values[addr])) for addr in np.flatnonzero(mask))
+    return imem, dmem
+
+
+class StoreLog(list):
+    # sim.Pipeline's dmem, keeping every store in order
+    def __init__(self, values):
+        super().__init__(values)
+        self.stores = []
+
+    def __setitem__(self, addr, value):
+        self.stores.append((addr, value))
+        super().__setitem__(addr, value)
+
+
+def mismatches(final, expected, mask):
+    # [(addr, model, expected)] of the listed words that differ
+    return [(int(addr), int(final[addr]), int(expected[addr]))
+            for addr in np.flatnonzero(mask & (final != expected))]
+
+
+def after(start, stores, at):
+    # the DMEM right after the first at stores
+    state = np.array(start, dtype=np.uint64)
+    for addr, value in stores[:at]:
+        state[addr] = value
+    return state
+
+
+def snapshot_at(start, stores, expected, mask):
+    # the store counts after which the DMEM matches the listed words
+    state = np.array(start, dtype=np.uint64)
+    found = []
+    for at in range(len(stores) + 1):
+        if at:
+            addr, value = stores[at - 1]
+            state[addr] = value
+        if not (mask & (state != expected)).any():
+            found.append(at)
+    return found
+
+
+def run_case(case, max_cycles=sim.MAX_CYCLES):
+    # one case on sim.Pipeline -> result dict
+    imem, dmem = start_dmem(case)
+    expected, mask = read_dmem(case.expected)
+    cpu = sim.Pipeline(imem, dmem)
+    start = list(cpu.dmem)
+    if case.at is not None:
+        cpu.dmem = StoreLog(cpu.dmem)
+    took = time.perf_counter()
+    halt = cpu.run(max_cycles, case.end)
+    took = time.perf_counter() - took
+    result = {'case': case.name, 'halt': halt, 'cycles': cpu.stats['cycles'], 'seconds': took}
+    if case.at is not None:
+        stores = cpu.dmem.stores
+        at = case.at
+        if at == 'any':
+            found = snapshot_at(start, stores, expected, mask)
+            # no match: diff against the final DMEM
+            at = found[0] if found else len(stores)
+            result['found'] = found
+        result.update(at=at, stores=len(stores), diff=mismatches(after(start, stores, at), expected, mask))
+        result['ok'] = not result['diff'] and at <= len(stores)
+    else:
+        result['diff'] = mismatches(np.array(cpu.dmem, dtype=np.uint64), expected, mask)
+        result['ok'] = not result['diff'] and halt is not None
+    return result
+
+
+def run_board(regs, case, seconds=BOARD_SECONDS):
+    # the case on the board: load, pcreset, run until every thread is on its
+    # b . or seconds are up, stop, read DMEM back -> mismatches
+    imem, dmem = start_dmem(case)
+    expected, mask = read_dmem(case.expected)
+    regs.run(0)
+    regs.load([f'dmem_write {addr} {value >> 32:#x} {value & 0xFFFFFFFF:#x}' for addr, value in dmem.items()]
+              + [f'imem_write {pc} {word:#x}' for pc, word in imem])
+    regs.pcreset()
+    regs.run(1)
+    try:
+        pcprof.sample(regs, samples=1 << 62, seconds=seconds, halts=pipereg.halt_pcs(imem))
+    finally:
+        regs.run(0)
+    final = np.array(regs.read_dmem(), dtype=np.uint64)
+    return mismatches(final, expected, mask)
+
+
+def show(name, diff):
+    lines = []
+    for addr, model, want in diff:
+        lines.append(f'    DMEM[{addr}] {name} {model:#018x} expected {want:#018x}')
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='diff recorded board DMEM dumps against sim.py')
+    parser.add_argument('--case', nargs=3, action='append', metavar=('IMAGE', 'INITIAL', 'EXPECTED'),
+                        help="extra final case, INITIAL '-' for the image's own dmem_write lines")
+    parser.add_argument('--end', type=lambda pc: int(pc, 0), help='--case: stop when the word at this pc is in EX')
+    parser.add_argument('--at', type=lambda at: at if at == 'any' else int(at),
+                        help="--case: EXPECTED is a snapshot taken after this many stores, 'any' to find them")
+    parser.add_argument('--only', action='store_true', help='run the --case cases only')
+    parser.add_argument('--jobs', type=int, help='worker processes, default one per cpu')
+    parser.add_argument('--max-cycles', type=int, default=sim.MAX_CYCLES)
+    parser.add_argument('--board', action='store_true', help='re-run the failing final cases on the board')
+    parser.add_argument('--backend', default=pipereg.PIPEREG_SPEC, help='cmd | ioctl | fake | coproc:<server command>')
+    parser.add_argument('--seconds', type=float, default=BOARD_SECONDS, help='--board: longest run per case')
+    args = parser.parse_args()
+
+    cases = [] if args.only else list(CASES)
+    for image, initial, expected in args.case or []:
+        cases.append(Case(os.path.basename(image), image, None if initial == '-' else initial, expected,
+                          args.end, args.at))
+
+    with ProcessPoolExecutor(args.jobs) as pool:
+        results = list(pool.map(run_case, cases, [args.max_cycles] * len(cases)))
+
+    failed = []
+    for case, result in zip(cases, results):
+        status = 'ok  ' if result['ok'] else 'FAIL'
+        where = f"store {result['at']}/{result['stores']}" if case.at is not None \
+            else f"halt {result['halt']}" if result['halt'] is not None else 'no halt'
+        print(f"{status} {case.name:16} {where:16} {len(result['diff'])} words differ  ({result['seconds']:.2f} s)")
+        for line in show('model', result['diff']):
+            print(line)
+        if not result['ok']:
+            failed.append(case)
+    print(f'{len(cases) - len(failed)}/{len(cases)} passed')
+
+    if args.board and failed:
+        regs = pipereg.connect(args.backend)
+        try:
+            for case in failed:
+                if case.at is not None:
+                    print(f'     {case.name:16} snapshot, not re-run on the board')
+                    continue
+                diff = run_board(regs, case, args.seconds)
+                print(f"{'ok  ' if not diff else 'FAIL'} {case.name:16} board, {len(diff)} words differ")
+                for line in show('board', diff):
+                    print(line)
+        finally:
+            regs.close()
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import argparse
+import json
+
+import devices
+import isa
+import link
+import map
+import sim
+import sim_mt
+
+# performance counters of a map.py/link.py image run on sim.py (st) or
+# sim_mt.py (mt): where the cycles went, per run and per thread, as a text
+# table or JSON
+#
+#   python report.py pp_output.txt
+#   python report.py image.txt mt --json report.json
+#   python report.py stream.txt --fifo packets.txt --gpu-latency 200
+#   python report.py pp_output.txt --lines pp_output.map    # EX slots per .s line
+#
+# st cycles split into useful words in EX, NOPs in EX, bubbles of words a
+# taken branch flushed from ID, the empty EX slots while the pipeline fills,
+# and FIFOWAIT / GPU_RUN stalls.  an mt thread gets every fourth EX slot and
+# has no flushes or bubbles, its cycles are wall clock up to its last word.
+# words are counted per class of the CTRL_UNIT.v dec_* outputs
+
+# dec_* output a word sets -> class
+CLASSES = (
+    'alu',          # dec_reg_wen, an ALU result
+    'compare',      # dec_alu_ctrl without dec_reg_wen: CMP / TST / TEQ
+    'load',         # dec_is_load
+    'store',        # dec_mem_wen
+    'branch',       # dec_is_branch: B and J
+    'bl',           # dec_is_bl
+    'cond_branch',  # dec_is_cond_branch: BEQ / BNE
+    'jr',           # dec_is_jump: BX
+    'nop',          # nothing, or a write to r0
+    'io',           # RDF / FIFOWAIT / FIFODONE / WRP / GPU_RUN, with devices attached
+)
+
+
+def word_class(word, signed_imm=False, io=False):
+    if io and devices.decode_io(word) is not None:
+        return 'io'
+    dec = isa.decode(word, signed_imm)
+    if dec.is_jump:
+        return 'jr'
+    if dec.is_cond_branch:
+        return 'cond_branch'
+    if dec.is_bl:
+        return 'bl'
+    if dec.is_branch:
+        return 'branch'
+    if dec.is_load:
+        return 'load'
+    if dec.mem_wen:
+        return 'store'
+    if dec.kind == isa.K_ALU:
+        return 'alu'
+    if dec.alu_ctrl != isa.ALU_NOP and not dec.reg_wen:
+        return 'compare'
+    return 'nop'
+
+
+def class_counts(imem, visits, pcs, signed_imm=False, io=False):
+    # words executed per class over pcs
+    counts = dict.fromkeys(CLASSES, 0)
+    for pc in pcs:
+        if visits[pc]:
+            counts[word_class(imem[pc], signed_imm, io)] += int(visits[pc])
+    return counts
+
+
+def ratio(a, b):
+    return round(a / b, 4) if b else None
+
+
+def counters(cycles, counts, extra):
+    # the fields every report row has, from cycles and the class counts
+    retired = sum(counts.values())
+    useful = retired - counts['nop']
+    row = {
+        'cycles': cycles,
+        'retired': retired,
+        'useful': useful,
+        'nops': counts['nop'],
+        'nop_share': ratio(counts['nop'], retired),
+        'cpi': ratio(cycles, useful),
+        'cpi_retired': ratio(cycles, retired),
+    }
+    row.update(extra)
+    row['classes'] = counts
+    return row
+
+
+def static_counts(imem, pcs, signed_imm=False, io=False):
+    words = [imem[pc] for pc in pcs]
+    nops = sum(word_class(word, signed_imm, io) == 'nop' for word in words)
+    return {'words': len(words), 'nops': nops, 'nop_share': ratio(nops, len(words))}
+
+
+def report_st(path, signed_imm=False, fifo=None, gpu=None, end=None, max_cycles=sim.MAX_CYCLES, lines=None):
+    imem, dmem = link.read_image(path)
+    cpu = sim.Pipeline(imem, dmem, signed_imm, fifo, gpu)
+    halt = cpu.run(max_cycles, end)
+    stats = cpu.stats
+    counts = class_counts(cpu.imem, cpu.visits, range(len(cpu.imem)), signed_imm, cpu.io)
+    advanced = stats['cycles'] - stats['fifo_stall'] - stats['gpu_stall']
+    retired = sum(counts.values())
+    row = counters(stats['cycles'], counts, {
+        'halt': halt,
+        'taken': stats['taken'],
+        'flushed': stats['flushed'],
+        'fifo_stall': stats['fifo_stall'],
+        'gpu_stall': stats['gpu_stall'],
+    })
+    row['split'] = {
+        'useful': row['useful'],
+        'nop': row['nops'],
+        'flush': stats['flushed'],
+        'fill': advanced - retired - stats['flushed'],
+        'fifo_stall': stats['fifo_stall'],
+        'gpu_stall': stats['gpu_stall'],
+    }
+    report = {
+        'image': path,
+        'target': 'st',
+        'static': static_counts(cpu.imem, [pc for pc, word in imem], signed_imm, cpu.io),
+        'run': row,
+    }
+    if lines:
+        by_line(report, cpu.visits, lines)
+    return report
+
+
+def report_mt(path, signed_imm=False, guard=False, max_cycles=sim.MAX_CYCLES, lines=None):
+    imem, dmem = link.read_image(path)
+    cpu = sim_mt.Barrel(imem, dmem, signed_imm, guard)
+    halt = cpu.run(max_cycles)
+    stats = cpu.stats
+    threads = []
+    for k in range(sim_mt.THREADS):
+        pcs = range(k * sim_mt.PARTITION, (k + 1) * sim_mt.PARTITION)
+        counts = class_counts(cpu.imem, cpu.visits, pcs, signed_imm)
+        # up to the last word of the thread in EX, like the st cycles
+        steps = sum(counts.values())
+        cycles = sim_mt.cycle(k, steps - 1) + 1 if steps else 0
+        threads.append(counters(cycles, counts, {'halt': halt[k], 'taken': int(stats['taken'][k])}))
+    counts = {name: sum(row['classes'][name] for row in threads) for name in CLASSES}
+    cycles = max(row['cycles'] for row in threads)
+    run = counters(cycles, counts, {'halt': None if None in halt else max(halt),
+                                    'taken': sum(row['taken'] for row in threads)})
+    # an EX slot from cycle 3 on holds a word of a live thread, or nothing
+    fill = min(cycles, sim_mt.cycle(0, 0))
+    run['split'] = {'useful': run['useful'], 'nop': run['nops'],
+                    'idle': cycles - fill - run['retired'], 'fill': fill}
+    report = {
+        'image': path,
+        'target': 'mt',
+        'static': static_counts(cpu.imem, [pc for pc, word in imem], signed_imm),
+        'run': run,
+        'threads': threads,
+    }
+    if lines:
+        by_line(report, cpu.visits, lines)
+    return report
+
+
+def table(report, top=20):
+    # the report as text
+    run = report['run']
+    static = report['static']
+    rows = [('run', run)] + [(f'thread {k}', row) for k, row in enumerate(report.get('threads', []))]
+    lines = [f"{report['image']} ({report['target']}): {static['words']} words, "
+             f"{static['nops']} NOPs ({100 * (static['nop_share'] or 0):.1f}%) in the image"]
+    fields = ('cycles', 'retired', 'useful', 'nops', 'nop_share', 'cpi', 'cpi_retired', 'taken')
+    lines.append(f"{'':12}" + ''.join(f'{name:>12}' for name in fields))
+    for name, row in rows:
+        lines.append(f'{name:12}' + ''.join(f'{"-" if row[f] is None else row[f]:>12}' for f in fields))
+    lines.append('')
+    lines.append(f"{'class':12}" + ''.join(f'{name:>12}' for name, row in rows))
+    for cls in CLASSES:
+        if any(row['classes'][cls] for name, row in rows):
+            lines.append(f'{cls:12}' + ''.join(f"{row['classes'][cls]:>12}" for name, row in rows))
+    lines.append('')
+    lines.append('cycles of the run')
+    for name, count in run['split'].items():
+        lines.append(f'  {name:12}{count:>10}  {100 * count / max(1, run["cycles"]):5.1f}%')
+    if report.get('lines'):
+        lines.append('')
+        lines.append('EX slots per source line (padding NOPs included)')
+        for row in report['lines'][:top]:
+            lines.append(f"  {row['count']:>10} {100 * row['count'] / max(1, run['cycles']):5.1f}%"
+                         f"  {row['line']:>5}  {row['label']:12} {row['text']}")
+    return '\n'.join(lines)
+
+
+def by_line(report, visits, path):
+    # add the EX slots of every pc, summed per line of the map.py line map
+    counts = {pc: int(n) for pc, n in enumerate(visits) if n}
+    report['lines'] = [{'line': line, 'label': label, 'text': text, 'count': n}
+                       for line, label, text, n in map.attribute(counts, map.read_line_map(path))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='performance counters of an image run on sim.py / sim_mt.py')
+    parser.add_argument('image', nargs='?', default='pp_output.txt')
+    parser.add_argument('target', nargs='?', default='st', choices=('st', 'mt'))
+    parser.add_argument('--max-cycles', type=int, default=sim.MAX_CYCLES)
+    parser.add_argument('--sign-ext', action='store_true',
+                        help='sign-extend imm8/imm12 like CTRL_UNIT.v, the boards zero-extend')
+    parser.add_argument('--end', type=lambda pc: int(pc, 0), help='st: stop when the word at this pc is in EX')
+    parser.add_argument('--guard', action='store_true', help='mt: hold the pc at word 126, the planned stop guard')
+    parser.add_argument('--fifo', help='st: fifo script (devices.py) feeding FIFOWAIT/RDF')
+    parser.add_argument('--fifo-gap', type=int, default=0)
+    parser.add_argument('--gpu-latency', type=int, help='st: cycles from GPU_RUN to gpu_done')
+    parser.add_argument('--lines', help='map.py line map (.map): EX slots per source line')
+    parser.add_argument('--top', type=int, default=20, help='source lines in the table')
+    parser.add_argument('--json', help="write the report here as JSON, '-' for stdout")
+    args = parser.parse_args()
+
+    if args.target == 'st':
+        fifo = devices.Fifo(devices.read_fifo_script(args.fifo), args.fifo_gap) if args.fifo else None
+        gpu = devices.Gpu(args.gpu_latency) if args.gpu_latency is not None else None
+        report = report_st(args.image, args.sign_ext, fifo, gpu, args.end, args.max_cycles, args.lines)
+    else:
+        report = report_mt(args.image, args.sign_ext, args.guard, args.max_cycles, args.lines)
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+        return
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(table(report, args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,13 @@
 
 import sys
 import os
+import re
 import subprocess
 import time
+
+import numpy as np
+
+import pipereg
 from base_opterm import openterm
 
 n = 5
@@ -65,6 +70,10 @@ BF_MAP = {
     'pipeline': '/home/netfpga/ykl/nf2_top_par.bit',
     'alu' : '/home/netfpga/hilbert/nf2_top_par.bit'
 }
+# register access for bulk reads goes through pipereg.connect, $PIPEREG:
+#   cmd | ioctl | fake | coproc:<server command>
+# e.g. PIPEREG='coproc:ssh netfpga python3 hilbert/pipereg.py --backend ioctl serve'
+
 PERL_SCRIPT_MAP = {
     'ids': './idsreg',
     'pipeline': './ykl/pipereg.pl',
@@ -103,6 +112,31 @@ def build_instr(upcode, reg1, reg2, wreg, offset, line):
 
        
 
+def dump_dmem(start=0, count=pipereg.DMEM_WORDS, regs=None):
+    # DMEM[start:start+count] in one batch -> uint64 array
+    if regs is None:
+        if pipereg.PIPEREG_SPEC is None:
+            raise RuntimeError("set PIPEREG to the board's register backend, or use read_dmem_pane")
+        regs = pipereg.connect()
+    return np.array(regs.read_dmem(start, count), dtype=np.uint64)
+
+def save_dmem(file, values, start=0):
+    # one row per word: addr hi lo value(signed)
+    values = np.asarray(values, dtype=np.uint64)
+    addr = np.arange(start, start + len(values), dtype=np.int64)
+    hi = (values >> np.uint64(32)).astype(np.int64)
+    lo = (values & np.uint64(0xFFFFFFFF)).astype(np.int64)
+    table = np.column_stack([addr, hi, lo, values.view(np.int64)])
+    np.savetxt(file, table, fmt=['%d', '0x%08x', '0x%08x', '%d'], header='addr hi lo value')
+
+def load_dmem(file):
+    # save_dmem file -> (addr, uint64 values)
+    with open(file, 'r') as f:
+        rows = [line.split() for line in f if line.strip() and not line.startswith('#')]
+    addr = np.array([int(row[0]) for row in rows], dtype=np.int64)
+    values = np.array([(int(row[1], 16) << 32) | int(row[2], 16) for row in rows], dtype=np.uint64)
+    return addr, values
+
 def logging(file, result):
     
     with open(file, 'a') as f:
@@ -166,51 +200,217 @@ def decode (command, script, log=False):
     return instrs, lines
 
 
-def pipeline_logic(instrs, lines, bitfile, script):
-    subprocess.run(['tmux', 'send-keys', '-t', 'nd0', f'nf_download {BF_MAP.get(bitfile,bitfile)}', 'C-m'])
-    time.sleep(10)
-    subprocess.run(['tmux', 'send-keys', '-t', 'nd0', 'rkd &', 'C-m'])
-    time.sleep(1)
+# polling instead of fixed sleeps
+DOWNLOAD_TIMEOUT = 60
+RUN_TIMEOUT = 30
+POLL_INTERVAL = 0.001
+
+def wait_until(check, timeout, interval=POLL_INTERVAL):
+    # poll check() until it returns something true, None on timeout
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(interval)
+
+def probe(regs, token=None):
+    # the reserved sw register reads back what was written once the design is up
+    # token=None: read it, otherwise write and compare
+    try:
+        if token is None:
+            return regs.backend.read(pipereg.PIPE_RESERVED_REG)
+        regs.backend.write(pipereg.PIPE_RESERVED_REG, token)
+        return regs.backend.read(pipereg.PIPE_RESERVED_REG) == token
+    except (subprocess.CalledProcessError, OSError, ValueError, RuntimeError):
+        return None
+
+def wait_download(regs, start, timeout=DOWNLOAD_TIMEOUT, interval=0.1):
+    # start(): kicks off nf_download, programming the FPGA clears the token
+    old = 0x5a5a0000 | (os.getpid() & 0xFFFF)
+    loaded = probe(regs, old)
+    start()
+    if loaded and wait_until(lambda: probe(regs) not in (old, None), timeout, interval) is None:
+        raise TimeoutError("nf_download: the old design is still answering")
+    if wait_until(lambda: probe(regs, old ^ 0xFFFF), timeout, interval) is None:
+        raise TimeoutError("nf_download: no register access after download")
+
+def wait_halt(pc, halts, timeout=RUN_TIMEOUT, interval=POLL_INTERVAL):
+    # sample PIPE_PC_DBG_REG (the fetch address, pc() -> int or None) until
+    # every thread was seen in its idle loop (pipereg.halt_pcs), returns the
+    # seconds it took or None on timeout
+    start = time.monotonic()
+    waiting = [set(pcs) for pcs in halts]
+
+    def halted():
+        value = pc()
+        waiting[:] = [pcs for pcs in waiting if value not in pcs]
+        return not waiting
+    if wait_until(halted, timeout, interval) is None:
+        return None
+    return time.monotonic() - start
+
+# the pane-only path, without $PIPEREG: a command has run once the marker
+# echoed after it shows up as a line of its own
+SEND_TIMEOUT = 2
+PANE_INTERVAL = 0.05
+marker = 0
+
+def send_keys(text):
+    subprocess.run(['tmux', 'send-keys', '-t', 'nd0', text, 'C-m'])
+
+def pane():
+    return subprocess.run(['tmux', 'capture-pane', '-t', 'nd0', '-p'], capture_output=True, text=True).stdout
+
+def send_wait(text, timeout=SEND_TIMEOUT, interval=PANE_INTERVAL):
+    # send text to the pane and wait until the shell returned from it,
+    # -> the pane lines up to the marker
+    global marker
+    marker += 1
+    token = f'done-{os.getpid()}-{marker}'
+    send_keys(f'{text}; echo {token}')
+
+    def ran():
+        lines = [line.strip() for line in pane().split('\n')]
+        return lines[:lines.index(token)] if token in lines else None
+    lines = wait_until(ran, timeout, interval)
+    if lines is None:
+        raise TimeoutError(f"no return from `{text}` in the nd0 pane after {timeout} s")
+    return lines
+
+# pipereg.pl dbg output
+PC_LINE = re.compile(r'PC:\s*(0x[0-9a-fA-F]+)$')
+
+def pane_pc(script, timeout=SEND_TIMEOUT):
+    # PIPE_PC_DBG_REG through `script dbg` in the pane, None if regread failed
+    for line in reversed(send_wait(f'{script} dbg', timeout)):
+        match = PC_LINE.match(line)
+        if match:
+            return int(match.group(1), 16)
+        if line.startswith('PC:'):
+            return None
+    return None
+
+def send_lines(regs, instrs, script):
+    # imem_write/dmem_write lines go through regs in batches, every other line
+    # (pipereg.pl lab commands, d_w / d_r ..) to the pane as it is, in file order;
+    # regs None: all of them to the pane
+    batch = []
+    for entry in instrs:
+        line = entry[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        if regs is not None and line.split()[0] in ('imem_write', 'dmem_write'):
+            batch.append(line)
+            continue
+        if batch:
+            regs.load(batch)
+            batch = []
+        send_wait(f'{script} {line}')
+    if batch:
+        regs.load(batch)
+
+# pipereg.pl dmem_read output
+DMEM_LINE = re.compile(r'DMEM\[(\d+)\]\s*=\s*(0x[0-9a-fA-F]+)(0x[0-9a-fA-F]+)\s*$')
+
+def read_dmem_pane(script, start=0, count=pipereg.DMEM_WORDS):
+    # DMEM[start:start+count] word by word through `script dmem_read` in the
+    # nd0 pane, the path without $PIPEREG -> uint64 array
+    values = np.zeros(count, dtype=np.uint64)
+    for i in range(count):
+        addr = start + i
+
+        def read():
+            text = pane()
+            if text == before:
+                return None
+            for line in reversed(text.split('\n')):
+                match = DMEM_LINE.match(line.strip())
+                if match and int(match.group(1)) == addr:
+                    return match
+            return None
+        before = pane()
+        send_keys(f'{script} dmem_read {addr}')
+        match = wait_until(read, SEND_TIMEOUT, PANE_INTERVAL)
+        if match is None:
+            raise RuntimeError(f"no answer to dmem_read {addr} in the nd0 pane")
+        values[i] = int(match.group(2), 16) << 32 | int(match.group(3), 16)
+    return values
+
+def pipeline_logic(instrs, lines, bitfile, script, regs=None, target='st'):
+    # with $PIPEREG set (or regs given) download and halt are polled through
+    # pipereg, otherwise everything goes through the nd0 pane as `script cmd`
+    # (the board session openterm opened is the only one) and is polled there
+    if regs is None and pipereg.PIPEREG_SPEC is not None:
+        regs = pipereg.connect(ctrl=0)
+    download = f'nf_download {BF_MAP.get(bitfile,bitfile)}'
+    if regs is None:
+        print("PIPEREG not set, polling through the terminal script")
+        send_wait(download, DOWNLOAD_TIMEOUT)
+        if wait_until(lambda: pane_pc(script) is not None, DOWNLOAD_TIMEOUT, PANE_INTERVAL) is None:
+            raise TimeoutError("nf_download: no register access after download")
+        pc = lambda: pane_pc(script)
+    else:
+        wait_download(regs, lambda: send_keys(download))
+        pc = regs.pc
     #reset logic
-    reset = mapping(['reset'], 'reset', script)
-    subprocess.run(['tmux', 'send-keys', '-t', 'nd0', reset, 'C-m'])
-    time.sleep(1)
+    if regs is None:
+        send_wait('rkd &')
+        send_wait(mapping(['reset'], 'reset', script))
+    else:
+        send_keys('rkd &')
+        # the new design comes up with PIPE_CTRL_REG = 0
+        regs.ctrl = 0
+        regs.pcreset()
     #sp write to 0
     #fp write to 0
     #lp write to 0
 
-
-    for i in range(len(instrs)):
-        subprocess.run(['tmux', 'send-keys', '-t', 'nd0',f'{script} {instrs[i][0]}', 'C-m'])
-        time.sleep(0.1)
+    send_lines(regs, instrs, script)
+    halts = pipereg.halt_pcs(pipereg.imem_words(instrs), target)
     print ("All instructions sent. Waiting for execution ...")
     while 1:
         input_str = input("Enter 'run' 'step' 'q' or other command: ").strip()
         if input_str == 'run':
-            subprocess.run(['tmux', 'send-keys', '-t', 'nd0', f'{mapping(["run"], "execution start", script)}', 'C-m'])
-            time.sleep(30)
-            subprocess.run(['tmux', 'send-keys', '-t', 'nd0', f'{mapping(["stop"], "execution stop", script)}', 'C-m'])
+            if regs is None:
+                send_wait(mapping(["run"], "execution start", script))
+            else:
+                regs.run(1)
+            if halts is None:
+                print(f"a thread has no idle loop to halt on, stopping after {RUN_TIMEOUT} s")
+                time.sleep(RUN_TIMEOUT)
+            else:
+                took = wait_halt(pc, halts)
+                print(f"halted after {took:.3f} s" if took is not None else f"no halt after {RUN_TIMEOUT} s")
+            if regs is None:
+                send_wait(mapping(["stop"], "execution stop", script))
+            else:
+                regs.run(0)
         elif input_str == 'step':
-            subprocess.run(['tmux', 'send-keys', '-t', 'nd0', f'{mapping(["step"], "step execution", script)}', 'C-m'])
+            if regs is None:
+                send_wait(mapping(["step"], "step execution", script))
+            else:
+                regs.step()
         elif input_str == 'q':
             print("Exiting...")
-            subprocess.run(['tmux', 'send-keys', '-t', 'nd0', 'killall rkd', 'C-m'])
+            send_keys('killall rkd')
+            if regs is not None:
+                regs.close()
             break
-        elif input_str == 'readall':
-            for i in range (256):
-                subprocess.run(['tmux', 'send-keys', '-t', 'nd0', f'{mapping(["dmem_read", hex(i)], "read dmem", script)}', 'C-m'])
-                time.sleep(0.2)
-                result = subprocess.run(['tmux', 'capture-pane', '-t', 'nd0', '-p'], capture_output=True, text=True)
-    
-                # 4. Get the last non-empty line
-                lines = [line.strip() for line in result.stdout.split('\n') if line.strip()]
-                result = lines[-1] if lines else ''
-                with open('dmem_results.txt', 'a') as f:
-                    f.write(f'{i} : {result}\n')
+        elif input_str.startswith('readall'):
+            # readall [start count]
+            args = input_str.split()[1:]
+            start, count = (int(args[0], 0), int(args[1], 0)) if len(args) == 2 else (0, pipereg.DMEM_WORDS)
+            values = dump_dmem(start, count, regs) if regs is not None else read_dmem_pane(script, start, count)
+            save_dmem('dmem_results.txt', values, start)
+            print(f"DMEM[{start}:{start + count}] -> dmem_results.txt")
         else:
-            subprocess.run(['tmux', 'send-keys', '-t', 'nd0', f'{script} {input_str}', 'C-m'])
+            before = pane()
+            send_keys(f'{script} {input_str}')
             print(" unknown command, sent to terminal script")
-            time.sleep(2)
+            wait_until(lambda: pane() != before, SEND_TIMEOUT, PANE_INTERVAL)
             subprocess.run(['tmux', 'capture-pane', '-t', 'nd0', '-p', '-S', '-3'])
 
 
@@ -285,7 +485,7 @@ def mapping(split_in, line, script):
 def main():
     global count
     if len(sys.argv) < 6:
-        raise ValueError("Usage: python mission_send.py <name> <password> <bitfile> <cmdfile> <scripts> NOP")
+        raise ValueError("Usage: python mission_send.py <name> <password> <bitfile> <cmdfile> <scripts> [st|mt]")
     openterm(sys.argv, n)
     bitfile = BF_MAP.get(sys.argv[3], sys.argv[3])
     command_file = sys.argv[4]
@@ -294,7 +494,8 @@ def main():
     # instrs, lines = decode(command, script, log = True)
     instrs = command
     lines = list(range(len(command)))
-    pipeline_logic(instrs, lines, bitfile, script)
+    target = sys.argv[6] if len(sys.argv) > 6 else 'st'
+    pipeline_logic(instrs, lines, bitfile, script, target=target)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+import isa
+
+# list scheduler for one basic block of dense (unpadded) words
+#
+# every word keeps its register and memory order constraints, a consumer is
+# placed `gap` words after its producer when possible and the free slots are
+# filled with other ready words, highest critical path first.  whatever gap is
+# left is padded with NOPs by hazard.pad afterwards
+
+
+def split(kept, heads):
+    # [(pc, word)] -> basic blocks, a block starts at a head or a branch target
+    # and ends after a branch/jump
+    starts = set(heads)
+    if kept:
+        starts.add(kept[0][0])
+    blocks = []
+    block = []
+    for pc, word in kept:
+        if pc in starts and block:
+            blocks.append(block)
+            block = []
+        block.append((pc, word))
+        dec = isa.decode(word)
+        if dec.is_branch or dec.is_jump:
+            blocks.append(block)
+            block = []
+    if block:
+        blocks.append(block)
+    return blocks
+
+
+def mem_ref(dec, version):
+    # (base reg, base version, offset) of a load/store, address = Rn +- imm12
+    if dec.is_load or dec.mem_wen:
+        return dec.reg1, version[dec.reg1], dec.imm64 if dec.alu_ctrl == isa.ALU_ADD else -dec.imm64
+    return None
+
+
+def mem_conflict(a, b, a_store, b_store):
+    if not (a_store or b_store):
+        return False
+    base_a, ver_a, off_a = a
+    base_b, ver_b, off_b = b
+    if base_a == base_b and ver_a == ver_b:
+        # same base value, DMEM takes the low 8 bits of the sum
+        return (off_a - off_b) % 256 == 0
+    return True
+
+
+def dependences(decs, gap):
+    # preds[j] = {i: words j has to stay behind i}
+    n = len(decs)
+    version = {}
+    refs = []
+    for dec in decs:
+        for r in dec.reads:
+            version.setdefault(r, 0)
+        if dec.is_load or dec.mem_wen:
+            version.setdefault(dec.reg1, 0)
+        refs.append(mem_ref(dec, version))
+        for r in dec.writes:
+            version[r] = version.get(r, 0) + 1
+
+    preds = [dict() for _ in range(n)]
+    for j in range(n):
+        dj = decs[j]
+        for i in range(j):
+            di = decs[i]
+            lat = 0
+            if any(r in di.writes for r in dj.reads):
+                lat = gap
+            elif any(r in di.writes for r in dj.writes) or any(r in di.reads for r in dj.writes):
+                lat = 1
+            elif refs[i] and refs[j] and mem_conflict(refs[i], refs[j], di.mem_wen, dj.mem_wen):
+                lat = 1
+            elif dj.is_branch or dj.is_jump:
+                lat = 1
+            if lat:
+                preds[j][i] = lat
+    return preds
+
+
+def order(block, window, gap):
+    # reorder one block, window: writes of the last words emitted before it
+    decs = [isa.decode(word) for _, word in block]
+    n = len(decs)
+    if n < 2:
+        return block
+    preds = dependences(decs, gap)
+    succs = [[] for _ in range(n)]
+    for j in range(n):
+        for i, lat in preds[j].items():
+            succs[i].append((j, lat))
+
+    # latency weighted path to the end of the block
+    prio = [0] * n
+    for i in range(n - 1, -1, -1):
+        prio[i] = max((lat + prio[j] for j, lat in succs[i]), default=0)
+
+    # earliest slot from the words of the previous block
+    earliest = [0] * n
+    for j, dec in enumerate(decs):
+        for dist, writes in enumerate(reversed(window), 1):
+            if any(r in writes for r in dec.reads):
+                earliest[j] = max(earliest[j], gap - dist)
+
+    term = n - 1 if (decs[-1].is_branch or decs[-1].is_jump) else None
+    slot_of = {}
+    result = []
+    remaining = [j for j in range(n) if j != term]
+    slot = 0
+    while remaining:
+        ready = []
+        for j in remaining:
+            if all(i in slot_of for i in preds[j]):
+                at = max([earliest[j]] + [slot_of[i] + lat for i, lat in preds[j].items()])
+                if at <= slot:
+                    ready.append(j)
+        if ready:
+            pick = max(ready, key=lambda j: (prio[j], -j))
+            slot_of[pick] = slot
+            result.append(block[pick])
+            remaining.remove(pick)
+        slot += 1
+    if term is not None:
+        result.append(block[term])
+    return result
@@ -0,0 +1,375 @@
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+import devices
+import isa
+import link
+
+# cycle model of src/pipline/pipeline_arm.v running one program (the 'st'
+# target of hazard.py), final DMEM as the board would return it
+#
+#   python sim.py pp_output.txt
+#   python sim.py image.txt --dump dmem.txt --max-cycles 200000
+#
+# one word enters ID per cycle.  what the RTL registers are per stage:
+#
+#   cycle  t-2: pc in IF, IMEM latches the word     (pc, imem_dout)
+#          t-1: IF/ID                               (pc_delay -> ifid_pc)
+#          t  : ID reads the register file          (REG_FILE, IFRF bypass)
+#          t+1: EX, branches/jumps redirect pc      (ID/EX flushed)
+#          t+2: MEM, DMEM port A
+#          t+3: MEM/WB
+#          t+4: WB, the value reaches an ID read of the same cycle
+#
+# no forwarding: a word reads what the register file held when it was in ID,
+# writes of the last three words are not there yet.  a taken branch flushes
+# the word in ID, the two words fetched behind it still execute.  DMEM is only
+# touched in MEM, in program order, so loads and stores are done at EX here
+#
+# reset leaves pc_delay = 0 and the IMEM output on word 0 while the pipeline
+# is stalled, so after pcreset word 0 goes through ID twice
+
+DMEM_WORDS = 256
+MASK64 = (1 << 64) - 1
+SIGN64 = 1 << 63
+
+MAX_CYCLES = 1000000
+
+ALU = {
+    isa.ALU_NOP: lambda a, b: 0,
+    isa.ALU_ADD: lambda a, b: (a + b) & MASK64,
+    isa.ALU_SUB: lambda a, b: (a - b) & MASK64,
+    isa.ALU_AND: lambda a, b: a & b,
+    isa.ALU_OR: lambda a, b: a | b,
+    isa.ALU_XNOR: lambda a, b: ~(a ^ b) & MASK64,
+    isa.ALU_SHIFTL: lambda a, b: (a << 1) & MASK64,
+    isa.ALU_SHIFTR: lambda a, b: a >> 1,
+    isa.ALU_SHIFTLV: lambda a, b: (a << (b & 0x3F)) & MASK64,
+    isa.ALU_SHIFTRV: lambda a, b: a >> (b & 0x3F),
+    isa.ALU_SLT: lambda a, b: int((a ^ SIGN64) < (b ^ SIGN64)),
+}
+
+# what EX does with a word
+X_NOP = 0       # nothing, or a result nobody writes
+X_ALU = 1
+X_LOAD = 2
+X_STORE = 3
+X_BRANCH = 4    # B / BL / J
+X_COND = 5      # BEQ / BNE
+X_JR = 6        # BX
+X_IO = 7        # RDF / FIFOWAIT / FIFODONE / GPU_RUN / WRP, with devices.py attached
+
+STATS = ('cycles', 'alu', 'loads', 'stores', 'branches', 'taken', 'nops', 'flushed', 'stale',
+         'io', 'fifo_stall', 'gpu_stall')
+
+
+def predecode(word, pc, signed_imm=False, io=False):
+    # -> (what, alu, reg1, reg2, imm or None, wreg, target, bne) for EX
+    # io: decode the FIFO/GPU words, alu is then (op, arg)
+    if io and devices.decode_io(word) is not None:
+        op, reg, arg = devices.decode_io(word)
+        if op == devices.RDF:
+            return X_IO, (op, arg), 0, 0, None, reg, None, False, ()
+        if op == devices.WRP:
+            return X_IO, (op, arg), reg, 0, None, 0, None, False, (reg,) if reg else ()
+        return X_IO, (op, arg), 0, 0, None, 0, None, False, ()
+    dec = isa.decode(word, signed_imm)
+    imm = dec.imm64 if dec.use_imm else None
+    wreg = dec.wreg if dec.reg_wen else 0
+    target = isa.branch_target(dec, pc)
+    if dec.is_jump:
+        what = X_JR
+    elif dec.is_cond_branch:
+        what = X_COND
+    elif dec.is_branch:
+        what = X_BRANCH
+    elif dec.is_load:
+        what = X_LOAD
+    elif dec.mem_wen:
+        what = X_STORE
+    elif wreg:
+        what = X_ALU
+    else:
+        what = X_NOP
+    return what, ALU[dec.alu_ctrl], dec.reg1, dec.reg2, imm, wreg, target, dec.branch_cond, dec.reads
+
+
+# the same fields as arrays indexed by pc, for the models that step many
+# words at once (sim_mt.py)
+Table = namedtuple('Table', ['what', 'alu', 'reg1', 'reg2', 'use_imm', 'imm', 'wreg', 'target', 'bne'])
+
+
+def decode_table(imem, signed_imm=False):
+    rows = [predecode(word, pc, signed_imm) for pc, word in enumerate(imem)]
+    alu = {fn: ctrl for ctrl, fn in ALU.items()}
+    return Table(
+        what=np.array([row[0] for row in rows], dtype=np.int8),
+        alu=np.array([alu[row[1]] for row in rows], dtype=np.int8),
+        reg1=np.array([row[2] for row in rows], dtype=np.intp),
+        reg2=np.array([row[3] for row in rows], dtype=np.intp),
+        use_imm=np.array([row[4] is not None for row in rows]),
+        imm=np.array([row[4] or 0 for row in rows], dtype=np.uint64),
+        wreg=np.array([row[5] for row in rows], dtype=np.intp),
+        target=np.array([-1 if row[6] is None else row[6] for row in rows], dtype=np.int64),
+        bne=np.array([row[7] for row in rows]),
+    )
+
+
+U64 = np.uint64
+ALU_BATCH = {
+    isa.ALU_NOP: lambda a, b: np.zeros_like(a),
+    isa.ALU_ADD: lambda a, b: a + b,
+    isa.ALU_SUB: lambda a, b: a - b,
+    isa.ALU_AND: lambda a, b: a & b,
+    isa.ALU_OR: lambda a, b: a | b,
+    isa.ALU_XNOR: lambda a, b: ~(a ^ b),
+    isa.ALU_SHIFTL: lambda a, b: a << U64(1),
+    isa.ALU_SHIFTR: lambda a, b: a >> U64(1),
+    isa.ALU_SHIFTLV: lambda a, b: a << (b & U64(0x3F)),
+    isa.ALU_SHIFTRV: lambda a, b: a >> (b & U64(0x3F)),
+    isa.ALU_SLT: lambda a, b: (a.view(np.int64) < b.view(np.int64)).astype(np.uint64),
+}
+
+
+def alu_batch(ctrl, a, b):
+    # ALU.v over uint64 arrays, ctrl per element
+    out = np.zeros_like(a)
+    for op in np.flatnonzero(np.bincount(ctrl)).tolist():
+        lane = ctrl == op
+        out[lane] = ALU_BATCH[op](a[lane], b[lane])
+    return out
+
+
+class Pipeline:
+    def __init__(self, imem=None, dmem=None, signed_imm=False, fifo=None, gpu=None):
+        # signed_imm: sign-extend imm8/imm12 like CTRL_UNIT.v, off by default
+        # like the decoder inlined in pipeline_arm.v.  fifo/gpu: devices.Fifo/Gpu
+        # on the ports of the FIFO/GPU instructions, with neither they are NOPs
+        self.signed_imm = signed_imm
+        self.io = fifo is not None or gpu is not None
+        self.fifo = fifo if fifo is not None else devices.Fifo()
+        self.gpu = gpu if gpu is not None else devices.Gpu(latency=0)
+        self.imem = isa.new_image()
+        self.dmem = [0] * DMEM_WORDS
+        self.code = [None] * len(self.imem)
+        self.regs = [0] * 16
+        for pc, word in (imem or []):
+            self.imem_write(pc, word)
+        for addr, value in (dmem or {}).items():
+            self.dmem_write(addr, value)
+        self.reset()
+
+    def imem_write(self, pc, word):
+        pc &= isa.PC_MASK
+        self.imem[pc] = word
+        self.code[pc] = None
+
+    def dmem_write(self, addr, value):
+        self.dmem[addr & 0xFF] = value & MASK64
+
+    def reset(self):
+        # pcreset: pipeline registers cleared, the register file keeps its values
+        self.pc = 0
+        self.halt = None
+        self.stats = dict.fromkeys(STATS, 0)
+        self.visits = [0] * len(self.imem)     # words in EX per pc
+        self.fifo.reset()
+        self.gpu.reset()
+
+    def decoded(self, pc):
+        entry = self.code[pc]
+        if entry is None:
+            entry = self.code[pc] = predecode(self.imem[pc], pc, self.signed_imm, self.io)
+        return entry
+
+    def run(self, max_cycles=MAX_CYCLES, end=None):
+        # run until the program is caught in a loop of branches and NOPs (a
+        # `b .`, or `.L11: b .L12 / .L12: b .L11` as gcc output ends), returns
+        # the cycle that loop was entered, None when max_cycles ran out first.
+        # end: or until the word at this pc is in EX, for programs that run off
+        # their last word (write_Data_I_Mem.py), or FIFOWAIT when the fifo has
+        # nothing left.  t counts the cycles the pipeline advanced, a stall
+        # adds to fifo_stall / gpu_stall instead
+        regs = self.regs
+        dmem = self.dmem
+        code = self.code
+        decoded = self.decoded
+        stats = self.stats
+        visits = self.visits
+        pending = [None] * 4        # cycle & 3 -> (reg, value) written back that cycle
+        ready = [0] * 16            # cycle a register has its newest value
+        ex = None                   # (entry, pc, A, B, r2data) in EX
+        id_pc = None                # ifid after reset: 0x00000000, no effect
+        fetched = 0                 # pc_delay after reset
+        pc = 0
+        seen = [None] * len(code)  # branch pc -> (words done, cycle) when last taken
+        fifo = self.fifo
+        gpu = self.gpu
+        alu = loads = stores = branches = taken = nops = flushed = stale = 0
+        io = fifo_stall = gpu_stall = 0
+
+        t = 0
+        while t < max_cycles:
+            slot = t & 3
+            write = pending[slot]
+            if write is not None:
+                regs[write[0]] = write[1]
+                pending[slot] = None
+
+            # EX
+            jump = None
+            if ex is not None:
+                entry, ex_pc, a, b, r2 = ex
+                if ex_pc == end:
+                    self.halt = t + fifo_stall + gpu_stall
+                    break
+                visits[ex_pc] += 1
+                what = entry[0]
+                if what == X_ALU:
+                    value = entry[1](a, b)
+                    pending[(t + 3) & 3] = (entry[5], value)
+                    ready[entry[5]] = t + 3
+                    alu += 1
+                elif what == X_NOP:
+                    nops += 1
+                elif what == X_LOAD:
+                    value = dmem[entry[1](a, b) & 0xFF]
+                    if entry[5]:
+                        pending[(t + 3) & 3] = (entry[5], value)
+                        ready[entry[5]] = t + 3
+                    loads += 1
+                elif what == X_STORE:
+                    dmem[entry[1](a, b) & 0xFF] = r2
+                    stores += 1
+                elif what == X_IO:
+                    op, arg = entry[1]
+                    now = t + fifo_stall + gpu_stall
+                    io += 1
+                    if op == devices.FIFOWAIT:
+                        until = fifo.wait(now, dmem)
+                        if until is None:
+                            # held for good, no packet will come
+                            self.halt = now
+                            break
+                        fifo_stall += until - now
+                    elif op == devices.RDF:
+                        pending[(t + 3) & 3] = (entry[5], fifo.read(arg))
+                        ready[entry[5]] = t + 3
+                    elif op == devices.FIFODONE:
+                        fifo.done(now)
+                    elif op == devices.WRP:
+                        gpu.param(arg, a)
+                    else:
+                        gpu_stall += gpu.run(now, dmem) - now
+                else:
+                    branches += 1
+                    if what == X_BRANCH:
+                        jump = entry[6]
+                        if entry[5]:
+                            # BL: R14 = pc of the BL + 1
+                            pending[(t + 3) & 3] = (entry[5], (ex_pc + 1) & isa.PC_MASK)
+                            ready[entry[5]] = t + 3
+                    elif what == X_COND:
+                        if (a != b) == entry[7]:
+                            jump = entry[6]
+                    else:
+                        jump = r2 & isa.PC_MASK
+                    if jump is not None:
+                        taken += 1
+                        # back on a branch with nothing done since: idle for good
+                        done = alu + loads + stores + io
+                        last = seen[ex_pc]
+                        if last is not None and last[0] == done:
+                            self.halt = last[1]
+                            break
+                        seen[ex_pc] = (done, t + fifo_stall + gpu_stall)
+
+            # ID
+            if jump is not None:
+                if id_pc is not None:
+                    flushed += 1
+                ex = None
+            elif id_pc is not None:
+                entry = code[id_pc]
+                if entry is None:
+                    entry = decoded(id_pc)
+                for r in entry[8]:
+                    if ready[r] > t:
+                        stale += 1
+                r2 = regs[entry[3]] if entry[3] else 0
+                ex = (entry, id_pc, regs[entry[2]] if entry[2] else 0,
+                      r2 if entry[4] is None else entry[4], r2)
+            else:
+                ex = None
+
+            # IF
+            id_pc = fetched
+            fetched = pc
+            pc = (pc + 1) & isa.PC_MASK if jump is None else jump
+            t += 1
+
+        # words behind the halt finish their write back
+        for write in pending:
+            if write is not None:
+                regs[write[0]] = write[1]
+        self.pc = pc
+        stats.update(cycles=t + fifo_stall + gpu_stall, alu=alu, loads=loads, stores=stores,
+                     branches=branches, taken=taken, nops=nops, flushed=flushed, stale=stale,
+                     io=io, fifo_stall=fifo_stall, gpu_stall=gpu_stall)
+        return self.halt if t < max_cycles else None
+
+
+def load(path, signed_imm=False, fifo=None, gpu=None):
+    imem, dmem = link.read_image(path)
+    return Pipeline(imem, dmem, signed_imm, fifo, gpu)
+
+
+def write_dmem(path, dmem):
+    # dmem_write lines, the format read_image and pipereg.py take back
+    with open(path, 'w') as f:
+        for addr, value in enumerate(dmem):
+            f.write(f'dmem_write {addr} {value >> 32:#x} {value & 0xFFFFFFFF:#x}\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run a map.py/link.py image on a model of pipeline_arm.v')
+    parser.add_argument('image', nargs='?', default='pp_output.txt')
+    parser.add_argument('--max-cycles', type=int, default=MAX_CYCLES)
+    parser.add_argument('--sign-ext', action='store_true',
+                        help='sign-extend imm8/imm12 like CTRL_UNIT.v, the board zero-extends')
+    parser.add_argument('--end', type=lambda pc: int(pc, 0), help='stop when the word at this pc is in EX')
+    parser.add_argument('--fifo', help='fifo script (devices.py) feeding FIFOWAIT/RDF')
+    parser.add_argument('--fifo-gap', type=int, default=0, help='cycles from FIFODONE to the next packet')
+    parser.add_argument('--gpu-latency', type=int, help='cycles from GPU_RUN to gpu_done')
+    parser.add_argument('--dump', help='write the final DMEM here as dmem_write lines')
+    parser.add_argument('--regs', action='store_true', help='print the register file')
+    args = parser.parse_args()
+
+    fifo = devices.Fifo(devices.read_fifo_script(args.fifo), args.fifo_gap) if args.fifo else None
+    gpu = devices.Gpu(args.gpu_latency) if args.gpu_latency is not None else None
+    cpu = load(args.image, args.sign_ext, fifo, gpu)
+    halt = cpu.run(args.max_cycles, args.end)
+    if halt is None:
+        print(f'no halt after {args.max_cycles} cycles, pc {cpu.pc}')
+    print(' '.join(f'{name} {cpu.stats[name]}' for name in STATS))
+    if cpu.io:
+        stats = cpu.stats
+        stalled = stats['fifo_stall'] + stats['gpu_stall']
+        print(f'stalled {stalled} of {stats["cycles"]} cycles ({100 * stalled / max(1, stats["cycles"]):.1f}%): '
+              f'fifo {stats["fifo_stall"]} over {len(cpu.fifo.waits)} packets, '
+              f'gpu {stats["gpu_stall"]} over {len(cpu.gpu.runs)} runs')
+    if args.regs:
+        for r in range(16):
+            print(f'r{r:<2} {cpu.regs[r]:#018x}')
+    if args.dump:
+        write_dmem(args.dump, cpu.dmem)
+    else:
+        for addr, value in enumerate(cpu.dmem):
+            if value:
+                print(f'DMEM[{addr}] = {value:#018x}')
+
+
+if __name__ == "__main__":
+    main()
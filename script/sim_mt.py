@@ -0,0 +1,211 @@
+import argparse
+
+import numpy as np
+
+import hazard
+import isa
+import link
+import sim
+
+# model of src/pipline/pipiline_arm_mt.v: four threads, thread_id rotates
+# every cycle (pc_target.v), REG_FILE_BANK.v gives each thread its own 16
+# registers
+#
+#   python sim_mt.py image.txt              # link.py output
+#   python sim_mt.py image.txt --guard      # the planned stop guard
+#
+# thread k fetches on cycles k, k+4, .. and its words are in EX on cycles
+# 3+k, 7+k, ..  the next word of a thread reaches ID just as the previous one
+# is written back, and a taken branch redirects pc[ex_thread_id] before the
+# thread fetches again, so every thread runs its program in order with no
+# hazards and no shadow.  the model executes one word of every live thread
+# per step (a rotation) with numpy, DMEM accesses keep thread order.
+#
+# the word 0 fetch that reset leaves in IMEM goes through ID twice on the
+# first rotation, with the same register values both times, so it is not
+# modelled
+#
+# pc[6:0] of a thread wraps at 128, as pc_target.v does in the instantiated
+# design.  guard=True (--guard) models the stop guard of the commented-out pc
+# logic in pipiline_arm_mt.v instead (pc[6:1] == 111111 holds the pc);
+# hazard.PARTITION_USABLE keeps programs clear of it so they run on both
+
+THREADS = hazard.THREADS
+PARTITION = hazard.PARTITION
+LOCAL = PARTITION - 1           # pc[6:0]
+BASE = isa.PC_MASK & ~LOCAL     # pc[8:7], the thread
+
+STATS = ('alu', 'loads', 'stores', 'branches', 'taken', 'nops')
+
+
+def cycle(thread, step):
+    # cycle the word a thread executes in a step is in EX
+    return 3 + thread + 4 * step
+
+
+class Barrel:
+    def __init__(self, imem=None, dmem=None, signed_imm=False, guard=False):
+        self.signed_imm = signed_imm
+        self.guard = guard
+        self.imem = isa.new_image()
+        self.table = None
+        self.dmem = np.zeros(sim.DMEM_WORDS, dtype=np.uint64)
+        self.regs = np.zeros((THREADS, 16), dtype=np.uint64)
+        for pc, word in (imem or []):
+            self.imem_write(pc, word)
+        for addr, value in (dmem or {}).items():
+            self.dmem_write(addr, value)
+        self.reset()
+
+    def imem_write(self, pc, word):
+        self.imem[pc & isa.PC_MASK] = word
+        self.table = None
+
+    def dmem_write(self, addr, value):
+        self.dmem[addr & 0xFF] = value & sim.MASK64
+
+    def reset(self):
+        # pcreset: every thread back to the start of its partition
+        self.pcs = np.arange(THREADS, dtype=np.int64) * PARTITION
+        self.steps = 0
+        self.halt = [None] * THREADS
+        self.visits = np.zeros(len(self.imem), dtype=np.int64)     # words executed per pc
+        self.taken = np.zeros(len(self.imem), dtype=np.int64)      # taken branches per pc
+
+    def run(self, max_cycles=sim.MAX_CYCLES):
+        # run until every thread is held by the stop guard or caught in a loop
+        # of branches and NOPs (the wrap at 128 included), returns the cycle each thread got there (None:
+        # still running when max_cycles ran out)
+        if self.table is None:
+            self.table = sim.decode_table(self.imem, self.signed_imm)
+        T = self.table
+        regs = self.regs
+        dmem = self.dmem
+        pcs = self.pcs
+        visits = self.visits
+        taken_at = self.taken
+        live = np.array([h is None for h in self.halt])
+        threads = np.arange(THREADS)
+        done = np.zeros(THREADS, dtype=np.int64)     # ALU/load/store words per thread
+        seen = np.full(len(self.imem), -1, dtype=np.int64)  # done when a branch was last taken
+        seen_step = np.zeros(len(self.imem), dtype=np.int64)
+
+        step = self.steps
+        while live.any() and cycle(THREADS - 1, step) < max_cycles:
+            act = threads[live]
+            p = pcs[act]
+            what = T.what[p]
+            a = regs[act, T.reg1[p]]
+            r2 = regs[act, T.reg2[p]]
+            b = np.where(T.use_imm[p], T.imm[p], r2)
+            value = sim.alu_batch(T.alu[p], a, b)
+
+            # MEM, in thread order when a load could see a store of this step
+            load = what == sim.X_LOAD
+            store = what == sim.X_STORE
+            if load.any() or store.any():
+                addr = (value & sim.U64(0xFF)).astype(np.intp)
+                if load.any() and store.any():
+                    for i in np.flatnonzero(load | store):
+                        if store[i]:
+                            dmem[addr[i]] = r2[i]
+                        else:
+                            value[i] = dmem[addr[i]]
+                elif store.any():
+                    dmem[addr[store]] = r2[store]
+                else:
+                    value[load] = dmem[addr[load]]
+
+            # WB, BL links pc + 1
+            bl = (what == sim.X_BRANCH) & (T.wreg[p] != 0)
+            value[bl] = ((p[bl] + 1) & isa.PC_MASK).astype(np.uint64)
+            wreg = T.wreg[p]
+            write = wreg != 0
+            regs[act[write], wreg[write]] = value[write]
+
+            # EX redirects pc[ex_thread_id], pc_target keeps pc[8:7]
+            cond = what == sim.X_COND
+            jr = what == sim.X_JR
+            taken = (what == sim.X_BRANCH) | jr | (cond & ((a != r2) == T.bne[p]))
+            target = np.where(jr, (r2 & sim.U64(isa.PC_MASK)).astype(np.int64), T.target[p])
+            held = ((p & LOCAL) >> 1 == LOCAL >> 1) if self.guard else np.zeros(len(p), dtype=bool)
+            pcs[act] = np.where(taken, (p & BASE) | (target & LOCAL),
+                                np.where(held, p, (p & BASE) | ((p + 1) & LOCAL)))
+
+            # the live threads are in different partitions, p has no repeats
+            visits[p] += 1
+            taken_at[p[taken]] += 1
+            done[act] += (what == sim.X_ALU) | load | store
+
+            # back on a taken branch (or the wrap of pc[6:0], the way a thread
+            # without a program goes round its NOPs) with nothing done since,
+            # or held: finished
+            wrap = ~taken & ~held & ((p & LOCAL) == LOCAL)
+            for i in np.flatnonzero(taken | wrap | held):
+                k = int(act[i])
+                if taken[i] or wrap[i]:
+                    pc = p[i]
+                    if seen[pc] == done[k]:
+                        self.halt[k] = cycle(k, int(seen_step[pc]))
+                        live[k] = False
+                    seen[pc] = done[k]
+                    seen_step[pc] = step
+                else:
+                    self.halt[k] = cycle(k, step)
+                    live[k] = False
+            step += 1
+
+        self.steps = step
+        return list(self.halt)
+
+    @property
+    def stats(self):
+        # per thread counters, {name: [thread 0, .., thread 3]}
+        what = self.table.what if self.table is not None else sim.decode_table(self.imem, self.signed_imm).what
+        per = lambda counts: counts.reshape(THREADS, PARTITION).sum(axis=1)
+        return {
+            'alu': per(self.visits * (what == sim.X_ALU)),
+            'loads': per(self.visits * (what == sim.X_LOAD)),
+            'stores': per(self.visits * (what == sim.X_STORE)),
+            'branches': per(self.visits * (what >= sim.X_BRANCH)),
+            'taken': per(self.taken),
+            'nops': per(self.visits * (what == sim.X_NOP)),
+        }
+
+
+def load(path, signed_imm=False, guard=False):
+    imem, dmem = link.read_image(path)
+    return Barrel(imem, dmem, signed_imm, guard)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run a link.py image on a model of pipiline_arm_mt.v')
+    parser.add_argument('image', nargs='?', default='image.txt')
+    parser.add_argument('--max-cycles', type=int, default=sim.MAX_CYCLES)
+    parser.add_argument('--sign-ext', action='store_true',
+                        help='sign-extend imm8/imm12 like CTRL_UNIT.v, the board zero-extends')
+    parser.add_argument('--guard', action='store_true',
+                        help='hold the pc at word 126 like the planned stop guard, pc_target.v wraps pc[6:0] at 128')
+    parser.add_argument('--dump', help='write the final DMEM here as dmem_write lines')
+    parser.add_argument('--regs', action='store_true', help='print the register banks')
+    args = parser.parse_args()
+
+    cpu = load(args.image, signed_imm=args.sign_ext, guard=args.guard)
+    halt = cpu.run(args.max_cycles)
+    for k in range(THREADS):
+        state = f'halt {halt[k]}' if halt[k] is not None else f'running, pc {cpu.pcs[k]:#x}'
+        counts = ' '.join(f'{name} {cpu.stats[name][k]}' for name in STATS)
+        print(f'thread {k}: {state} {counts}')
+    if args.regs:
+        for r in range(16):
+            print(f'r{r:<2} ' + ' '.join(f'{int(cpu.regs[k, r]):#018x}' for k in range(THREADS)))
+    if args.dump:
+        sim.write_dmem(args.dump, [int(v) for v in cpu.dmem])
+    else:
+        for addr, value in enumerate(cpu.dmem):
+            if value:
+                print(f'DMEM[{addr}] = {int(value):#018x}')
+
+
+if __name__ == "__main__":
+    main()
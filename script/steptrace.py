@@ -0,0 +1,148 @@
+import argparse
+import os
+
+import numpy as np
+
+import isa
+import link
+import map
+import pipereg
+
+# single-step trace of the board, runStpe.py in one process: N steps over one
+# register channel, PIPE_PC_DBG_REG and PIPE_IF_INSTR_REG read after each,
+# streamed to a file of fixed-width records numpy can memory-map, and a diff of
+# two traces (say before / after a reassembly) down to the first step they part
+#
+#   PIPEREG='coproc:ssh netfpga python3 pipereg.py --backend ioctl serve' \
+#       python steptrace.py record 20000 before.trace --load pp_output.txt
+#   python steptrace.py show before.trace --start 100 --count 20
+#   python steptrace.py diff before.trace after.trace --lines pp_output.map
+#
+# file: MAGIC, record size (<u4), 4 spare bytes, then RECORD per step.  the
+# record count is whatever the file size holds, a trace cut short by ^C reads
+# back up to its last whole record.  the pc is the fetch address, as for
+# pcprof.py; diff compares pc and word of step i in both, not the step numbers
+
+MAGIC = b'MPTRACE1'
+HEADER = 16
+RECORD = np.dtype([('step', '<u4'), ('pc', '<u4'), ('instr', '<u4')])
+BATCH = 512             # steps per transact
+
+
+def record(regs, steps, path, batch=BATCH):
+    # step the board steps times into path, returns the records written
+    written = 0
+    with open(path, 'wb') as f:
+        f.write(MAGIC + np.array([RECORD.itemsize, 0], dtype='<u4').tobytes())
+        while written < steps:
+            count = min(batch, steps - written)
+            pcs, words = regs.step_trace(count)
+            chunk = np.empty(count, dtype=RECORD)
+            chunk['step'] = np.arange(written, written + count)
+            chunk['pc'] = np.array(pcs, dtype=np.uint32) & isa.PC_MASK
+            chunk['instr'] = words
+            f.write(chunk.tobytes())
+            f.flush()
+            written += count
+    return written
+
+
+def read_trace(path):
+    # the records of a trace file, memory-mapped
+    with open(path, 'rb') as f:
+        head = f.read(HEADER)
+    if len(head) < HEADER or head[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a step trace")
+    size = int(np.frombuffer(head, dtype='<u4', count=1, offset=len(MAGIC))[0])
+    if size != RECORD.itemsize:
+        raise ValueError(f"{path}: {size} byte records, expected {RECORD.itemsize}")
+    count = (os.path.getsize(path) - HEADER) // size
+    if not count:
+        return np.zeros(0, dtype=RECORD)
+    return np.memmap(path, dtype=RECORD, mode='r', offset=HEADER, shape=(count,))
+
+
+def diverge(a, b):
+    # first step whose pc or word differ, len of the shorter trace if one is
+    # a prefix of the other, None if they are the same
+    n = min(len(a), len(b))
+    differ = np.flatnonzero((a['pc'][:n] != b['pc'][:n]) | (a['instr'][:n] != b['instr'][:n]))
+    if len(differ):
+        return int(differ[0])
+    return None if len(a) == len(b) else n
+
+
+def source(lines):
+    # pc -> 'line label text' from a map.py line map
+    where = {}
+    for row in lines or []:
+        where.setdefault(row.pc, f'{row.line:>5}  {row.label:12} {row.text}')
+    return where
+
+
+def rows(trace, start, count, where=None, mark=None):
+    out = []
+    for rec in trace[max(0, start):start + count]:
+        step, pc, word = int(rec['step']), int(rec['pc']), int(rec['instr'])
+        flag = '>' if step == mark else ' '
+        out.append(f"{flag}{step:>9}  {pc:>3}  {word:#010x}  {(where or {}).get(pc, '')}")
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='record, show and diff single-step traces of the board')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    rec = sub.add_parser('record', help='step the board N times into a trace file')
+    rec.add_argument('steps', type=int)
+    rec.add_argument('path')
+    rec.add_argument('--load', help='map.py/link.py image to load first, the trace starts from pc reset')
+    rec.add_argument('--backend', default=pipereg.PIPEREG_SPEC, help='cmd | ioctl | fake | coproc:<server command>')
+    rec.add_argument('--batch', type=int, default=BATCH)
+    show = sub.add_parser('show', help='print records of a trace')
+    show.add_argument('path')
+    show.add_argument('--start', type=int, default=0)
+    show.add_argument('--count', type=int, default=50)
+    show.add_argument('--lines', help='map.py line map (.map) for the source column')
+    diff = sub.add_parser('diff', help='first step where two traces differ')
+    diff.add_argument('a')
+    diff.add_argument('b')
+    diff.add_argument('--context', type=int, default=5)
+    diff.add_argument('--lines', help='map.py line map (.map) for the source column')
+    args = parser.parse_args()
+
+    if args.cmd == 'record':
+        regs = pipereg.connect(args.backend)
+        try:
+            regs.run(0)
+            if args.load:
+                imem, dmem = link.read_image(args.load)
+                regs.load([f'dmem_write {addr} {value >> 32:#x} {value & 0xFFFFFFFF:#x}' for addr, value in dmem.items()]
+                          + [f'imem_write {pc} {word:#x}' for pc, word in imem])
+                regs.pcreset()
+            written = record(regs, args.steps, args.path, args.batch)
+        finally:
+            regs.close()
+        print(f'{written} steps to {args.path}')
+        return
+
+    where = source(map.read_line_map(args.lines)) if args.lines else None
+    if args.cmd == 'show':
+        print('\n'.join(rows(read_trace(args.path), args.start, args.count, where)))
+        return
+
+    a, b = read_trace(args.a), read_trace(args.b)
+    at = diverge(a, b)
+    if at is None:
+        print(f'same {len(a)} steps')
+        return
+    if at == min(len(a), len(b)):
+        print(f'same for {at} steps, then {args.a if len(a) > at else args.b} goes on')
+        return
+    print(f'first divergence at step {at}')
+    for name, trace in ((args.a, a), (args.b, b)):
+        print(name)
+        print('\n'.join(rows(trace, at - args.context, 2 * args.context + 1, where, mark=at)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+import hashlib
+from array import array
+from collections import namedtuple
+
+import hazard
+import isa
+import sim
+import sim_mt
+
+# block translation of IMEM images, the fast path behind sim.py / sim_mt.py
+#
+#   cpu = Engine(imem, dmem, target='mt')
+#   cpu.run()                       # same halt cycles as sim_mt.Barrel
+#
+# a basic block (a straight run of words up to the first branch) is turned
+# into one python function the first time execution reaches it:
+#
+#   def block_0x0a(R, D):
+#       R[3] = (R[2] + 1) & 0xffffffffffffffff
+#       if R[11] == R[0]: return 0x28
+#       return 0x0b
+#
+# R are the registers of the running thread, D the DMEM, the return value is
+# the next pc.  translations are shared by every Engine holding the same
+# image (keyed by a hash of the IMEM contents), an imem_write moves the engine
+# to the translation of the new contents
+#
+# 'st': the blocks run the program in order, which is what pipeline_arm.v
+# does as long as hazard.check finds nothing (no stale register read, NOPs in
+# every branch shadow).  images it complains about run on sim.Pipeline
+# instead.  a taken branch costs its three shadow slots
+# 'mt': threads have no hazards at all.  the live thread that has executed
+# the fewest words runs its next block, so DMEM accesses keep thread order
+# only to block granularity, threads that hand data to each other through
+# DMEM within a few words need sim_mt.Barrel
+
+M64 = '0xffffffffffffffff'
+S64 = '0x8000000000000000'
+
+CACHE_SIZE = 64
+
+Block = namedtuple('Block', ['run', 'pcs', 'words', 'fallthrough', 'branch', 'effects', 'held'])
+
+_programs = {}      # (image hash, target, signed_imm, guard) -> Program
+
+
+def operand(reg):
+    return f'R[{reg}]' if reg else '0'
+
+
+def alu_expr(ctrl, a, b):
+    # ALU.v on python ints, a/b are source text
+    if ctrl == isa.ALU_ADD:
+        if a == '0':
+            return b
+        return f'({a} + {b}) & {M64}'
+    if ctrl == isa.ALU_SUB:
+        return f'({a} - {b}) & {M64}'
+    if ctrl == isa.ALU_AND:
+        return f'{a} & {b}'
+    if ctrl == isa.ALU_OR:
+        return f'{a} | {b}'
+    if ctrl == isa.ALU_XNOR:
+        return f'~({a} ^ {b}) & {M64}'
+    if ctrl == isa.ALU_SHIFTL:
+        return f'({a} << 1) & {M64}'
+    if ctrl == isa.ALU_SHIFTR:
+        return f'{a} >> 1'
+    if ctrl == isa.ALU_SHIFTLV:
+        return f'({a} << ({b} & 63)) & {M64}'
+    if ctrl == isa.ALU_SHIFTRV:
+        return f'{a} >> ({b} & 63)'
+    if ctrl == isa.ALU_SLT:
+        return f'1 if ({a} ^ {S64}) < ({b} ^ {S64}) else 0'
+    return '0'
+
+
+class Program:
+    # translated blocks of one IMEM image, filled in as execution finds them
+    def __init__(self, imem, target='st', signed_imm=False, guard=False):
+        self.imem = list(imem)
+        self.target = target
+        self.signed_imm = signed_imm
+        self.guard = guard
+        self.blocks = [None] * len(self.imem)
+        # st: translation is only exact for hazard free images
+        self.exact = target == 'mt' or not hazard.check(list(enumerate(self.imem)), 'st')
+
+    def next_pc(self, pc):
+        if self.target == 'mt':
+            return (pc & sim_mt.BASE) | ((pc + 1) & sim_mt.LOCAL)
+        return (pc + 1) & isa.PC_MASK
+
+    def jump_pc(self, pc, target):
+        # pc_target.v keeps pc[8:7] of the thread
+        if self.target == 'mt':
+            return (pc & sim_mt.BASE) | (target & sim_mt.LOCAL)
+        return target
+
+    def held(self, pc):
+        return self.target == 'mt' and self.guard and (pc & sim_mt.LOCAL) >> 1 == sim_mt.LOCAL >> 1
+
+    def block(self, start):
+        blk = self.blocks[start]
+        if blk is None:
+            blk = self.blocks[start] = self.translate(start)
+        return blk
+
+    def translate(self, start):
+        lines = []
+        pcs = []
+        effects = 0
+        pc = start
+        held = self.held(start)
+        exit = None
+        while True:
+            pcs.append(pc)
+            dec = isa.decode(self.imem[pc], self.signed_imm)
+            a = operand(dec.reg1)
+            b = str(dec.imm64) if dec.use_imm else operand(dec.reg2)
+            if dec.kind == isa.K_ALU:
+                lines.append(f'R[{dec.wreg}] = {alu_expr(dec.alu_ctrl, a, b)}')
+                effects += 1
+            elif dec.kind == isa.K_LOAD:
+                op = '+' if dec.alu_ctrl == isa.ALU_ADD else '-'
+                if dec.writes:
+                    lines.append(f'R[{dec.wreg}] = D[({a} {op} {b}) & 255]')
+                effects += 1
+            elif dec.kind == isa.K_STORE:
+                op = '+' if dec.alu_ctrl == isa.ALU_ADD else '-'
+                lines.append(f'D[({a} {op} {b}) & 255] = {operand(dec.reg2)}')
+                effects += 1
+            elif dec.kind == isa.K_COND:
+                test = '!=' if dec.branch_cond else '=='
+                target = self.jump_pc(pc, isa.branch_target(dec, pc))
+                lines.append(f'if {a} {test} {operand(dec.reg2)}: return {target:#x}')
+                exit = pc
+            elif dec.kind in (isa.K_BRANCH, isa.K_JUMP):
+                if dec.is_bl:
+                    lines.append(f'R[{isa.REG_LINK}] = {(pc + 1) & isa.PC_MASK:#x}')
+                lines.append(f'return {self.jump_pc(pc, isa.branch_target(dec, pc)):#x}')
+                exit = pc
+            elif dec.kind == isa.K_JR:
+                if self.target == 'mt':
+                    lines.append(f'return {pc & sim_mt.BASE:#x} | ({operand(dec.reg2)} & {sim_mt.LOCAL:#x})')
+                else:
+                    lines.append(f'return {operand(dec.reg2)} & {isa.PC_MASK:#x}')
+                exit = pc
+            nxt = self.next_pc(pc)
+            if exit is not None or held or nxt <= pc or self.held(nxt):
+                break
+            pc = nxt
+        # a held pc is fetched again and again
+        fallthrough = pc if held else nxt
+        if not lines or not lines[-1].startswith('return'):
+            lines.append(f'return {fallthrough:#x}')
+        name = f'block_{start:#05x}'
+        src = f'def {name}(R, D):\n' + ''.join(f'    {line}\n' for line in lines)
+        space = {}
+        exec(compile(src, f'<{self.target} {name}>', 'exec'), space)
+        return Block(space[name], tuple(pcs), len(pcs), fallthrough, pc, effects, held)
+
+
+def program(imem, target='st', signed_imm=False, guard=False):
+    key = (hashlib.blake2b(array('I', imem)).hexdigest(), target, signed_imm, guard)
+    prog = _programs.get(key)
+    if prog is None:
+        if len(_programs) >= CACHE_SIZE:
+            del _programs[next(iter(_programs))]
+        prog = _programs[key] = Program(imem, target, signed_imm, guard)
+    return prog
+
+
+class Engine:
+    def __init__(self, imem=None, dmem=None, target='st', signed_imm=False, guard=False):
+        self.target = target
+        self.signed_imm = signed_imm
+        self.guard = guard
+        self.imem = isa.new_image()
+        self.prog = None
+        self.dmem = [0] * sim.DMEM_WORDS
+        threads = sim_mt.THREADS if target == 'mt' else 1
+        self.regs = [[0] * 16 for _ in range(threads)]
+        for pc, word in (imem or []):
+            self.imem_write(pc, word)
+        for addr, value in (dmem or {}).items():
+            self.dmem_write(addr, value)
+        self.reset()
+
+    def imem_write(self, pc, word):
+        self.imem[pc & isa.PC_MASK] = word
+        self.prog = None
+
+    def dmem_write(self, addr, value):
+        self.dmem[addr & 0xFF] = value & sim.MASK64
+
+    def reset(self):
+        self.halt = None if self.target == 'st' else [None] * sim_mt.THREADS
+        self.cycles = 0
+        self.entries = [0] * len(self.imem)     # block start -> times run
+        self.taken = [0] * len(self.imem)       # block start -> times it left through its branch
+        self.cycle_stats = None
+
+    def program(self):
+        if self.prog is None:
+            self.prog = program(self.imem, self.target, self.signed_imm, self.guard)
+        return self.prog
+
+    def run(self, max_cycles=sim.MAX_CYCLES):
+        # from pcreset until halted, returns the halt cycle like sim.py
+        # (st) or the per thread list like sim_mt.py (mt)
+        self.reset()
+        prog = self.program()
+        if self.target == 'mt':
+            return self.run_mt(prog, max_cycles)
+        if not prog.exact:
+            return self.run_cycles(max_cycles)
+        return self.run_st(prog, max_cycles)
+
+    def run_cycles(self, max_cycles):
+        # hazards in the image: every cycle of sim.Pipeline
+        cpu = sim.Pipeline(signed_imm=self.signed_imm)
+        cpu.imem[:] = self.imem
+        cpu.dmem = self.dmem
+        cpu.regs = self.regs[0]
+        self.halt = cpu.run(max_cycles)
+        self.cycles = cpu.stats['cycles']
+        self.cycle_stats = cpu.stats
+        return self.halt
+
+    def run_st(self, prog, max_cycles):
+        R = self.regs[0]
+        D = self.dmem
+        blocks = prog.blocks
+        entries = self.entries
+        taken = self.taken
+        seen = {}
+        done = 0
+        pc = 0
+        t = 2           # ID slot of word 0, see sim.py
+        while t < max_cycles:
+            blk = blocks[pc] or prog.block(pc)
+            nxt = blk.run(R, D)
+            entries[pc] += 1
+            t += blk.words
+            done += blk.effects
+            if nxt != blk.fallthrough:
+                # t: the branch is in EX, back on it with nothing done: idle
+                taken[pc] += 1
+                last = seen.get(blk.branch)
+                if last is not None and last[0] == done:
+                    self.halt = last[1]
+                    break
+                seen[blk.branch] = (done, t)
+                t += hazard.BRANCH_SHADOW
+            pc = nxt
+        self.cycles = t
+        return self.halt if t < max_cycles else None
+
+    def run_mt(self, prog, max_cycles):
+        # one block of every live thread per round
+        D = self.dmem
+        blocks = prog.blocks
+        entries = self.entries
+        taken = self.taken
+        regs = self.regs
+        pcs = [k * sim_mt.PARTITION for k in range(sim_mt.THREADS)]
+        steps = [0] * sim_mt.THREADS        # words executed per thread
+        done = [0] * sim_mt.THREADS
+        seen = {}
+        limit = [(max_cycles - sim_mt.cycle(k, 0) + 3) // 4 for k in range(sim_mt.THREADS)]
+        live = list(range(sim_mt.THREADS))
+        while live:
+            for k in live:
+                pc = pcs[k]
+                blk = blocks[pc] or prog.block(pc)
+                nxt = blk.run(regs[k], D)
+                entries[pc] += 1
+                steps[k] += blk.words
+                done[k] += blk.effects
+                if nxt != blk.fallthrough:
+                    taken[pc] += 1
+                if nxt != blk.fallthrough or nxt < blk.branch:
+                    # a taken branch or the wrap of pc[6:0]
+                    last = seen.get(blk.branch)
+                    if last is not None and last[0] == done[k]:
+                        self.halt[k] = sim_mt.cycle(k, last[1])
+                        live = [j for j in live if j != k]
+                    seen[blk.branch] = (done[k], steps[k] - 1)
+                elif blk.held:
+                    self.halt[k] = sim_mt.cycle(k, steps[k] - 1)
+                    live = [j for j in live if j != k]
+                pcs[k] = nxt
+                if steps[k] >= limit[k]:
+                    live = [j for j in live if j != k]
+        self.cycles = max(sim_mt.cycle(k, steps[k]) for k in range(sim_mt.THREADS))
+        return list(self.halt)
+
+    @property
+    def stats(self):
+        # the counters of sim.py (st, without the second pass of word 0 after
+        # reset) or, per thread, sim_mt.py (mt)
+        if self.cycle_stats is not None:
+            return self.cycle_stats
+        prog = self.program()
+        threads = sim_mt.THREADS if self.target == 'mt' else 1
+        names = sim_mt.STATS if self.target == 'mt' else sim.STATS
+        counts = [dict.fromkeys(names, 0) for _ in range(threads)]
+        for start, n in enumerate(self.entries):
+            if not n:
+                continue
+            count = counts[start // sim_mt.PARTITION if threads > 1 else 0]
+            for pc in prog.blocks[start].pcs:
+                what = sim.predecode(prog.imem[pc], pc, self.signed_imm)[0]
+                name = {sim.X_ALU: 'alu', sim.X_LOAD: 'loads', sim.X_STORE: 'stores',
+                        sim.X_NOP: 'nops'}.get(what, 'branches')
+                count[name] += n
+            count['taken'] += self.taken[start]
+        if self.target == 'mt':
+            return {name: [count[name] for count in counts] for name in names}
+        count = counts[0]
+        # a taken branch: one word flushed, two shadow NOPs executed
+        count['nops'] += 2 * count['taken']
+        count['flushed'] = count['taken']
+        count['cycles'] = self.cycles
+        return count
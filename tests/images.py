@@ -0,0 +1,100 @@
+import os
+
+import map
+import sim
+import sim_mt
+import translate
+
+# test images: source snippets assembled by map.py and run on sim.py (st) or
+# sim_mt.py (mt), every run checked against translate.py on the same image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PIPELINE = os.path.join(HERE, '..', 'script', 'pipeline.txt')
+MASK64 = (1 << 64) - 1
+
+# sum of 0..9 in [fp, #-N] slots, the result stored through a .LC pointer
+SCALARS = """
+.LC0:
+.word	0
+.word	0
+push	{fp, lr}
+add	fp, sp, #4
+sub	sp, sp, #16
+mov	r3, #0
+str	r3, [fp, #-8]
+mov	r3, #0
+str	r3, [fp, #-12]
+b	.L2
+.L3:
+ldr	r2, [fp, #-12]
+ldr	r3, [fp, #-8]
+add	r3, r2, r3
+str	r3, [fp, #-12]
+ldr	r3, [fp, #-8]
+add	r3, r3, #1
+str	r3, [fp, #-8]
+.L2:
+ldr	r3, [fp, #-8]
+cmp	r3, #9
+ble	.L3
+ldr	r3, .L8
+ldr	r2, [fp, #-12]
+str	r2, [r3]
+ldr	r2, [fp, #-8]
+str	r2, [r3, #4]
+.L11:
+b	.L11
+.L8:
+.word	.LC0
+"""
+SCALARS_OUT = [45, 10]
+
+# the words pipeline.txt sorts into a stack array
+PIPELINE_DATA = [323, 123, -455, 2, 98, 125, 10, 65, -56, 0]
+
+
+def assemble(source, **options):
+    if source == PIPELINE:
+        with open(PIPELINE) as f:
+            source = f.read()
+    return map.Assembler(**options).assemble(source.strip().split('\n'))
+
+
+def run(image, target='st', signed_imm=False):
+    # -> (dmem, registers of thread 0) once the program halts
+    if target == 'st':
+        cpu = sim.Pipeline(image.imem, dict(image.dmem), signed_imm)
+        assert cpu.run() is not None
+        dmem, regs = list(cpu.dmem), list(cpu.regs)
+    else:
+        cpu = sim_mt.Barrel(image.imem, dict(image.dmem), signed_imm)
+        assert cpu.run()[0] is not None
+        dmem, regs = [int(v) for v in cpu.dmem], [int(v) for v in cpu.regs[0]]
+    engine = translate.Engine(image.imem, dict(image.dmem), target, signed_imm)
+    engine.run()
+    assert list(engine.dmem) == dmem
+    assert list(engine.regs[0]) == regs
+    return dmem, regs
+
+
+def signed(value):
+    value &= MASK64
+    return value - (1 << 64) if value >> 63 else value
+
+
+def words(image, dmem, label, count, step=4):
+    # count DMEM words from a data label on, as signed values
+    first = image.symbols[label]
+    return [signed(dmem[(first + i * step) & 0xFF]) for i in range(count)]
+
+
+def contains(values, run):
+    values = [signed(v) for v in values]
+    return any(values[i:i + len(run)] == run for i in range(len(values) - len(run) + 1))
+
+
+def regions(image, dmem):
+    # {region: [values]} of the data labels and the stack in image.memory,
+    # these only move between byte and COMPACT builds
+    return {name: [signed(dmem[a]) for a in range(first, last + 1, step)]
+            for first, last, step, name in image.memory if name.startswith(('data', 'stack'))}
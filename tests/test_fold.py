@@ -0,0 +1,14 @@
+import pytest
+
+from images import PIPELINE, assemble, run
+
+
+@pytest.mark.parametrize('target', ['st', 'mt'])
+@pytest.mark.parametrize('promote', [False, True])
+def test_pipeline_copy_folded(target, promote):
+    # the .LC0 copy becomes dmem_write lines, the run ends with the same DMEM
+    plain = assemble(PIPELINE, target=target, PROMOTE=promote)
+    image = assemble(PIPELINE, target=target, PROMOTE=promote, FOLD=True)
+    assert len(image.imem) < len(plain.imem)
+    assert len(image.dmem) > len(plain.dmem)
+    assert run(image, target)[0] == run(plain, target)[0]
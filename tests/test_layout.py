@@ -0,0 +1,77 @@
+import pytest
+
+import layout
+from images import PIPELINE, PIPELINE_DATA, SCALARS, SCALARS_OUT, assemble, contains, regions, run
+
+
+@pytest.mark.parametrize('target', ['st', 'mt'])
+@pytest.mark.parametrize('promote', [False, True])
+def test_scalars(target, promote):
+    plain = assemble(SCALARS, target=target, PROMOTE=promote)
+    image = assemble(SCALARS, target=target, PROMOTE=promote, COMPACT=True)
+    want = regions(plain, run(plain, target)[0])
+    assert want['data .LC0'] == SCALARS_OUT
+    assert regions(image, run(image, target)[0]) == want
+
+
+@pytest.mark.parametrize('target', ['st', 'mt'])
+@pytest.mark.parametrize('options', [{}, {'PROMOTE': True}, {'PROMOTE': True, 'FOLD': True}],
+                         ids=['plain', 'promote', 'fold'])
+def test_pipeline_sorts(target, options):
+    plain = assemble(PIPELINE, target=target, **options)
+    image = assemble(PIPELINE, target=target, COMPACT=True, **options)
+    assert image.memory[-1] == (240, 255, 1, 'stack (16 words)')
+    got = regions(image, run(image, target)[0])
+    assert got == regions(plain, run(plain, target)[0])
+    assert got['data .LC0'] == PIPELINE_DATA
+    assert contains(got['stack (16 words)'], sorted(PIPELINE_DATA))
+
+
+def test_data_clear_of_fixed_words():
+    # str r3, [r6, #1] with r6 = 0 writes DMEM[1] by index
+    image = assemble(PIPELINE, COMPACT=True)
+    assert (1, 1, 1, 'fixed (line 81)') in image.memory
+    assert all(not first <= 1 <= last for first, last, step, name in image.memory if name.startswith('data'))
+
+
+# words named through mov r6, #0 and pool constants read after them
+INDEXED = """
+mov	r6, #0
+mov	r3, #7
+str	r3, [r6, #4]
+str	r3, [r6, #8]
+str	r3, [r6, #12]
+str	r3, [r6, #16]
+str	r3, [r6, #20]
+mov	r1, #100000
+mov	r2, #0x12345678
+str	r1, [r6, #24]
+str	r2, [r6, #28]
+.L11:
+b	.L11
+"""
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_pool_clear_of_fixed_words(compact):
+    image = assemble(INDEXED, COMPACT=compact)
+    step = 1 if compact else 4
+    fixed = {first for first, last, s, name in image.memory if name.startswith('fixed')}
+    pool = {addr for addr, value in image.dmem}
+    assert fixed == set(range(step, 8 * step, step))
+    assert pool and not pool & fixed
+    dmem = run(image)[0]
+    assert [dmem[a] for a in range(step, 8 * step, step)] == [7] * 5 + [100000, 0x12345678]
+
+
+def test_unknown_index_base():
+    source = SCALARS.replace('str\tr2, [r3, #4]', 'ldr\tr6, [fp, #-12]\nstr\tr2, [r6, #1]')
+    with pytest.raises(ValueError, match='not a known address'):
+        assemble(source, COMPACT=True)
+    assemble(source)
+
+
+def test_memory_map_fails_on_stack_overlap():
+    data = [(a, 1) for a in range(0, 250)]
+    with pytest.raises(ValueError, match='overlaps the stack'):
+        layout.memory_map(data, {'.LC0': 0}, [], 16, 1)
@@ -0,0 +1,70 @@
+import pytest
+
+import link
+import map
+import sim_mt
+
+# every thread stores 7 to DMEM[r1], r1 patched per thread
+TEMPLATE = """
+mov	r1, #5
+mov	r3, #7
+str	r3, [r1]
+.L1:
+b	.L1
+"""
+
+
+def build(tmp_path, source):
+    lines = source.strip().split('\n')
+    image = map.Assembler(target='mt').assemble(lines)
+    out = tmp_path / 'prog.txt'
+    out.write_text(''.join(line[0] + '\n' for line in image.output))
+    map.write_line_map(tmp_path / 'prog.map', map.line_map(image, lines, 'mt'))
+    return out
+
+
+def test_param_skips_reset_prologue(tmp_path):
+    out = build(tmp_path, TEMPLATE)
+    words, dmem = link.read_image(str(out))
+    programs = link.instances(words, [(1, [10, 20, 30, 40])], link.reset_pcs(tmp_path / 'prog.map'))
+    cpu = sim_mt.Barrel(sorted(link.link(programs).items()), dmem)
+    assert all(halt is not None for halt in cpu.run())
+    assert [int(cpu.dmem[a]) for a in (5, 10, 20, 30, 40)] == [0, 7, 7, 7, 7]
+
+
+def test_param_range():
+    words = [(0, 0xe3a01000)]
+    assert link.patch_mov(words, 1, 127) == [(0, 0xe3a0107f)]
+    with pytest.raises(ValueError, match='outside 0..127'):
+        link.patch_mov(words, 1, 128)
+
+
+# .LC0 copied to DMEM[r1]
+DATA = """
+.LC0:
+.word	{value}
+ldr	r3, .L8
+ldr	r2, [r3]
+mov	r1, #{to}
+str	r2, [r1]
+.L1:
+b	.L1
+.L8:
+.word	.LC0
+"""
+
+
+def test_programs_with_own_data(tmp_path):
+    images = []
+    for thread, start in enumerate((0, 8)):
+        lines = DATA.format(value=11 * (thread + 1), to=100 + 4 * thread).strip().split('\n')
+        image = map.Assembler(RMEM_START=start, target='mt').assemble(lines)
+        out = tmp_path / f'prog{thread}.txt'
+        out.write_text(''.join(line[0] + '\n' for line in image.output))
+        images.append(link.read_image(str(out)))
+    dmem = link.merge_dmem([(f'prog{thread}', data) for thread, (words, data) in enumerate(images)])
+    cpu = sim_mt.Barrel(sorted(link.link([words for words, data in images]).items()), dmem)
+    cpu.run()
+    assert [int(cpu.dmem[a]) for a in (100, 104)] == [11, 22]
+    with pytest.raises(ValueError, match='--dmem-start'):
+        link.merge_dmem([('a', {0: 11}), ('b', {0: 22})])
@@ -0,0 +1,81 @@
+import pytest
+
+import isa
+import materialize
+from images import assemble, regions, run
+
+# immediates outside 0..127, one through an [fp, #-N] slot
+WIDE = """
+.LC0:
+.word	5
+.word	0
+.word	0
+.word	0
+.word	0
+.word	0
+.word	0
+.word	0
+.word	0
+push	{fp, lr}
+add	fp, sp, #4
+sub	sp, sp, #8
+mov	r3, #1000
+mov	r2, #-200
+add	r3, r3, #-4
+add	r2, r2, #300
+mov	r1, #100000
+mov	r4, #0x12345678
+mov	r5, #-1
+sub	r5, r5, #130
+mov	r6, #200
+cmp	r6, #199
+bgt	.L2
+mov	r6, #0
+.L2:
+str	r3, [fp, #-8]
+ldr	r7, [fp, #-8]
+ldr	r9, .L8
+ldr	r0, [r9]
+str	r3, [r9, #4]
+str	r2, [r9, #8]
+str	r1, [r9, #12]
+str	r4, [r9, #16]
+str	r5, [r9, #20]
+str	r6, [r9, #24]
+str	r7, [r9, #28]
+str	r0, [r9, #32]
+.L11:
+b	.L11
+.L8:
+.word	.LC0
+"""
+WIDE_OUT = [5, 996, 100, 100000, 0x12345678, -131, 200, 996, 5]
+
+
+@pytest.mark.parametrize('signed_imm', [False, True])
+@pytest.mark.parametrize('options', [{}, {'SCHEDULE': False}, {'NOP_NUM': 3}, {'COMPACT': True}],
+                         ids=['schedule', 'plain', 'nops', 'compact'])
+def test_wide_immediates(options, signed_imm):
+    # materialized constants read the same on both decoders
+    image = assemble(WIDE, **options)
+    assert {form for line, value, form, words, cycles in image.constants} == {'imm8', 'pool'}
+    dmem, regs = run(image, signed_imm=signed_imm)
+    assert regions(image, dmem)['data .LC0'] == WIDE_OUT
+
+
+@pytest.mark.parametrize('target', ['st', 'mt'])
+def test_wide_immediates_without_pool(monkeypatch, target):
+    monkeypatch.setattr(materialize.Pool, 'room', lambda self, value: False)
+    image = assemble(WIDE, target=target)
+    forms = {form for line, value, form, words, cycles in image.constants}
+    assert {'split', 'sequence'} <= forms and 'pool' not in forms
+    for signed_imm in (False, True):
+        dmem, regs = run(image, target, signed_imm)
+        assert regions(image, dmem)['data .LC0'] == WIDE_OUT
+
+
+def test_decode_zero_extends_by_default():
+    # mov r3, #200: 200 on the board, -56 on CTRL_UNIT.v
+    word = 0xE3A030C8
+    assert isa.decode(word).imm64 == 200
+    assert isa.decode(word, signed_imm=True).imm64 == (-56) & materialize.MASK64
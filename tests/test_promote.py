@@ -0,0 +1,58 @@
+import pytest
+
+import promote
+from images import PIPELINE, PIPELINE_DATA, SCALARS, SCALARS_OUT, assemble, contains, run, words
+
+
+@pytest.mark.parametrize('target', ['st', 'mt'])
+def test_scalars(target):
+    image = assemble(SCALARS, target=target, PROMOTE=True)
+    assert len(image.imem) < len(assemble(SCALARS, target=target).imem)
+    dmem, regs = run(image, target)
+    assert words(image, dmem, '.LC0', 2) == SCALARS_OUT
+
+
+@pytest.mark.parametrize('target', ['st', 'mt'])
+def test_pipeline_sorts(target):
+    # the array is addressed through fp and stays in DMEM, i / j / the swap go
+    # to registers
+    image = assemble(PIPELINE, target=target, PROMOTE=True)
+    assert len(image.imem) < len(assemble(PIPELINE, target=target).imem)
+    dmem, regs = run(image, target)
+    assert words(image, dmem, '.LC0', 10) == PIPELINE_DATA
+    assert contains(dmem[::4], sorted(PIPELINE_DATA))
+
+
+# a[2] = 9 through a pointer into int a[4] at fp-24, then read back as the
+# plain slot [fp, #-16] and stored to DMEM[100]; the scalar at fp-8 to DMEM[104]
+ARRAY = """
+push	{fp, lr}
+add	fp, sp, #4
+sub	sp, sp, #24
+sub	ip, fp, #24
+add	r3, ip, #8
+mov	r2, #9
+str	r2, [r3]
+ldr	r3, [fp, #-16]
+mov	r6, #0
+str	r3, [r6, #100]
+mov	r3, #5
+str	r3, [fp, #-8]
+ldr	r3, [fp, #-8]
+str	r3, [r6, #104]
+.L11:
+b	.L11
+"""
+
+
+@pytest.mark.parametrize('source', [
+    ARRAY,
+    # the pointer kept in a slot (int *p = a), the array reaches up to fp
+    ARRAY.replace('add\tr3, ip, #8', 'str\tip, [fp, #-12]\nldr\tr3, [fp, #-12]\nadd\tr3, r3, #8'),
+], ids=['pointer', 'escaped'])
+def test_array_element_not_promoted(source):
+    lines, promoted = promote.promote(source.strip().split('\n'))
+    assert 16 not in {n for first, n in promoted}
+    for option in (False, True):
+        dmem, regs = run(assemble(source, PROMOTE=option))
+        assert dmem[100:105:4] == [9, 5]
@@ -0,0 +1,25 @@
+import pytest
+
+import regress
+
+
+@pytest.mark.parametrize('case', regress.CASES, ids=[case.name for case in regress.CASES])
+def test_recorded_case(case):
+    result = regress.run_case(case)
+    assert result['ok'], regress.show('model', result['diff'])
+
+
+@pytest.mark.parametrize('name, at', [('sort-dump', 2), ('sort-dump1', 2), ('sort-dump2', 4), ('sort-dump3', 60)])
+def test_snapshot_found_from_dump(name, at):
+    case = next(case for case in regress.CASES if case.name == name)
+    assert regress.run_case(case)['found'] == [at]
+    assert regress.run_case(case._replace(at=at))['ok']
+    assert not regress.run_case(case._replace(at=at - 1))['ok']
+
+
+def test_snapshot_never_reached(tmp_path):
+    case = next(case for case in regress.CASES if case.name == 'sort-dump2')
+    dump = tmp_path / 'dump.txt'
+    dump.write_text(open(case.expected).read().replace('DMEM[0] = 0xffffffff0xfffffe39', 'DMEM[0] = 0x000000000x00000005'))
+    result = regress.run_case(case._replace(expected=str(dump)))
+    assert not result['ok'] and result['found'] == []
@@ -0,0 +1,44 @@
+import pytest
+
+import sim_mt
+import translate
+from images import PIPELINE, PIPELINE_DATA, SCALARS, SCALARS_OUT, assemble, contains, run, words
+
+# translate.py against sim.py / sim_mt.py (checked in run()) on scheduled,
+# unscheduled and NOP_NUM padded images
+
+
+@pytest.mark.parametrize('target', ['st', 'mt'])
+@pytest.mark.parametrize('options', [{'SCHEDULE': False}, {}, {'NOP_NUM': 3}], ids=['plain', 'schedule', 'nops'])
+def test_scalars(target, options):
+    image = assemble(SCALARS, target=target, **options)
+    dmem, regs = run(image, target)
+    assert words(image, dmem, '.LC0', 2) == SCALARS_OUT
+
+
+@pytest.mark.parametrize('target', ['st', 'mt'])
+def test_schedule_keeps_state(target):
+    plain = run(assemble(SCALARS, target=target, SCHEDULE=False), target)
+    assert run(assemble(SCALARS, target=target), target) == plain
+    assert run(assemble(SCALARS, target=target, NOP_NUM=3), target) == plain
+
+
+@pytest.mark.parametrize('target', ['st', 'mt'])
+def test_pipeline_sorts(target):
+    image = assemble(PIPELINE, target=target)
+    dmem, regs = run(image, target)
+    assert words(image, dmem, '.LC0', 10) == PIPELINE_DATA
+    assert contains(dmem[::4], sorted(PIPELINE_DATA))
+    assert run(assemble(PIPELINE, target=target, SCHEDULE=False), target) == (dmem, regs)
+
+
+@pytest.mark.parametrize('guard', [False, True])
+def test_mt_halts(guard):
+    # threads without a program go round their NOPs (pc_target.v wraps pc[6:0])
+    # or are held by the planned stop guard, both models halt them alike
+    image = assemble(SCALARS, target='mt')
+    cpu = sim_mt.Barrel(image.imem, dict(image.dmem), guard=guard)
+    halt = cpu.run()
+    engine = translate.Engine(image.imem, dict(image.dmem), 'mt', guard=guard)
+    assert engine.run() == halt
+    assert None not in halt